@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import json
+import hashlib
+import argparse
+import datetime
+import numpy as np
+from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateOne, DeleteMany
+
+from apps.database import db, lazy_collection
+from apps import geometry, masks
+from apps.indexes import ensure_indexes, log_plan
+
+
+# one document per annotation:
+#   image_id, name, label, shape_type, source ('manual' or MLflow run id),
+#   bbox [x0, y0, x1, y1], area, geometry {x, y} (binary, see apps/geometry.py),
+#   style (remaining Plotly trace keys), mask {size, counts} (RLE of mask annotations)
+collection = lazy_collection('annotations')
+
+# Plotly trace keys stored in their own fields rather than in style
+TRACE_FIELDS = ('x', 'y', 'name', 'customdata')
+# customdata keys of the figure only: the annotation's _id, a mask's RLE (stored
+# in the mask field; only on traces that never reach a figure), the key of an
+# unsaved mask's RLE in the annotator session and the mask's overlay image URL
+FIGURE_CUSTOMDATA_KEYS = ('annotation_id', 'rle', 'mask_key', 'source')
+# keys plotly regenerates on every figure round-trip, neither stored nor compared
+TRANSIENT_KEYS = ('uid',)
+
+
+def label_of(name):
+    '''Label of a trace name ('label_1 -box' -> 'label_1').'''
+    return re.sub(r' -(box|line|polygon|model|mask)$', '', name)
+
+
+def polygon_area(x, y):
+    '''Shoelace area of a closed polygon.'''
+    return 0.5*abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))
+
+
+def annotation_id(trace):
+    '''Id of the annotation a trace was loaded from or saved as (None if never saved).'''
+    return (trace.get('customdata') or [{}])[0].get('annotation_id')
+
+
+def set_annotation_id(trace, id_):
+    customdata = list(trace.get('customdata') or [{}])
+    customdata[0] = dict(customdata[0], annotation_id=str(id_))
+    trace['customdata'] = customdata
+
+
+def fingerprint(trace):
+    '''Digest of a trace, compared at save time to find the changed annotations.'''
+    trace = {key: value for key, value in trace.items() if key not in TRANSIENT_KEYS}
+    return hashlib.md5(json.dumps(trace, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def trace_to_doc(image_id, trace, rle=None):
+    '''Annotation document of a Plotly trace dict (rle: a mask's RLE if not in its customdata).'''
+    trace_customdata = (trace.get('customdata') or [{}])[0]
+    customdata = {
+        key: value for key, value in trace_customdata.items()
+        if key not in FIGURE_CUSTOMDATA_KEYS
+    }
+    shape_type = customdata.get('shape_type', '')
+    x = np.asarray(trace['x'], dtype=float)
+    y = np.asarray(trace['y'], dtype=float)
+    if np.isfinite(x).any():
+        bbox = [float(np.nanmin(x)), float(np.nanmin(y)), float(np.nanmax(x)), float(np.nanmax(y))]
+    else:
+        bbox = None
+    if shape_type in ('box', 'polygon') and len(x) > 2:
+        area = float(polygon_area(x, y))
+    else:
+        area = 0.0
+    doc = {
+        'image_id': ObjectId(image_id),
+        'name': trace['name'],
+        'label': label_of(trace['name']),
+        'shape_type': shape_type,
+        'source': customdata.get('mlflow_run_id', 'manual'),
+        'bbox': bbox,
+        'area': area,
+        'geometry': geometry.encode_points(x, y),
+        'customdata': [customdata],
+        'style': {
+            key: value for key, value in trace.items()
+            if key not in TRACE_FIELDS + TRANSIENT_KEYS
+        },
+        'created': datetime.datetime.utcnow()
+    }
+    if shape_type == 'mask':
+        rle = rle or trace_customdata.get('rle')
+        if rle is None:
+            # a stored mask whose trace only changed style: keep its mask, bbox and area
+            del doc['bbox'], doc['area']
+        else:
+            doc['mask'] = masks.rle_to_doc(rle)
+            doc['bbox'] = masks.rle_bbox(rle)
+            doc['area'] = float(masks.rle_area(rle))
+    return doc
+
+
+def doc_to_trace(doc):
+    '''Plotly trace dict of an annotation document (coordinates are decoded here only).'''
+    x, y = geometry.decode_points(doc['geometry'])
+    trace = dict(doc['style'])
+    trace['x'] = geometry.to_list(x)
+    trace['y'] = geometry.to_list(y)
+    trace['name'] = doc['name']
+    trace['customdata'] = doc['customdata']
+    set_annotation_id(trace, doc['_id'])
+    if doc['shape_type'] == 'mask':
+        trace['customdata'][0]['source'] = masks.mask_url(doc['_id'])
+    return trace
+
+
+def is_annotation(trace):
+    '''False for the invisible trace that spans the image axes.'''
+    return trace.get('name') != 'dummy'
+
+
+def load_traces(image_id):
+    '''Annotation traces of an image in the order they were saved.'''
+    search_request = {'image_id': ObjectId(image_id)}
+    log_plan('load_traces', collection, search_request, sort=[('_id', 1)])
+    # masks are drawn from their own URL (see apps/images.py)
+    cursor = collection.find(search_request, {'mask': 0}).sort('_id', 1)
+    return [doc_to_trace(doc) for doc in cursor]
+
+
+def save_traces(image_id, traces):
+    '''Replace the annotations of an image with the figure's traces.'''
+    image_id = ObjectId(image_id)
+    docs = [trace_to_doc(image_id, trace) for trace in traces if is_annotation(trace)]
+    collection.delete_many({'image_id': image_id})
+    if docs:
+        collection.insert_many(docs)
+    return len(docs)
+
+
+def annotation_version(metadata):
+    '''Number of annotation saves recorded in fs.files metadata (0 if never saved).'''
+    return (metadata or {}).get('annotation_version', 0)
+
+
+def save_changes(image_id, traces, saved, version, fields=None, mask_rles=None):
+    '''Write only the annotations that changed since they were loaded.
+
+    saved maps annotation ids to the fingerprints they had when loaded at
+    version (metadata.annotation_version of the image); mask_rles maps the
+    mask_key of unsaved mask traces to their RLE. If another save has
+    happened since, nothing is written and None is returned. Otherwise new
+    traces get an id in place (and new masks the URL of their stored
+    overlay), and (version, saved, counts) after the save is returned.
+
+    The annotations are written before the version is incremented (together
+    with fields) on the condition that it is still version, so a failed
+    write leaves the version, and other sessions, untouched; a save by
+    another session between the two is reported as a conflict (None), its
+    annotations and these then both being stored.
+    '''
+    image_id = ObjectId(image_id)
+    # a missing version field matches None
+    search_request = {'_id': image_id, 'metadata.annotation_version': version or None}
+    if db.fs.files.find_one(search_request, {'_id': 1}) is None:
+        return None
+
+    requests = []
+    current = {}
+    counts = {'added': 0, 'changed': 0, 'removed': 0}
+    now = datetime.datetime.utcnow()
+    for trace in traces:
+        if not is_annotation(trace):
+            continue
+        id_ = annotation_id(trace)
+        rle = (mask_rles or {}).get((trace.get('customdata') or [{}])[0].get('mask_key'))
+        if id_ is None:
+            id_ = str(ObjectId())
+            set_annotation_id(trace, id_)
+            doc = trace_to_doc(image_id, trace, rle)
+            doc['_id'] = ObjectId(id_)
+            requests.append(InsertOne(doc))
+            counts['added'] += 1
+            if doc['shape_type'] == 'mask':
+                # from now on drawn from the stored mask, like a mask loaded from the database
+                trace['customdata'][0].pop('mask_key', None)
+                trace['customdata'][0]['source'] = masks.mask_url(id_)
+        elif saved.get(id_) != fingerprint(trace):
+            doc = trace_to_doc(image_id, trace, rle)
+            del doc['created']
+            doc['modified'] = now
+            requests.append(UpdateOne({'_id': ObjectId(id_)}, {'$set': doc}, upsert=True))
+            counts['changed'] += 1
+        current[id_] = fingerprint(trace)
+    removed = [ObjectId(id_) for id_ in saved if id_ not in current]
+    if removed:
+        requests.append(DeleteMany({'_id': {'$in': removed}}))
+        counts['removed'] = len(removed)
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+
+    update = {'$inc': {'metadata.annotation_version': 1}}
+    if fields:
+        update['$set'] = fields
+    if db.fs.files.update_one(search_request, update).matched_count == 0:
+        return None
+    return version + 1, current, counts
+
+
+def insert_traces(image_traces):
+    '''Add annotations to several images: [(image_id, trace), ...] in one insert_many.'''
+    docs = [trace_to_doc(image_id, trace) for image_id, trace in image_traces]
+    if docs:
+        collection.insert_many(docs, ordered=False)
+
+
+def has_source(image_id, source):
+    '''True if the image has an annotation from this source (e.g. an MLflow run id).'''
+    search_request = {'image_id': ObjectId(image_id), 'source': source}
+    log_plan('has_source', collection, search_request, {'_id': 1}, limit=1)
+    return collection.find_one(search_request, {'_id': 1}) is not None
+
+
+def reassign(image_ids, to_image_id):
+    '''Move the annotations of images to another image, dropping those it already has.'''
+    to_image_id = ObjectId(to_image_id)
+    projection = {'name': 1, 'geometry': 1}
+
+    def key(doc):
+        x, y = geometry.decode_points(doc['geometry'])
+        return doc['name'], x.tobytes(), y.tobytes()
+
+    existing = {key(doc) for doc in collection.find({'image_id': to_image_id}, projection)}
+    moved, dropped = [], []
+    for doc in collection.find({'image_id': {'$in': list(image_ids)}}, projection).sort('_id', 1):
+        if key(doc) in existing:
+            dropped.append(doc['_id'])
+        else:
+            existing.add(key(doc))
+            moved.append(doc['_id'])
+    if moved:
+        collection.update_many({'_id': {'$in': moved}}, {'$set': {'image_id': to_image_id}})
+    if dropped:
+        collection.delete_many({'_id': {'$in': dropped}})
+    return len(moved)
+
+
+def image_ids_with_name(pattern, image_ids):
+    '''Set of the image_ids with an annotation name matching a regex.'''
+    search_request = {'image_id': {'$in': list(image_ids)}, 'name': pattern}
+    log_plan('image_ids_with_name', collection, search_request, {'_id': 0, 'image_id': 1})
+    return set(collection.distinct('image_id', search_request))
+
+
+def migrate(batch_size=100):
+    '''Move annotations embedded in fs.files metadata.dash_img_annotation to the collection.
+
+    Each image's embedded annotations replace what the collection holds for
+    it before they are unset, so an interrupted migration can be re-run.
+    '''
+    ensure_indexes(['annotations'])
+    count = 0
+    search_request = {'metadata.dash_img_annotation': {'$exists': True}}
+    projection = {'metadata.dash_img_annotation': 1}
+    while True:
+        docs = list(db.fs.files.find(search_request, projection).limit(batch_size))
+        if not docs:
+            return count
+        for doc in docs:
+            count = count + save_traces(doc['_id'], doc['metadata']['dash_img_annotation'])
+        db.fs.files.update_many(
+            {'_id': {'$in': [doc['_id'] for doc in docs]}},
+            {'$unset': {'metadata.dash_img_annotation': ''}}
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Annotation collection jobs.')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_migrate = subparsers.add_parser(
+        'migrate', help='move annotations from fs.files metadata to the annotations collection'
+    )
+    parser_migrate.add_argument('--batch-size', type=int, default=100, help='images per batch')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        print(f'migrated {migrate(args.batch_size)} annotations')
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,24 +2,20 @@
 # -*- coding: utf-8 -*-
 
 import re
+import copy
+import itertools
+import uuid
 import base64
 import datetime
-import urllib.parse
 from io import BytesIO, StringIO
 import pandas as pd
 import numpy as np
-from PIL import Image as PImage
 from nested_lookup import nested_lookup
 
-from pymongo import MongoClient
 from bson.objectid import ObjectId
-import gridfs
-
-import mlflow.pyfunc
-import mlflow
 
 import dash
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_table
@@ -28,24 +24,46 @@ import plotly.graph_objs as go
 import visdcc
 
 from apps import config
+from apps.database import fs
+from apps import annotations, masks
+from apps.selection import iter_images, label_filter, page_key, LABEL_FILTER_BATCH
+from apps.metrics import instrument, phase
+from apps.images import image_cache, image_url
+from apps.prefetch import prefetcher
+from apps.imaging import file_size, image_size
+from apps.sessions import session_store, new_session_id
+from apps.models import model_cache, mlflow_client
+from apps.inference import prediction_trace
+from apps.simplify import simplify_points, simplify_trace, tolerance_for
+from apps.jobs import job_manager, FINISHED
 from app import app
 
 
-client = MongoClient(config.MONGODB_CONNECT_STRING)
-db = client[config.MONGODB_DATABASE]
-fs = gridfs.GridFS(db)
-
-
-if config.MLFLOW_URI is not None:
-    mlflow.tracking.set_tracking_uri(config.MLFLOW_URI)
-
-
 df_select_init = pd.DataFrame()
 df_select_init['filename'] = [[]] * 1
 df_select_init['_id'] = [[]] * 1
 df_select_init['content_type'] = [[]] * 1
 df_select_init['comments'] = [[]] * 1
 df_labels_init = pd.DataFrame(config.DEFAULT_LABELS)
+figure_init = {
+    'data': [{'x':[], 'y':[], 'type':'scattergl'}],
+    'layout':{
+        'xaxis':{
+            'visible': False,
+            'range': [0, config.IMG_DISPLAY_HEIGHT]
+        },
+        'yaxis':{
+            'visible': False,
+            'range': [0, config.IMG_DISPLAY_HEIGHT],
+            'scaleanchor': 'x'
+        },
+        'width': config.IMG_DISPLAY_HEIGHT,
+        'height': config.IMG_DISPLAY_HEIGHT,
+        'margin': {'l': 0, 'r': 0, 't': 0, 'b': 0},
+        'clickmode': 'event',
+        'legend': {'x': 0, 'y': 1, 'font': {'size': 22}},
+    }
+}
 
 
 layout = html.Div([
@@ -53,7 +71,20 @@ layout = html.Div([
         html.Div([
             dcc.Store(id='store-shapes'),
 
-            dcc.Store(id='polygon-data'),
+            # key of the figure/polygon state kept server-side in apps.sessions
+            dcc.Store(id='session-id', storage_type='session'),
+
+            # figure updates from the server and the update the graph shows
+            # (merged in the browser by assets/figure-delta.js)
+            dcc.Store(id='store-figure-delta'),
+            dcc.Store(id='store-figure-seq'),
+
+            # Select Images query and the (uploadDate, _id) key that starts each page
+            dcc.Store(id='store-query'),
+            dcc.Store(id='store-page-keys'),
+
+            # hidden images after the selected row, preloaded into the browser cache
+            html.Div(id='div-prefetch', style={'display': 'none'}),
 
             visdcc.Run_js(id='javascript-ctrl-click', run="$('#graph-image').Graph()"),
             visdcc.Run_js(id='javascript-ctrl-keyup', run="$('#graph-image').Graph()"),
@@ -133,12 +164,13 @@ layout = html.Div([
                     fill_width=True,
                     data=df_select_init.to_dict('records'),
                     editable=True,
-                    sort_action='native',
-                    sort_mode='multi',
+                    # rows come one page at a time in (uploadDate, _id) order, which a
+                    # browser-side sort of the page would misrepresent
+                    sort_action='none',
                     row_selectable='single',
                     row_deletable=False,
                     selected_rows=[],
-                    page_action='native',
+                    page_action='custom',
                     page_current=0,
                     page_size=10
                 )
@@ -214,7 +246,22 @@ layout = html.Div([
                 title='Batch Model',
                 n_clicks=0
             ),
+            html.Button(
+                children='Cancel Batch',
+                id='button-mlflow-cancel',
+                title='cancel the running batch model job',
+                n_clicks=0
+            ),
+            html.Button(
+                children='Resume Batch',
+                id='button-mlflow-resume',
+                title='resume the last batch model job',
+                n_clicks=0
+            ),
+            dcc.Store(id='store-job-id', storage_type='session'),
+            dcc.Interval(id='interval-job', interval=config.JOB_POLL_INTERVAL, disabled=True),
             html.Div(id='report-model', children=''),
+            html.Div(id='report-model-load', children=''),
 
             html.Br(),
 
@@ -273,25 +320,7 @@ layout = html.Div([
                         'resetScale2d'
                     ]
                 },
-                figure={
-                    'data': [{'x':[], 'y':[], 'type':'scattergl'}],
-                    'layout':{
-                        'xaxis':{
-                            'visible': False,
-                            'range': [0, config.IMG_DISPLAY_HEIGHT]
-                        },
-                        'yaxis':{
-                            'visible': False,
-                            'range': [0, config.IMG_DISPLAY_HEIGHT],
-                            'scaleanchor': 'x'
-                        },
-                        'width': config.IMG_DISPLAY_HEIGHT,
-                        'height': config.IMG_DISPLAY_HEIGHT,
-                        'margin': {'l': 0, 'r': 0, 't': 0, 'b': 0},
-                        'clickmode': 'event',
-                        'legend': {'x': 0, 'y': 1, 'font': {'size': 22}},
-                    }
-                }
+                figure=figure_init
             )
         ], className='three columns')
     ], className='rows'),
@@ -299,62 +328,88 @@ layout = html.Div([
 
 
 @app.callback(
-    [Output('datatable-filenames', 'data'),
-     Output('datatable-filenames', 'columns')],
+    [Output('store-query', 'data'),
+     Output('datatable-filenames', 'page_current')],
     [Input('button-download-meta', 'n_clicks')],
     [State('input-num-imgs', 'value'),
      State('input-annotation-labels', 'value'),
      State('output-data-upload', 'children')])
+@instrument
 def query_db(n_clicks, num_imgs, filter_label, csv_data):
-    '''Query mongodb database and fill datatable with filenames.'''
-    df_select = pd.DataFrame()
-    search_list = []
-    if n_clicks > 0:
-        if csv_data:
-            df_filenames = pd.DataFrame(nested_lookup('data', csv_data)[0])
-            filenames = df_filenames[df_filenames.columns[0]].tolist()
-            num_imgs = len(filenames)
-            search_list.append({"filename": {"$in": filenames}})
-
-        if filter_label:
-            if filter_label[0] == '!':
-                regx = {"$not":re.compile(filter_label[1:], re.IGNORECASE)}
-            else:
-                regx = re.compile(filter_label, re.IGNORECASE)
-            search_list.append({'metadata.dash_img_annotation.name': regx})
+    '''Record the query of the filenames datatable and go back to its first page.'''
+    if not n_clicks:
+        return dash.no_update, dash.no_update
+    filenames = None
+    if csv_data:
+        df_filenames = pd.DataFrame(nested_lookup('data', csv_data)[0])
+        filenames = df_filenames[df_filenames.columns[0]].tolist()
+        num_imgs = len(filenames)
+    query = {
+        'n_clicks': n_clicks,
+        'num_imgs': num_imgs,
+        'filenames': filenames,
+        'filter_label': filter_label
+    }
+    return query, 0
 
-        if csv_data or filter_label:
-            search_request = {'$and': search_list}
-            result = fs.find(search_request).sort('uploadDate', -1).limit(num_imgs)
-        else:
-            result = fs.find().sort('uploadDate', -1).limit(num_imgs)
-
-        filename = []
-        id_ = []
-        content_type = []
-        comments = []
-        for item in result:
-            filename.append(item.filename)
-            id_.append(str(item._id))
-            content_type.append(item.content_type)
-            comments.append(item.metadata['comments'])
-
-        df_select['filename'] = filename
-        df_select['content-type'] = content_type
-        df_select['comments'] = comments
-        df_select['_id'] = id_
-    else:
+
+@app.callback(
+    [Output('datatable-filenames', 'data'),
+     Output('datatable-filenames', 'columns'),
+     Output('datatable-filenames', 'selected_rows'),
+     Output('store-page-keys', 'data')],
+    [Input('store-query', 'data'),
+     Input('datatable-filenames', 'page_current')],
+    [State('datatable-filenames', 'page_size'),
+     State('store-page-keys', 'data')])
+@instrument
+def page_filenames(query, page_current, page_size, page_keys):
+    '''Fill datatable with one page of filenames.
+
+    Each page is read by indexed queries starting after the last (uploadDate, _id)
+    of the previous page, whose key is kept in store-page-keys (see apps/selection.py).
+    '''
+    df_select = pd.DataFrame()
+    if not query:
         df_select['filename'] = [[]] * 1
         df_select['content_type'] = [[]] * 1
         df_select['comments'] = [[]] * 1
         df_select['_id'] = [[]] * 1
-
-    return df_select.to_dict('records'), [{'name': i, 'id': i} for i in df_select.columns[0:-1]]
+        columns = [{'name': i, 'id': i} for i in df_select.columns[0:-1]]
+        return df_select.to_dict('records'), columns, [], dash.no_update
+
+    if (page_keys is None) or (page_keys['n_clicks'] != query['n_clicks']):
+        page_keys = {'n_clicks': query['n_clicks'], 'keys': {}}
+    page_current = page_current or 0
+    num_rows = page_size
+    if query['num_imgs']:
+        num_rows = min(page_size, query['num_imgs'] - page_current*page_size)
+
+    docs = []
+    if num_rows > 0:
+        key = page_keys['keys'].get(str(page_current))
+        # a page reached without passing through the previous one is skipped to
+        skip = page_current*page_size if (key is None) and (page_current > 0) else 0
+        # without a label filter a single batch holds the page
+        batch_size = LABEL_FILTER_BATCH if label_filter(query) else skip + num_rows
+        images = iter_images(query, after=key, batch_size=batch_size)
+        with phase('query'):
+            docs = list(itertools.islice(images, skip, skip + num_rows))
+    if docs:
+        page_keys['keys'][str(page_current + 1)] = page_key(docs[-1])
+
+    df_select['filename'] = [doc['filename'] for doc in docs]
+    df_select['content-type'] = [doc.get('contentType') for doc in docs]
+    df_select['comments'] = [(doc.get('metadata') or {}).get('comments') for doc in docs]
+    df_select['_id'] = [str(doc['_id']) for doc in docs]
+    columns = [{'name': i, 'id': i} for i in df_select.columns[0:-1]]
+    return df_select.to_dict('records'), columns, [], page_keys
 
 
 @app.callback(
     Output('datatable-filenames', 'style_data_conditional'),
     [Input('datatable-filenames', 'selected_rows')])
+@instrument
 def highlight_rows_filenames(row_index):
     '''Filenames-datatable row is highlighted on user selection.'''
     if row_index:
@@ -369,9 +424,38 @@ def highlight_rows_filenames(row_index):
     }]
 
 
+@app.callback(
+    Output('div-prefetch', 'children'),
+    [Input('datatable-filenames', 'selected_rows')],
+    [State('datatable-filenames', 'data'),
+     State('datatable-filenames', 'derived_virtual_data'),
+     State('datatable-filenames', 'derived_virtual_indices'),
+     State('session-id', 'data')])
+@instrument
+def prefetch_images(row_index, file_data, virtual_data, virtual_indices, session_id):
+    '''Preload the images of the rows displayed after the selected one.
+
+    Images resized on the server are loaded into its image cache, the others
+    get browser preload hints. Runs next to display_update_image, so the
+    selected image is not delayed.
+    '''
+    image_ids = []
+    if row_index and file_data:
+        # selected_rows index data; the rows below it are in the table's virtual order
+        if virtual_data and virtual_indices and (row_index[0] in virtual_indices):
+            rows, position = virtual_data, virtual_indices.index(row_index[0])
+        else:
+            rows, position = file_data, row_index[0]
+        rows = rows[position + 1:position + 1 + config.PREFETCH_ROWS]
+        image_ids = [row['_id'] for row in rows if row.get('_id')]
+    browser_ids = prefetcher.prefetch(session_id, image_ids)
+    return [html.Img(src=image_url(image_id, 'display')) for image_id in browser_ids]
+
+
 @app.callback(
     Output('datatable-labels', 'style_data_conditional'),
     [Input('datatable-labels', 'selected_rows')])
+@instrument
 def highlight_rows_labels(row_index):
     '''Labels-datatable row is highlighted on user selection.'''
     return [{
@@ -381,10 +465,153 @@ def highlight_rows_labels(row_index):
     }]
 
 
+def get_session_state(session_id):
+    '''Figure/polygon state of an annotator session (a fresh one if unknown).'''
+    state = None
+    if session_id is not None:
+        state = session_store.get(session_id)
+    if state is None:
+        state = {
+            'image_id': None,
+            'figure': copy.deepcopy(figure_init),
+            'polygon': None,
+            'version': 0,
+            'saved': {},
+            'figure_seq': 0,
+            'figure_prints': []
+        }
+    return state
+
+
+def saved_fingerprints(data):
+    '''{annotation id: fingerprint} of the figure traces that are saved annotations.'''
+    return {
+        annotations.annotation_id(trace): annotations.fingerprint(trace)
+        for trace in data if annotations.annotation_id(trace) is not None
+    }
+
+
+def set_session_state(session_id, state):
+    if session_id is not None:
+        session_store.set(session_id, state)
+
+
+def figure_delta(state, figure, client_seq, restyle_data=None):
+    '''Update of the browser's figure (at client_seq) to the session's figure.
+
+    Traces the browser already has are sent as their index in its figure and
+    a legend event as the restyle it has already drawn, so only new and
+    changed traces go over the wire. A browser that does not show the
+    session's last figure (reloaded, or a response it dropped) gets all of it.
+    '''
+    prints = [annotations.fingerprint(trace) for trace in figure['data']]
+    seq = state.get('figure_seq', 0)
+    delta = {'seq': seq + 1, 'after': None, 'layout': figure['layout']}
+    if client_seq != seq:
+        delta['data'] = figure['data']
+    elif restyle_data is not None:
+        delta['after'] = seq
+        delta['restyle'] = restyle_data
+    else:
+        positions = {}
+        for index, print_ in enumerate(state.get('figure_prints') or []):
+            positions.setdefault(print_, []).append(index)
+        delta['after'] = seq
+        delta['data'] = [
+            positions[print_].pop(0) if positions.get(print_) else trace
+            for trace, print_ in zip(figure['data'], prints)
+        ]
+    state['figure_seq'] = seq + 1
+    state['figure_prints'] = prints
+    return delta
+
+
+def is_mask(trace):
+    return (trace.get('customdata') or [{}])[0].get('shape_type') == 'mask'
+
+
+def keep_mask_in_session(trace, state, session_id):
+    '''Move the RLE of a new mask trace into the session state, out of the figure.
+
+    Until it is saved, its overlay is rendered from there by the
+    /masks/preview route (see apps/images.py).
+    '''
+    customdata = trace['customdata'][0]
+    key = uuid.uuid4().hex
+    state.setdefault('masks', {})[key] = {
+        'rle': customdata.pop('rle'),
+        'color': trace['marker']['color']
+    }
+    customdata['mask_key'] = key
+    customdata['source'] = masks.preview_url(session_id, key)
+    return trace
+
+
+def mask_images(images, data, img_width, img_height):
+    '''Layout images: the image itself plus an overlay for each visible mask trace.'''
+    images = [image for image in images if image.get('name') != 'mask']
+    for trace in data:
+        if is_mask(trace) and (trace.get('visible', True) is True):
+            images.append({
+                'name': 'mask',
+                'source': trace['customdata'][0]['source'],
+                'x': 0,
+                'sizex': img_width,
+                'y': img_height,
+                'sizey': img_height,
+                'xref': 'x',
+                'yref': 'y',
+                'opacity': 1.0,
+                'layer': 'above',
+                'sizing': 'stretch'
+            })
+    return images
+
+
+def apply_restyle(data, restyle_data):
+    '''Apply a plotly restyle event ([{attr: values}, [trace indices]]) to figure data.'''
+    update, indices = restyle_data
+    for index_pos, index in enumerate(indices):
+        if index >= len(data):
+            continue
+        for key, value in update.items():
+            if isinstance(value, list):
+                value = value[index_pos % len(value)]
+            *parents, attr = key.split('.')
+            item = data[index]
+            for parent in parents:
+                item = item.setdefault(parent, {})
+            item[attr] = value
+
+
 @app.callback(
-    [Output('graph-image', 'figure'),
-     Output('booleanswitch-edit-output', 'children'),
-     Output('polygon-data', 'data')],
+    Output('session-id', 'data'),
+    [Input('session-id', 'modified_timestamp')],
+    [State('session-id', 'data')])
+@instrument
+def init_session(timestamp, session_id):
+    '''Assign this browser tab an id for its server-side annotator state.'''
+    if session_id is None:
+        return new_session_id()
+    return dash.no_update
+
+
+app.clientside_callback(
+    ClientsideFunction('annotator', 'applyFigureDelta'),
+    Output('graph-image', 'figure'),
+    [Input('store-figure-delta', 'data')],
+    [State('graph-image', 'figure')])
+
+
+app.clientside_callback(
+    ClientsideFunction('annotator', 'figureSeq'),
+    Output('store-figure-seq', 'data'),
+    [Input('graph-image', 'figure')])
+
+
+@app.callback(
+    [Output('store-figure-delta', 'data'),
+     Output('booleanswitch-edit-output', 'children')],
     [Input('datatable-filenames', 'selected_rows'),
      Input('graph-image', 'selectedData'),
      Input('datatable-labels', 'selected_rows'),
@@ -394,16 +621,18 @@ def highlight_rows_labels(row_index):
      Input('javascript-ctrl-click', 'event'),
      Input('javascript-ctrl-keyup', 'event'),
      Input('button-mlflow-single', 'n_clicks'),
-     Input('button-remove-traces', 'n_clicks')],
+     Input('button-remove-traces', 'n_clicks'),
+     Input('graph-image', 'restyleData')],
     [State('dropdown-select-run', 'value'),
      State('datatable-filenames', 'data'),
      State('datatable-labels', 'data'),
      State('daq-booleanswitch-edit', 'on'),
      State('daq-booleanswitch-lasso', 'on'),
      State('store-shapes', 'data'),
-     State('polygon-data', 'data'),
      State('input-annotation-labels', 'value'),
-     State('graph-image', 'figure')])
+     State('session-id', 'data'),
+     State('store-figure-seq', 'data')])
+@instrument
 def display_update_image(
         filename_row_index,
         selectedData,
@@ -415,30 +644,59 @@ def display_update_image(
         js_ctrlkeyup_evt,
         mlflow_nclicks,
         remove_traces_nclicks,
+        restyle_data,
         dropdwn_run_id,
         file_data,
         label_data,
         edit_boxes,
         lasso_open,
         shape_data,
-        polygon_data,
         filter_label,
-        fig
+        session_id,
+        figure_seq
 ):
-    '''Display and update image w/ annotations.'''
+    '''Display and update image w/ annotations.
+
+    The figure lives in the server-side session store; the browser only sends
+    the triggering event and receives the changes to its figure (see
+    figure_delta).
+    '''
+    with phase('session_load'):
+        state = get_session_state(session_id)
+    fig = state['figure']
     data = fig['data']
     layout_ = fig['layout']
     ctx = dash.callback_context
     trig_id = ctx.triggered[0]['prop_id']
 
+    if trig_id == 'graph-image.restyleData':
+        # legend clicks and legend renames are already drawn by the browser
+        if restyle_data:
+            apply_restyle(data, restyle_data)
+            update, indices = restyle_data
+            if ('visible' in update) and any(is_mask(data[index]) for index in indices if index < len(data)):
+                # mask overlays are layout images, which legend clicks do not hide
+                fig['layout']['images'] = mask_images(
+                    fig['layout'].get('images', []), data, *state['image_size']
+                )
+            with phase('figure_delta'):
+                delta = figure_delta(state, fig, figure_seq, restyle_data)
+            set_session_state(session_id, state)
+            return delta, dash.no_update
+        return dash.no_update, dash.no_update
+
     if trig_id == 'datatable-filenames.selected_rows':
         if filename_row_index:
             df_select = pd.DataFrame(file_data)
             id_ = df_select.loc[filename_row_index[0], '_id']
-            out = fs.find_one({'_id':ObjectId(id_)})
-            img = PImage.open(BytesIO(out.read()))
-            img_width, img_height = img.size
+            with phase('gridfs_read'):
+                out = fs.find_one({'_id':ObjectId(id_)})
+                img_width, img_height = file_size(out)
             scale_factor = (config.IMG_DISPLAY_HEIGHT)/img_height
+            state['image_id'] = id_
+            state['image_size'] = [img_width, img_height]
+            state['masks'] = {}
+            state['version'] = annotations.annotation_version(out.metadata)
             data = [{
                 'x': [0, img_width],
                 'y': [0, img_height],
@@ -450,16 +708,15 @@ def display_update_image(
                 'type':'scattergl'
             }]
 
-            if type(out.metadata) == dict:
-                if 'dash_img_annotation' in out.metadata.keys():
-                    data_list = out.metadata['dash_img_annotation']
-                    if filter_label:
-                        for index, data_item in enumerate(data_list):
-                            if re.search(filter_label, data_item['name'], re.IGNORECASE):
-                                data_list[index]['visible'] = True
-                            else:
-                                data_list[index]['visible'] = 'legendonly'
-                    data = data + data_list
+            with phase('annotations_load'):
+                data_list = annotations.load_traces(id_)
+            if filter_label:
+                for index, data_item in enumerate(data_list):
+                    if re.search(filter_label, data_item['name'], re.IGNORECASE):
+                        data_list[index]['visible'] = True
+                    else:
+                        data_list[index]['visible'] = 'legendonly'
+            data = data + data_list
 
             images = [go.layout.Image(
                 x=0,
@@ -471,7 +728,7 @@ def display_update_image(
                 opacity=1.0,
                 layer='below',
                 sizing='stretch',
-                source=img
+                source=image_url(id_, 'display')
             )]
             layout_['images'] = images
             layout_['width'] = img_width*scale_factor
@@ -512,6 +769,7 @@ def display_update_image(
                 name = labelname + ' -polygon'
                 shape_type = 'polygon'
             showlegend = True
+            x, y = simplify_points(x, y, shape_type, tolerance_for(name))
 
         for trace_dict in fig['data']:
             if 'selectedpoints' in trace_dict:
@@ -639,7 +897,7 @@ def display_update_image(
             'line': {'color': labelcolor},
             'type': 'scattergl'
         }]
-        if ctx.states['polygon-data.data'] is None:
+        if state['polygon'] is None:
             if lasso_open:
                 data = fig['data'] + data_store
             else:
@@ -648,15 +906,15 @@ def display_update_image(
                 data = fig['data'] + data_store
         else:
             if lasso_open:
-                data_store[0]['x'] = ctx.states['polygon-data.data'][0]['x'] \
+                data_store[0]['x'] = state['polygon'][0]['x'] \
                     + data_store[0]['x']
-                data_store[0]['y'] = ctx.states['polygon-data.data'][0]['y'] \
+                data_store[0]['y'] = state['polygon'][0]['y'] \
                     + data_store[0]['y']
             else:
-                data_store[0]['x'] = ctx.states['polygon-data.data'][0]['x'][:-1] \
-                    + data_store[0]['x'] + [ctx.states['polygon-data.data'][0]['x'][0]]
-                data_store[0]['y'] = ctx.states['polygon-data.data'][0]['y'][:-1] \
-                    + data_store[0]['y'] + [ctx.states['polygon-data.data'][0]['y'][0]]
+                data_store[0]['x'] = state['polygon'][0]['x'][:-1] \
+                    + data_store[0]['x'] + [state['polygon'][0]['x'][0]]
+                data_store[0]['y'] = state['polygon'][0]['y'][:-1] \
+                    + data_store[0]['y'] + [state['polygon'][0]['y'][0]]
 
             data = fig['data'][:-1] + data_store
 
@@ -666,47 +924,25 @@ def display_update_image(
     if trig_id == 'button-mlflow-single.n_clicks':
         # Load the model in 'python_function' format
         if mlflow_nclicks > 0:
-            artifacts = mlflow.tracking.MlflowClient().list_artifacts(run_id=dropdwn_run_id)
-            path = [artifact.path for artifact in artifacts if 'pyfunc' in artifact.path][0]
+            with phase('model_load'):
+                loaded = model_cache.get(dropdwn_run_id)
             df_select = pd.DataFrame(file_data)
-            loaded_model = mlflow.pyfunc.load_model(
-                model_uri=f'runs:/{dropdwn_run_id}/{path}'
-            )
             # Evaluate the model
-            filename = df_select.loc[filename_row_index[0], 'filename']
-            up = urllib.parse.urlparse(layout_['images'][0]['source'])
-            img_head, img_data = up.path.split(',', 1)
-            img = PImage.open(BytesIO(base64.b64decode(img_data)))
-            img_width, img_height = img.size
-            df_img = pd.DataFrame(
-                data=[base64.encodebytes(base64.b64decode(img_data))],
-                columns=['image']
-            )
-            predictions = loaded_model.predict(df_img)
+            id_ = df_select.loc[filename_row_index[0], '_id']
+            with phase('image_read'):
+                img_width, img_height = image_size(id_)
+                cached = image_cache.get(id_)
+            df_img = pd.DataFrame(data=[base64.encodebytes(cached.data)], columns=['image'])
+            with phase('model_predict'):
+                predictions = loaded.model.predict(df_img)
             # predictions_sampled = predictions[::10]
             df_labels = pd.DataFrame(label_data)
             labelcolor = df_labels.loc[label_row_index[0], 'colors']
-            run_dict = mlflow.tracking.MlflowClient().get_run(run_id=dropdwn_run_id).to_dictionary()
-            name = run_dict['data']['tags']['mlflow.runName'] + ' -model'
-            shape_type = 'model'
-            model_trace = go.Scattergl(
-                x=predictions['x'],
-                y=img_height-predictions['y'],
-                mode='markers',
-                marker={'opacity': 1, 'color': labelcolor},
-                showlegend=True,
-                name=name,
-                customdata=[
-                    {
-                        'shape_type': shape_type,
-                        'mlflow_path': path,
-                        'mlflow_run_id': dropdwn_run_id
-                    }
-                ],
-                hoverinfo='name',
-                visible=True
-            )
-            data = fig['data'] + [model_trace]
+            with phase('prediction_trace'):
+                trace = prediction_trace(predictions, img_width, img_height, labelcolor, loaded)
+                if is_mask(trace):
+                    trace = keep_mask_in_session(trace, state, session_id)
+                data = fig['data'] + [trace]
 
     if (trig_id == 'button-remove-traces.n_clicks') and (remove_traces_nclicks > 0):
         data = fig['data']
@@ -719,12 +955,29 @@ def display_update_image(
                 indices = indices + [index]
         data = np.delete(data, indices).tolist()
 
-    return go.Figure(data, layout_), f'Edit boxes {edit_boxes}', data_store
+    with phase('figure'):
+        figure = go.Figure(data, layout_).to_dict()
+    if state.get('image_size'):
+        with phase('mask_images'):
+            figure['layout']['images'] = mask_images(
+                figure['layout'].get('images', []), figure['data'], *state['image_size']
+            )
+    state['figure'] = figure
+    state['polygon'] = data_store
+    if (trig_id == 'datatable-filenames.selected_rows') and filename_row_index:
+        # annotations as loaded, to find the changed ones on save
+        state['saved'] = saved_fingerprints(figure['data'])
+    with phase('figure_delta'):
+        delta = figure_delta(state, figure, figure_seq)
+    with phase('session_save'):
+        set_session_state(session_id, state)
+    return delta, f'Edit boxes {edit_boxes}'
 
 
 @app.callback(
     Output('booleanswitch-lasso-output', 'children'),
     [Input('daq-booleanswitch-lasso', 'on')])
+@instrument
 def lasso_boolen_switch(on):
     '''Reports if user selected closed/open lasso (closed lasso connects 1st, last pts).'''
     if on:
@@ -738,6 +991,7 @@ def lasso_boolen_switch(on):
     Output('store-shapes', 'data'),
     [Input('graph-image', 'relayoutData')],
     [State('store-shapes', 'data')])
+@instrument
 def store_shapes(relayoutData, stored_data):
     '''Temporary storage of user annotions in the browser.'''
     if stored_data is None:
@@ -755,6 +1009,7 @@ def store_shapes(relayoutData, stored_data):
     [Output('javascript-ctrl-keyup', 'run'),
      Output('javascript-ctrl-click', 'run')],
     [Input('button-lasso-polygon', 'n_clicks')])
+@instrument
 def javascript_event_listeners(n_clicks):
     '''Javascript event listeners for Ctrl+MouseClick and Ctrl+Keyup.'''
     if n_clicks < 1: return '', ''
@@ -799,6 +1054,7 @@ def javascript_event_listeners(n_clicks):
      Input('button-rect', 'n_clicks'),
      Input('datatable-labels', 'selected_rows')],
     [State('datatable-labels', 'data')])
+@instrument
 def drag_color(n_clicks_lasso, n_clicks_rect, label_row_index, label_data):
     '''Javascript to maintain label color while drawing box and lasso.'''
     df_labels = pd.DataFrame(label_data)
@@ -848,6 +1104,7 @@ def parse_contents(contents, filename, date):
               [Input('upload-data', 'contents')],
               [State('upload-data', 'filename'),
                State('upload-data', 'last_modified')])
+@instrument
 def update_output(list_of_contents, list_of_names, list_of_dates):
     if list_of_contents is not None:
         children = [
@@ -858,84 +1115,69 @@ def update_output(list_of_contents, list_of_names, list_of_dates):
 
 
 @app.callback(
-    Output('report-model', 'children'),
-    [Input('button-mlflow-batch', 'n_clicks')],
-    [State('datatable-filenames', 'data'),
+    Output('store-job-id', 'data'),
+    [Input('button-mlflow-batch', 'n_clicks'),
+     Input('button-mlflow-cancel', 'n_clicks'),
+     Input('button-mlflow-resume', 'n_clicks')],
+    [State('store-query', 'data'),
      State('datatable-labels', 'data'),
      State('datatable-labels', 'selected_rows'),
-     State('dropdown-select-run', 'value')])
-def mlflow_batch(n_clicks, file_data, label_data, label_row_index, dropdwn_run_id):
-    '''Apply MLflow model to all files in datatable.'''
-    if (n_clicks > 0) and (config.MLFLOW_URI is not None):
-        df_select = pd.DataFrame(file_data)
-        artifacts = mlflow.tracking.MlflowClient().list_artifacts(run_id=dropdwn_run_id)
-        path = [artifact.path for artifact in artifacts if 'pyfunc' in artifact.path][0]
+     State('dropdown-select-run', 'value'),
+     State('store-job-id', 'data')])
+@instrument
+def mlflow_batch(n_clicks, cancel_nclicks, resume_nclicks, query, label_data,
+                 label_row_index, dropdwn_run_id, job_id):
+    '''Start, cancel or resume a background job applying an MLflow model to all files of the datatable query.'''
+    trig_id = dash.callback_context.triggered[0]['prop_id']
+    if (trig_id == 'button-mlflow-batch.n_clicks') and (n_clicks > 0) \
+            and (config.MLFLOW_URI is not None) and query:
         df_labels = pd.DataFrame(label_data)
         labelcolor = df_labels.loc[label_row_index[0], 'colors']
-        for index, row in df_select.iterrows():
-            # Evaluate the model
-            filename = row['filename']
-            result = fs.get_last_version(filename)
-            result_id = result._id
-            # check if metadata model annotation already exists
-            search_request = {
-                '$and':
-                    [
-                        {'_id': result_id},
-                        {'metadata.dash_img_annotation.customdata.mlflow_run_id': dropdwn_run_id}
-                    ]
-            }
-            if not fs.exists(search_request):
-                result_read = result.read()
-                img = PImage.open(BytesIO(result_read))
-                img_width, img_height = img.size
-                df_img = pd.DataFrame(data=[base64.encodebytes(result_read)], columns=['image'])
-                loaded_model = mlflow.pyfunc.load_model(
-                    model_uri=f'runs:/{dropdwn_run_id}/{path}'
-                )
-                predictions = loaded_model.predict(df_img)
-                run_dict = mlflow.tracking.MlflowClient().get_run(
-                    run_id=dropdwn_run_id).to_dictionary()
-                name = run_dict['data']['tags']['mlflow.runName'] + ' -model'
-                shape_type = 'model'
-                model_trace = {
-                    'x': predictions['x'].tolist(),
-                    'y': (img_height-predictions['y']).tolist(),
-                    'mode': 'markers',
-                    'marker': {'opacity': 1, 'color': labelcolor},
-                    'showlegend': True,
-                    'name': name,
-                    'customdata': [
-                        {
-                            'shape_type': shape_type,
-                            'mlflow_path': path,
-                            'mlflow_run_id': dropdwn_run_id
-                        }
-                    ],
-                    'hoverinfo': 'name',
-                    'visible': True,
-                    'type': 'scattergl'
-                }
-
-                if 'dash_img_annotation' in result.metadata:
-                    data = result.metadata['dash_img_annotation'] + [model_trace]
-                else:
-                    data = [model_trace]
-
-                db.fs.files.update_one(
-                    {'_id': result_id}, {'$set': {'metadata.dash_img_annotation': data}}
-                )
-        return 'batch model completed'
-    return ''
+        return str(job_manager.submit(dropdwn_run_id, query, labelcolor))
+    if job_id is not None:
+        if (trig_id == 'button-mlflow-cancel.n_clicks') and (cancel_nclicks > 0):
+            job_manager.cancel(job_id)
+        elif (trig_id == 'button-mlflow-resume.n_clicks') and (resume_nclicks > 0):
+            job_manager.resume(job_id)
+        return job_id
+    return dash.no_update
+
+
+@app.callback(
+    [Output('report-model', 'children'),
+     Output('interval-job', 'disabled')],
+    [Input('interval-job', 'n_intervals'),
+     Input('store-job-id', 'data')])
+@instrument
+def batch_progress(n_intervals, job_id):
+    '''Report the progress of the batch model job; polling stops once it has finished.'''
+    if job_id is None:
+        return '', True
+    job = job_manager.status(job_id)
+    if job is None:
+        return '', True
+    counts = job['counts']
+    finished = sum(counts.values())
+    # the total of a label-filtered query is known once the job has listed its images
+    total = '?' if job.get('total') is None else job['total']
+    report = (
+        f"batch model {job['status']}: {finished}/{total} images - "
+        f"{counts.get('done', 0)} annotated, {counts.get('skipped', 0)} already annotated, "
+        f"{counts.get('failed', 0)} failed"
+    )
+    if job.get('error'):
+        report = report + f" ({job['error']})"
+    return report, job['status'] in FINISHED
 
 
 @app.callback(
     Output('dropdown-select-exp', 'options'),
     [Input('button-mlflow-connect', 'n_clicks')])
+@instrument
 def mflow_connect(n_clicks):
     '''Display list of MLflow experiments in datatable.'''
     if (n_clicks > 0) and (config.MLFLOW_URI is not None):
-        mlflow_experiments = mlflow.tracking.MlflowClient().list_experiments()
+        mlflow_experiments = mlflow_client().list_experiments()
         return [{'label': ex.name, 'value': ex.name} for ex in mlflow_experiments]
     return []
 
@@ -944,15 +1186,18 @@ def mflow_connect(n_clicks):
     [Output('dropdown-select-run', 'options'),
      Output('dropdown-select-run', 'value')],
     [Input('dropdown-select-exp', 'value')],
-    [State('graph-image', 'figure')])
-def dropdwn_exp(exp_name, fig):
+    [State('session-id', 'data')])
+@instrument
+def dropdwn_exp(exp_name, session_id):
     '''MLflow experiments drop-down menu.'''
+    fig = get_session_state(session_id)['figure']
     if (exp_name is not None) and ('images' in list(fig['layout'].keys())):
-        exp = mlflow.tracking.MlflowClient().get_experiment_by_name(name=exp_name)
-        runs = mlflow.tracking.MlflowClient().list_run_infos(experiment_id=exp.experiment_id)
+        client = mlflow_client()
+        exp = client.get_experiment_by_name(name=exp_name)
+        runs = client.list_run_infos(experiment_id=exp.experiment_id)
         mlflow_run_opts = []
         for run in runs:
-            tags = mlflow.tracking.MlflowClient().get_run(run.run_uuid).data.tags
+            tags = client.get_run(run.run_uuid).data.tags
             mlflow_run_opts = mlflow_run_opts + [
                 {'label': tags['mlflow.runName'], 'value': run.run_uuid}
             ]
@@ -960,13 +1205,26 @@ def dropdwn_exp(exp_name, fig):
     return [], 'None'
 
 
+@app.callback(
+    Output('report-model-load', 'children'),
+    [Input('dropdown-select-run', 'value')])
+@instrument
+def warm_up_model(run_id):
+    '''Start loading the selected run's model before a model button is clicked.'''
+    if (config.MLFLOW_URI is not None) and (run_id not in (None, 'None')):
+        model_cache.warm_up(run_id)
+        return 'loading model in the background'
+    return ''
+
+
 @app.callback(
     Output('report-save', 'children'),
     [Input('button-save', 'n_clicks')],
     [State('datatable-filenames', 'data'),
      State('datatable-filenames', 'selected_rows'),
-     State('graph-image', 'figure')])
-def save_metadata(n_clicks, file_data, filename_row_index, fig):
+     State('session-id', 'data')])
+@instrument
+def save_metadata(n_clicks, file_data, filename_row_index, session_id):
     '''Save annotation metadata to MongoDB.'''
     save_stmt = ''
     if (n_clicks > 0) and filename_row_index:
@@ -974,12 +1232,34 @@ def save_metadata(n_clicks, file_data, filename_row_index, fig):
         filename = df_select.loc[filename_row_index[0], 'filename']
         id_ = df_select.loc[filename_row_index[0], '_id']
         comments = df_select.loc[filename_row_index[0], 'comments']
-        data = fig['data']
+        state = get_session_state(session_id)
+        if (state['image_id'] != id_) or ('saved' not in state):
+            return 'not saved: select ' + filename + ' again'
         metadata = {}
-        #metadata['saved_time'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        metadata['comments'] = comments
-        metadata['dash_img_annotation'] = data
-        db.fs.files.update_one({'_id': ObjectId(id_)}, {'$set': {'metadata':metadata}})
-        save_stmt = 'saved metadata: ' + filename
+        #metadata['metadata.saved_time'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        metadata['metadata.comments'] = comments
+        if config.SIMPLIFY_ON_SAVE:
+            state['figure']['data'] = [simplify_trace(trace) for trace in state['figure']['data']]
+        # only set the annotator's fields so metadata written at upload (derivatives) is kept
+        with phase('annotations_save'):
+            result = annotations.save_changes(
+                id_, state['figure']['data'], state['saved'], state['version'], metadata,
+                mask_rles={key: mask['rle'] for key, mask in (state.get('masks') or {}).items()}
+            )
+        if result is None:
+            return 'not saved: ' + filename + ' was saved by someone else since it was loaded; ' \
+                'select it again to see their changes'
+        state['version'], state['saved'], counts = result
+        # saved masks are drawn from /masks/<annotation id>.png now; drop their RLEs
+        figure = state['figure']
+        unsaved = {trace['customdata'][0].get('mask_key') for trace in figure['data'] if is_mask(trace)}
+        state['masks'] = {key: mask for key, mask in (state.get('masks') or {}).items() if key in unsaved}
+        if state.get('image_size'):
+            figure['layout']['images'] = mask_images(
+                figure['layout'].get('images', []), figure['data'], *state['image_size']
+            )
+        set_session_state(session_id, state)
+        save_stmt = 'saved metadata: ' + filename \
+            + ' ({added} added, {changed} changed, {removed} removed)'.format(**counts)
 
     return save_stmt
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import argparse
+import datetime
+import mimetypes
+import numpy as np
+from pymongo import InsertOne
+
+from apps import config
+from apps.database import db
+from apps import annotations, geometry, masks
+from apps.imaging import image_size
+from apps.ingest import ingest_image
+
+
+# COCO has no open polylines; line annotations are left out of exports
+EXPORTED_SHAPES = ('box', 'polygon', 'model', 'mask')
+
+
+def _image_dims(doc):
+    metadata = doc.get('metadata') or {}
+    if 'width' in metadata and 'height' in metadata:
+        return metadata['width'], metadata['height']
+    return image_size(doc['_id'])
+
+
+def coco_annotation(doc, annotation_id, image_id, category_id, width, height):
+    '''COCO annotation dict of an annotation document (image rows go down, figure y up).
+
+    Masks and model predictions are RLE segmentations of single objects
+    (iscrowd 0, which COCO evaluation scores); only annotations imported
+    with iscrowd set keep it.
+    '''
+    if doc['shape_type'] in ('box', 'polygon'):
+        x, y = geometry.decode_points(doc['geometry'])
+        finite = np.isfinite(x) & np.isfinite(y)
+        segmentation = [np.column_stack([x[finite], height - y[finite]]).ravel().tolist()]
+        area = doc.get('area', 0.0)
+    else:
+        if doc['shape_type'] == 'mask':
+            rle = masks.rle_from_doc(doc['mask'])
+        else:
+            x, y = geometry.decode_points(doc['geometry'])
+            rle = masks.rle_encode(masks.rasterize(x, height - y, width, height))
+        segmentation = {'size': [height, width], 'counts': [int(count) for count in rle['counts']]}
+        # model annotations are stored with area 0
+        area = float(masks.rle_area(rle))
+    bbox = None
+    if doc.get('bbox'):
+        x0, y0, x1, y1 = doc['bbox']
+        bbox = [x0, height - y1, x1 - x0, y1 - y0]
+    return {
+        'id': annotation_id,
+        'image_id': image_id,
+        'category_id': category_id,
+        'segmentation': segmentation,
+        'area': area,
+        'bbox': bbox,
+        'iscrowd': int(bool((doc.get('customdata') or [{}])[0].get('iscrowd')))
+    }
+
+
+def iter_coco_json(labels=None, source=None):
+    '''COCO JSON of fs.files and its annotations, generated piece by piece.
+
+    Images are numbered in _id order. Annotations are read sorted by
+    image_id and joined against a second fs.files cursor in the same order,
+    so memory does not grow with the number of images.
+    '''
+    if not labels:
+        labels = sorted(annotations.collection.distinct('label'))
+    category_ids = {label: index + 1 for index, label in enumerate(labels)}
+    projection = {'filename': 1, 'contentType': 1, 'uploadDate': 1, 'metadata.width': 1, 'metadata.height': 1}
+
+    yield '{"info": ' + json.dumps({
+        'description': 'dash-image-annotator export',
+        'date_created': datetime.datetime.utcnow().isoformat()
+    })
+    yield ', "categories": ' + json.dumps([
+        {'id': category_id, 'name': label, 'supercategory': ''}
+        for label, category_id in category_ids.items()
+    ])
+
+    yield ', "images": ['
+    cursor = db.fs.files.find({}, projection, no_cursor_timeout=True).sort('_id', 1)
+    for index, doc in enumerate(cursor):
+        width, height = _image_dims(doc)
+        ext = mimetypes.guess_extension(doc.get('contentType') or '') or ''
+        yield (', ' if index else '') + json.dumps({
+            'id': index + 1,
+            'file_name': doc['filename'] + ext,
+            'width': width,
+            'height': height,
+            'date_captured': doc['uploadDate'].isoformat()
+        })
+    cursor.close()
+
+    yield '], "annotations": ['
+    search_request = {'label': {'$in': labels}, 'shape_type': {'$in': list(EXPORTED_SHAPES)}}
+    if source:
+        search_request['source'] = source
+    annotation_cursor = annotations.collection.find(
+        search_request, {'style': 0}, no_cursor_timeout=True
+    ).sort([('image_id', 1), ('_id', 1)])
+    files = db.fs.files.find({}, projection, no_cursor_timeout=True).sort('_id', 1)
+    file_doc, file_index, dims = None, 0, None
+    count = 0
+    for doc in annotation_cursor:
+        while (file_doc is None) or (file_doc['_id'] < doc['image_id']):
+            file_doc = next(files, None)
+            if file_doc is None:
+                break
+            file_index += 1
+            dims = None
+        if (file_doc is None) or (file_doc['_id'] != doc['image_id']):
+            # annotation of a deleted image
+            if file_doc is None:
+                break
+            continue
+        if dims is None:
+            dims = _image_dims(file_doc)
+        count += 1
+        yield (', ' if count > 1 else '') + json.dumps(coco_annotation(
+            doc, count, file_index, category_ids[doc['label']], *dims
+        ))
+    annotation_cursor.close()
+    files.close()
+    yield ']}'
+
+
+def label_colors(labels):
+    '''Colors of labels: config.DEFAULT_LABELS colors, cycled for labels not listed there.'''
+    default = dict(zip(config.DEFAULT_LABELS['labels'], config.DEFAULT_LABELS['colors']))
+    palette = config.DEFAULT_LABELS['colors']
+    return {
+        label: default.get(label, palette[index % len(palette)])
+        for index, label in enumerate(labels)
+    }
+
+
+def _decode_counts(counts):
+    '''Run lengths of a COCO RLE (list, or the compressed string format).'''
+    if not isinstance(counts, str):
+        return counts
+    runs = []
+    position = 0
+    while position < len(counts):
+        value, shift, more = 0, 0, True
+        while more:
+            char = ord(counts[position]) - 48
+            value |= (char & 0x1f) << (5*shift)
+            more = bool(char & 0x20)
+            position += 1
+            shift += 1
+            if not more and (char & 0x10):
+                value |= -1 << (5*shift)
+        if len(runs) > 2:
+            value += runs[-2]
+        runs.append(value)
+    return runs
+
+
+def _trace(label, color, shape_type, x, y, **customdata):
+    customdata['shape_type'] = shape_type
+    return {
+        'x': x,
+        'y': y,
+        'mode': 'markers+lines',
+        'marker': {'opacity': 1, 'color': color},
+        'showlegend': True,
+        'name': f'{label} -{shape_type}',
+        'customdata': [customdata],
+        'hoverinfo': 'name',
+        'visible': True,
+        'line': {'color': color},
+        'type': 'scattergl'
+    }
+
+
+def _is_box(points):
+    '''True for a closed ring of 4 corners of an axis-aligned rectangle (how boxes are exported).'''
+    if len(points) != 5:
+        return False
+    edges = np.diff(points, axis=0)
+    return bool(((edges[:, 0] == 0) ^ (edges[:, 1] == 0)).all())
+
+
+def coco_traces(annotation, label, color, height):
+    '''Figure traces of a COCO annotation: polygons, an RLE mask or its box (crowd flag kept in customdata).'''
+    segmentation = annotation.get('segmentation')
+    crowd = {'iscrowd': 1} if annotation.get('iscrowd') else {}
+    if isinstance(segmentation, list) and segmentation:
+        for polygon in segmentation:
+            points = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+            if (points[0] != points[-1]).any():
+                points = np.vstack([points, points[:1]])
+            shape_type = 'box' if _is_box(points) else 'polygon'
+            yield _trace(
+                label, color, shape_type, points[:, 0].tolist(), (height - points[:, 1]).tolist(), **crowd
+            )
+    elif isinstance(segmentation, dict):
+        rle = {'size': segmentation['size'], 'counts': _decode_counts(segmentation['counts'])}
+        trace = _trace(label, color, 'mask', [], [], rle=rle, **crowd)
+        trace['mode'] = 'markers'
+        yield trace
+    elif annotation.get('bbox'):
+        x, y, w, h = annotation['bbox']
+        top, bottom = height - y, height - y - h
+        yield _trace(label, color, 'box', [x, x + w, x + w, x, x], [bottom, bottom, top, top, bottom], **crowd)
+
+
+def _find_images(file_names):
+    '''{COCO file_name: fs.files _id} by stored filename (or alias) without directory and extension.'''
+    names = {file_name: os.path.basename(file_name).split('.')[0] for file_name in file_names}
+    found = {}
+    cursor = db.fs.files.find(
+        {'$or': [
+            {'filename': {'$in': list(names.values())}},
+            {'metadata.aliases': {'$in': list(names.values())}}
+        ]},
+        {'filename': 1, 'metadata.aliases': 1}
+    )
+    for doc in cursor:
+        for name in [doc['filename']] + (doc.get('metadata') or {}).get('aliases', []):
+            found.setdefault(name, doc['_id'])
+    return {file_name: found[name] for file_name, name in names.items() if name in found}
+
+
+def import_coco(fp, images_dir=None, batch_size=1000):
+    '''Import a COCO JSON file; annotations are written with bulk_write in batches.
+
+    Images are matched to fs.files by file name; with images_dir, images not
+    found are uploaded from that directory first. Returns counts.
+    '''
+    coco = json.load(fp)
+    categories = {category['id']: category['name'] for category in coco.get('categories', [])}
+    colors = label_colors(sorted(categories.values()))
+    images = {image['id']: image for image in coco.get('images', [])}
+    counts = {'images': 0, 'uploaded': 0, 'missing': 0, 'annotations': 0}
+
+    image_ids = {}
+    file_names = [image['file_name'] for image in images.values()]
+    for start in range(0, len(file_names), batch_size):
+        image_ids.update(_find_images(file_names[start:start + batch_size]))
+    for image in images.values():
+        if (image['file_name'] not in image_ids) and images_dir:
+            path = os.path.join(images_dir, image['file_name'])
+            if not os.path.exists(path):
+                path = os.path.join(images_dir, os.path.basename(image['file_name']))
+            if os.path.exists(path):
+                with open(path, 'rb') as image_fp:
+                    stored = ingest_image(image['file_name'], image_fp, {'comments': ''})
+                if stored['image_id'] is not None:
+                    image_ids[image['file_name']] = stored['image_id']
+                    counts['uploaded'] += stored['status'] == 'stored'
+    counts['images'] = len(image_ids)
+    counts['missing'] = len(images) - len(image_ids)
+
+    requests = []
+    for annotation in coco.get('annotations', []):
+        image = images.get(annotation['image_id'])
+        if (image is None) or (image['file_name'] not in image_ids):
+            continue
+        image_id = image_ids[image['file_name']]
+        if 'height' not in image:
+            image['width'], image['height'] = image_size(image_id)
+        label = categories.get(annotation['category_id'], str(annotation['category_id']))
+        color = colors.get(label, config.DEFAULT_LABELS['colors'][0])
+        for trace in coco_traces(annotation, label, color, image['height']):
+            requests.append(InsertOne(annotations.trace_to_doc(image_id, trace)))
+        if len(requests) >= batch_size:
+            counts['annotations'] += annotations.collection.bulk_write(requests, ordered=False).inserted_count
+            requests = []
+    if requests:
+        counts['annotations'] += annotations.collection.bulk_write(requests, ordered=False).inserted_count
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='COCO export and import of annotations.')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_export = subparsers.add_parser('export', help='write fs.files and annotations as COCO JSON')
+    parser_export.add_argument('output', help="JSON file ('-': stdout)")
+    parser_export.add_argument('--labels', nargs='+', help='labels to export (default: all)')
+    parser_export.add_argument('--source', help="only annotations from this source ('manual' or a run id)")
+    parser_import = subparsers.add_parser('import', help='add the annotations of a COCO JSON file')
+    parser_import.add_argument('input', help='COCO JSON file')
+    parser_import.add_argument('--images', help='directory to upload images not found in fs.files from')
+    parser_import.add_argument('--batch-size', type=int, default=1000, help='annotations per bulk_write')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        out = sys.stdout if args.output == '-' else open(args.output, 'w')
+        try:
+            for piece in iter_coco_json(args.labels, args.source):
+                out.write(piece)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    elif args.command == 'import':
+        with open(args.input) as fp:
+            counts = import_coco(fp, args.images, args.batch_size)
+        print(f"imported {counts['annotations']} annotations on {counts['images']} images "
+              f"({counts['uploaded']} uploaded, {counts['missing']} not found)")
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,8 @@
 
 import os
 import sys
+import json
+import tempfile
 
 
 # Host and Port of image-annotator/uploader web-app
@@ -10,6 +12,11 @@ HOST = os.environ.get('HOST', '127.0.0.1')
 PORT = os.environ.get('PORT', 8050)
 
 
+# Pages served, the first one at '/' (e.g. 'uploader' for an upload-only deployment
+# that never imports the annotator, its model code and their dependencies)
+APP_PAGES = os.environ.get('APP_PAGES', 'annotator,uploader').split(',')
+
+
 # Optional. Example: http://127.0.0.1:5000
 MLFLOW_URI = os.environ.get('MLFLOW_URI')
 
@@ -30,6 +37,24 @@ except KeyError:
     sys.exit(1)
 
 
+# MongoDB connection pool of each server process (see apps/database.py)
+#  - every process (e.g. each gunicorn worker) creates its own client on first use
+#  - timeouts are in milliseconds; an empty socket/wait-queue timeout waits indefinitely
+MONGODB_MAX_POOL_SIZE = int(os.environ.get('MONGODB_MAX_POOL_SIZE', 100))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGODB_SERVER_SELECTION_TIMEOUT_MS', 30000))
+MONGODB_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGODB_CONNECT_TIMEOUT_MS', 20000))
+MONGODB_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGODB_SOCKET_TIMEOUT_MS') or 0) or None
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGODB_WAIT_QUEUE_TIMEOUT_MS') or 0) or None
+
+
+# MongoDB indexes and query plans (see apps/indexes.py)
+#  - MONGODB_ENSURE_INDEXES=0 skips creating the app's indexes at startup
+#  - MONGODB_EXPLAIN=1 logs an explain() summary of the app's queries (debugging only,
+#    every query runs twice)
+MONGODB_ENSURE_INDEXES = os.environ.get('MONGODB_ENSURE_INDEXES', '1') == '1'
+MONGODB_EXPLAIN = os.environ.get('MONGODB_EXPLAIN', '0') == '1'
+
+
 # Annotation labels
 DEFAULT_LABELS = {
     'labels': ['label_1', 'label_2', 'label_3', 'label_4'],
@@ -37,6 +62,123 @@ DEFAULT_LABELS = {
 }
 
 
+# Point simplification of lasso and model traces (see apps/simplify.py)
+#  - tolerances are in image pixels, 0 keeps every point
+#  - SIMPLIFY_LABEL_TOLERANCES overrides it per label, e.g. '{"label_1": 0.5}'
+#  - lasso traces are simplified when drawn; with SIMPLIFY_ON_SAVE=1 all
+#    traces are also simplified when saved (Save button and Batch Model)
+SIMPLIFY_TOLERANCE = float(os.environ.get('SIMPLIFY_TOLERANCE', 1.0))
+SIMPLIFY_LABEL_TOLERANCES = json.loads(os.environ.get('SIMPLIFY_LABEL_TOLERANCES', '{}'))
+SIMPLIFY_ON_SAVE = os.environ.get('SIMPLIFY_ON_SAVE', '0') == '1'
+
+
 # Set image display height in pixels
 #  - images will be displayed with this height while maintaining the aspect ratio
 IMG_DISPLAY_HEIGHT = 512
+
+
+# Seconds browsers may cache images served by the /images/<ObjectId> endpoint
+IMAGE_MAX_AGE = int(os.environ.get('IMAGE_MAX_AGE', 86400))
+
+
+# Byte budget (in MB) of the process-local LRU cache of decoded and display-resized images
+IMAGE_CACHE_MB = int(os.environ.get('IMAGE_CACHE_MB', 256))
+
+# Prefetch of the PREFETCH_ROWS images after the selected row of the Select Images table
+#  - PREFETCH_WORKERS threads per process load images without stored derivatives
+#    into the image cache, the others get browser preload hints (0: only
+#    browser preload hints)
+PREFETCH_ROWS = int(os.environ.get('PREFETCH_ROWS', 3))
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', 2))
+
+# JPEG quality of images re-encoded at IMG_DISPLAY_HEIGHT
+IMG_DISPLAY_QUALITY = 85
+
+
+# Derivatives written next to each uploaded image (see apps/imaging.py)
+#  - display: IMG_DISPLAY_HEIGHT high, thumbnail: fits in THUMBNAIL_SIZE
+#  - DERIVATIVE_FORMAT is JPEG or WEBP; images with transparency are stored as PNG
+DERIVATIVE_FORMAT = os.environ.get('DERIVATIVE_FORMAT', 'JPEG').upper()
+THUMBNAIL_SIZE = (128, 128)
+
+
+# Server-side store of the annotator's per-session figure and in-progress polygon
+#  - memory: per process (single worker: wsgi.py refuses to start several gunicorn
+#    workers with it), holds at most SESSION_MEMORY_MAX sessions
+#  - file: one JSON file per session in SESSION_DIR (multiple workers on one host)
+#  - mongo: 'dash_sessions' collection of MONGODB_DATABASE (multiple hosts)
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'memory')
+SESSION_DIR = os.environ.get(
+    'SESSION_DIR', os.path.join(tempfile.gettempdir(), 'dash-image-annotator-sessions')
+)
+SESSION_MEMORY_MAX = 1000
+# Seconds after the last update that file/mongo sessions are discarded
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 7 * 24 * 3600))
+
+
+# Callback metrics served on /metrics (see apps/metrics.py)
+#  - callbacks slower than SLOW_CALLBACK_MS (request to response, 0: never) are logged
+#    with their phases and body sizes
+SLOW_CALLBACK_MS = int(os.environ.get('SLOW_CALLBACK_MS', 0))
+
+
+# Warm-up of each server process before it reports ready on /readyz (see apps/health.py)
+#  - started in the background by the process's first request (e.g. the readiness probe)
+#  - connects to MongoDB, then loads the MLflow run WARM_UP_MODEL (if set)
+WARM_UP = os.environ.get('WARM_UP', '0') == '1'
+WARM_UP_MODEL = os.environ.get('WARM_UP_MODEL')
+
+
+# Max number of MLflow pyfunc models kept loaded in each server process
+MLFLOW_MODEL_CACHE_SIZE = int(os.environ.get('MLFLOW_MODEL_CACHE_SIZE', 2))
+
+
+# How model predictions are drawn and stored (see apps/masks.py)
+#  - 'points': one scattergl marker per predicted pixel
+#  - 'mask': a run-length encoded mask drawn as a PNG overlay of MASK_OPACITY,
+#    shown/hidden through its legend entry
+MLFLOW_PREDICTION_DISPLAY = os.environ.get('MLFLOW_PREDICTION_DISPLAY', 'points')
+MASK_OPACITY = float(os.environ.get('MASK_OPACITY', 0.4))
+
+
+# Batch Model inference pipeline (see apps/inference.py)
+#  - images are read from GridFS by MLFLOW_BATCH_READ_WORKERS threads
+#  - MLFLOW_BATCH_SIZE images go into each predict() call; the model's predictions
+#    must then have a MLFLOW_BATCH_ROW_COLUMN column with the row of the input image,
+#    otherwise images are predicted one at a time
+MLFLOW_BATCH_SIZE = int(os.environ.get('MLFLOW_BATCH_SIZE', 8))
+MLFLOW_BATCH_READ_WORKERS = int(os.environ.get('MLFLOW_BATCH_READ_WORKERS', os.cpu_count() or 1))
+MLFLOW_BATCH_ROW_COLUMN = 'row'
+
+
+# Background Batch Model jobs (see apps/jobs.py), recorded in the 'dash_jobs' collection
+#  - thread: jobs run in the server process, process: in a pool of spawned processes
+JOB_EXECUTOR = os.environ.get('JOB_EXECUTOR', 'thread')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 1))
+# Milliseconds between progress polls of the annotator page
+JOB_POLL_INTERVAL = 1000
+# Seconds between heartbeats of a running job, and without one after which a
+# 'running' job counts as interrupted (e.g. by a server restart) and can be resumed
+JOB_HEARTBEAT_SECONDS = 60
+JOB_STALE_SECONDS = 300
+
+
+# Upload ingestion (see apps/ingest.py)
+#  - files are read and written to GridFS UPLOAD_CHUNK_BYTES at a time
+#  - each file is spooled in memory up to UPLOAD_SPOOL_BYTES, then on disk
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+UPLOAD_SPOOL_BYTES = int(os.environ.get('UPLOAD_SPOOL_MB', 64)) * 1024 * 1024
+
+
+# Resumable chunked uploads (see apps/upload_routes.py)
+#  - partial uploads are kept in UPLOAD_DIR for UPLOAD_TTL seconds after their last chunk
+#  - received uploads are ingested in the background by UPLOAD_INGEST_WORKERS (threads
+#    or processes, as JOB_EXECUTOR); one whose ingestion made no progress for
+#    UPLOAD_INGEST_STALE seconds is restarted when it is completed again
+UPLOAD_DIR = os.environ.get(
+    'UPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'dash-image-annotator-uploads')
+)
+UPLOAD_CLIENT_CHUNK_BYTES = 8 * 1024 * 1024
+UPLOAD_TTL = 24 * 3600
+UPLOAD_INGEST_WORKERS = int(os.environ.get('UPLOAD_INGEST_WORKERS', 2))
+UPLOAD_INGEST_STALE = 300
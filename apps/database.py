@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+from pymongo import MongoClient
+import gridfs
+
+from apps import config
+
+
+class ProcessLocal(object):
+    '''Proxy of an object created on first use in each process.
+
+    A MongoClient must not be shared across fork(): pre-forking servers
+    (gunicorn) import the app once and fork workers, so every worker creates
+    its own client (and connection pool) the first time it is used.
+    '''
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._pid = None
+        self._object = None
+        self._lock = threading.Lock()
+        self._lock_pid = os.getpid()
+
+    def _resolve(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            if self._lock_pid != pid:
+                # a lock copied by fork may be held by a thread that only exists in the parent
+                self._lock, self._lock_pid = threading.Lock(), pid
+            with self._lock:
+                if self._pid != pid:
+                    self._object = self._factory()
+                    self._pid = pid
+        return self._object
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __getitem__(self, name):
+        return self._resolve()[name]
+
+
+def make_client():
+    return MongoClient(
+        config.MONGODB_CONNECT_STRING,
+        maxPoolSize=config.MONGODB_MAX_POOL_SIZE,
+        serverSelectionTimeoutMS=config.MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+        connectTimeoutMS=config.MONGODB_CONNECT_TIMEOUT_MS,
+        socketTimeoutMS=config.MONGODB_SOCKET_TIMEOUT_MS,
+        waitQueueTimeoutMS=config.MONGODB_WAIT_QUEUE_TIMEOUT_MS
+    )
+
+
+client = ProcessLocal(make_client)
+db = ProcessLocal(lambda: client._resolve()[config.MONGODB_DATABASE])
+fs = ProcessLocal(lambda: gridfs.GridFS(db._resolve()))
+
+# display-resolution and thumbnail versions of the images in fs, linked through
+# metadata.derivatives (original) and metadata.derivative_of (derivative)
+derivatives_fs = ProcessLocal(lambda: gridfs.GridFS(db._resolve(), collection='derivatives'))
+
+
+def lazy_collection(name):
+    '''Collection of db for module-level use (resolved in each process).'''
+    return ProcessLocal(lambda: db._resolve()[name])
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import zipfile
+import argparse
+import mimetypes
+import multiprocessing
+from io import BytesIO
+from collections import deque
+import numpy as np
+from PIL import Image as PImage, ImageDraw
+
+from apps.database import db, fs
+from apps import annotations, geometry, masks
+
+
+SPLITS = ('train', 'val')
+
+
+def split_of(image_id, seed, val_fraction):
+    ''''train' or 'val' from a seeded hash of the image id (independent of export order).'''
+    digest = hashlib.sha256(f'{seed}:{image_id}'.encode()).digest()
+    if int.from_bytes(digest[:8], 'big')/2**64 < val_fraction:
+        return 'val'
+    return 'train'
+
+
+def rasterize_annotation(draw, mask, doc, width, height, line_width):
+    '''Draw one annotation document into a label mask (PIL draw and NumPy array views of it).'''
+    if doc['shape_type'] == 'mask':
+        if 'mask' in doc:
+            mask |= masks.rle_decode(masks.rle_from_doc(doc['mask']))
+        return
+    x, y = geometry.decode_points(doc['geometry'])
+    finite = np.isfinite(x) & np.isfinite(y)
+    # figure y axis points up, image rows go down
+    x, rows = x[finite], height - y[finite]
+    if doc['shape_type'] == 'model':
+        mask |= masks.rasterize(x, rows, width, height)
+        return
+    points = np.column_stack([x, rows]).ravel().tolist()
+    if (doc['shape_type'] in ('box', 'polygon')) and (len(x) > 2):
+        draw.polygon(points, fill=1, outline=1)
+    elif (doc['shape_type'] == 'line') and (len(x) > 1):
+        draw.line(points, fill=1, width=line_width)
+
+
+def label_masks(docs, labels, width, height, line_width=1):
+    '''{label: boolean mask (height x width)} of an image's annotation documents.'''
+    result = {}
+    for doc in docs:
+        if doc['label'] not in labels:
+            continue
+        if doc['label'] not in result:
+            canvas = PImage.new('L', (width, height), 0)
+            result[doc['label']] = [canvas, ImageDraw.Draw(canvas), np.zeros((height, width), dtype=bool)]
+        canvas, draw, mask = result[doc['label']]
+        rasterize_annotation(draw, mask, doc, width, height, line_width)
+    return {
+        label: np.asarray(canvas, dtype=bool) | mask
+        for label, (canvas, draw, mask) in result.items()
+    }
+
+
+def render_image(image_id, filename, labels, options):
+    '''Worker: image and per-label masks of one image, encoded for the output format.
+
+    Returns None for images without annotations of the exported labels
+    (unless options['include_empty']).
+    '''
+    search_request = {'image_id': image_id, 'label': {'$in': labels}}
+    if options['source']:
+        search_request['source'] = options['source']
+    docs = list(annotations.collection.find(search_request, {'customdata': 0, 'style': 0}))
+    if not docs and not options['include_empty']:
+        return None
+
+    grid_out = fs.get(image_id)
+    data = grid_out.read()
+    img = PImage.open(BytesIO(data))
+    width, height = img.size
+    mask_by_label = label_masks(docs, labels, width, height, options['line_width'])
+    item = {
+        'split': split_of(image_id, options['seed'], options['val_fraction']),
+        'name': f'{filename}-{image_id}'
+    }
+    if options['format'] == 'zip':
+        item['image'] = data
+        item['ext'] = mimetypes.guess_extension(grid_out.content_type or '') or ''
+        item['masks'] = {}
+        for label, mask in mask_by_label.items():
+            buf = BytesIO()
+            PImage.fromarray(mask.astype(np.uint8)*255, 'L').convert('1').save(buf, format='PNG')
+            item['masks'][label] = buf.getvalue()
+    else:
+        item['image'] = np.asarray(img.convert('RGB'))
+        item['masks'] = np.stack([
+            mask_by_label.get(label, np.zeros((height, width), dtype=bool)) for label in labels
+        ])
+    return item
+
+
+class ZipWriter(object):
+    '''split/images/<name><ext> and split/masks/<name>/<label>.png members of one zip.'''
+
+    def __init__(self, path):
+        # images and PNG masks are already compressed
+        self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+
+    def add(self, item):
+        self.zip.writestr(f"{item['split']}/images/{item['name']}{item['ext']}", item['image'])
+        for label, png in item['masks'].items():
+            self.zip.writestr(f"{item['split']}/masks/{item['name']}/{label}.png", png)
+
+    def close(self, manifest):
+        self.zip.writestr('manifest.json', json.dumps(manifest, indent=2))
+        self.zip.close()
+
+
+class NpzWriter(object):
+    '''<split>-<shard>.npz files of shard_size images (names, image_<i>, masks_<i> with one plane per label).
+
+    Each array is compressed into the open shard as its image arrives (as
+    np.savez_compressed writes them), so only the image being written is
+    held in memory, however large the shards.
+    '''
+
+    def __init__(self, directory, shard_size):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.shard_size = shard_size
+        self.zips = {split: None for split in SPLITS}
+        self.names = {split: [] for split in SPLITS}
+        self.shards = {split: 0 for split in SPLITS}
+
+    def add(self, item):
+        split = item['split']
+        if self.zips[split] is None:
+            path = os.path.join(self.directory, f'{split}-{self.shards[split]:05d}.npz')
+            self.zips[split] = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        index = len(self.names[split])
+        self._write_array(split, f'image_{index}', item['image'])
+        self._write_array(split, f'masks_{index}', item['masks'])
+        self.names[split].append(item['name'])
+        if len(self.names[split]) >= self.shard_size:
+            self._close_shard(split)
+
+    def _write_array(self, split, name, array):
+        with self.zips[split].open(name + '.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+    def _close_shard(self, split):
+        if self.zips[split] is None:
+            return
+        self._write_array(split, 'names', np.array(self.names[split]))
+        self.zips[split].close()
+        self.zips[split] = None
+        self.names[split] = []
+        self.shards[split] += 1
+
+    def close(self, manifest):
+        for split in SPLITS:
+            self._close_shard(split)
+        with open(os.path.join(self.directory, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+
+def export(writer, labels=None, source=None, val_fraction=0.2, seed=0, workers=None,
+           line_width=1, include_empty=False, limit=0, output_format='zip'):
+    '''Export image/mask pairs of fs.files through writer; returns the manifest.
+
+    Images are rendered by a pool of spawned processes with at most
+    4 images per worker in flight and written out one at a time, so memory
+    stays bounded however many images are exported. workers=0 renders in
+    this process.
+    '''
+    if not labels:
+        labels = sorted(annotations.collection.distinct('label'))
+    options = {
+        'source': source,
+        'seed': seed,
+        'val_fraction': val_fraction,
+        'line_width': line_width,
+        'include_empty': include_empty,
+        'format': output_format
+    }
+    counts = {split: 0 for split in SPLITS}
+    counts['skipped'] = 0
+
+    def write(item):
+        if item is None:
+            counts['skipped'] += 1
+        else:
+            counts[item['split']] += 1
+            writer.add(item)
+
+    cursor = db.fs.files.find({}, {'filename': 1}, no_cursor_timeout=True).sort('_id', 1).limit(limit)
+    pool = None
+    if workers != 0:
+        # spawned (not forked) so each process opens its own MongoClient
+        pool = multiprocessing.get_context('spawn').Pool(workers)
+    try:
+        pending = deque()
+        max_pending = 4*(workers or os.cpu_count() or 1)
+        for doc in cursor:
+            args = (doc['_id'], doc['filename'], labels, options)
+            if pool is None:
+                write(render_image(*args))
+                continue
+            pending.append(pool.apply_async(render_image, args))
+            if len(pending) >= max_pending:
+                write(pending.popleft().get())
+        while pending:
+            write(pending.popleft().get())
+    finally:
+        cursor.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    manifest = {
+        'labels': labels,
+        'source': source,
+        'seed': seed,
+        'val_fraction': val_fraction,
+        'counts': counts
+    }
+    writer.close(manifest)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export images with per-label masks and a seeded train/val split.'
+    )
+    parser.add_argument('output', help='zip file, or directory of .npz shards')
+    parser.add_argument('--format', choices=['zip', 'npz'], default='zip')
+    parser.add_argument('--labels', nargs='+', help='labels to export (default: all)')
+    parser.add_argument('--source', help="only annotations from this source ('manual' or a run id)")
+    parser.add_argument('--val-fraction', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='rendering processes (default: CPU count, 0: none)')
+    parser.add_argument('--shard-size', type=int, default=1000, help='images per .npz shard')
+    parser.add_argument('--line-width', type=int, default=1, help='pixel width of line annotations')
+    parser.add_argument('--include-empty', action='store_true', help='also export images without annotations')
+    parser.add_argument('--limit', type=int, default=0, help='max images (0: all)')
+    args = parser.parse_args()
+
+    if args.format == 'zip':
+        writer = ZipWriter(args.output)
+    else:
+        writer = NpzWriter(args.output, args.shard_size)
+    manifest = export(
+        writer, args.labels, args.source, args.val_fraction, args.seed, args.workers,
+        args.line_width, args.include_empty, args.limit, args.format
+    )
+    print(f"exported {manifest['counts']['train']} train and {manifest['counts']['val']} val images "
+          f"({manifest['counts']['skipped']} without annotations skipped)")
+
+
+if __name__ == '__main__':
+    main()
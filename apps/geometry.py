@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from bson.binary import Binary
+
+
+# Annotation coordinates are stored as BSON binary:
+#   {'dtype': '<i2', 'delta': True, 'n': 3, 'data': Binary(...)}
+# Integer coordinates (pixel positions) are delta-encoded with the smallest
+# integer type that holds the differences; other coordinates are float32.
+INT_DTYPES = ('<i1', '<i2', '<i4')
+FLOAT_DTYPE = '<f4'
+
+
+def _int_dtype(deltas):
+    for dtype in INT_DTYPES:
+        info = np.iinfo(np.dtype(dtype))
+        if (deltas.min() >= info.min) and (deltas.max() <= info.max):
+            return dtype
+    return None
+
+
+def encode(values):
+    '''Encode a coordinate sequence (None/NaN allowed) as a compact binary field.'''
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) and np.isfinite(values).all() and (values == np.round(values)).all():
+        ints = values.astype(np.int64)
+        deltas = np.empty_like(ints)
+        deltas[0] = ints[0]
+        deltas[1:] = np.diff(ints)
+        dtype = _int_dtype(deltas)
+        if dtype is not None:
+            return {
+                'dtype': dtype,
+                'delta': True,
+                'n': len(values),
+                'data': Binary(deltas.astype(dtype).tobytes())
+            }
+    return {
+        'dtype': FLOAT_DTYPE,
+        'delta': False,
+        'n': len(values),
+        'data': Binary(values.astype(FLOAT_DTYPE).tobytes())
+    }
+
+
+def decode(field):
+    '''Float64 array of an encoded coordinate field (plain lists are passed through).'''
+    if isinstance(field, list):
+        return np.asarray(field, dtype=np.float64)
+    values = np.frombuffer(field['data'], dtype=np.dtype(field['dtype']))
+    if field['delta']:
+        return np.cumsum(values, dtype=np.int64).astype(np.float64)
+    return values.astype(np.float64)
+
+
+def encode_points(x, y):
+    '''Geometry sub-document of x/y coordinate sequences.'''
+    return {'x': encode(x), 'y': encode(y)}
+
+
+def decode_points(geometry):
+    '''x and y float64 arrays of a geometry sub-document.'''
+    return decode(geometry['x']), decode(geometry['y'])
+
+
+def to_list(values):
+    '''Plotly-ready list of coordinates (NaN gaps become None).'''
+    return np.where(np.isnan(values), None, values).tolist()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+import threading
+import flask
+from pymongo.errors import PyMongoError
+
+from apps import config
+from apps.database import client, ProcessLocal
+from app import app
+
+
+logger = logging.getLogger(__name__)
+
+# pid of the process warm_up() completed in: a worker forked from a preloaded
+# master (gunicorn --preload) inherits the master's globals but has to connect
+# to MongoDB and load the model itself
+_warmed_up_pid = None
+WARM_UP_RETRY_SECONDS = 5
+
+
+def warmed_up():
+    '''True once warm_up() has completed in this process (always without config.WARM_UP).'''
+    return (not config.WARM_UP) or (_warmed_up_pid == os.getpid())
+
+
+def ping_mongo():
+    '''Round trip time (seconds) of a MongoDB ping from this process.'''
+    start = time.perf_counter()
+    client.admin.command('ping')
+    return time.perf_counter() - start
+
+
+def warm_up():
+    '''Connect to MongoDB and load config.WARM_UP_MODEL before serving traffic.'''
+    global _warmed_up_pid
+    logger.info('MongoDB ping %.1f ms', ping_mongo()*1000)
+    if config.WARM_UP_MODEL and (config.MLFLOW_URI is not None):
+        from apps.models import model_cache
+        start = time.perf_counter()
+        loaded = model_cache.get(config.WARM_UP_MODEL)
+        logger.info('loaded model %s in %.1f s', loaded.run_name, time.perf_counter() - start)
+    _warmed_up_pid = os.getpid()
+
+
+def _warm_up_until_done():
+    while True:
+        try:
+            warm_up()
+            return
+        except Exception:
+            logger.exception('warm-up of process %d failed, retrying', os.getpid())
+            time.sleep(WARM_UP_RETRY_SECONDS)
+
+
+def _start_warm_up_thread():
+    thread = threading.Thread(target=_warm_up_until_done, name='warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+# one warm-up thread per process, started by its first request
+_warm_up_thread = ProcessLocal(_start_warm_up_thread)
+
+
+@app.server.before_request
+def _start_warm_up():
+    if config.WARM_UP:
+        _warm_up_thread._resolve()
+
+
+@app.server.route('/healthz')
+def healthz():
+    '''Liveness: the process serves requests (no database access).'''
+    return flask.jsonify(status='ok')
+
+
+@app.server.route('/readyz')
+def readyz():
+    '''Readiness: warmed up and MongoDB reachable (503 otherwise).'''
+    if not warmed_up():
+        return flask.jsonify(status='warming up'), 503
+    try:
+        ping = ping_mongo()
+    except PyMongoError as e:
+        return flask.jsonify(status='unavailable', error=str(e)), 503
+    return flask.jsonify(status='ok', mongo_ping_ms=round(ping*1000, 1))
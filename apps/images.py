@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+from io import BytesIO
+from collections import OrderedDict, namedtuple
+import flask
+from PIL import Image as PImage
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+import gridfs
+
+from apps import config
+from apps.database import fs, derivatives_fs
+from apps import annotations, masks
+from apps.imaging import encode_image, resize_to_height, file_size
+from apps.sessions import session_store
+from app import app
+
+
+CachedImage = namedtuple(
+    'CachedImage',
+    ['image_id', 'upload_date', 'content_type', 'data', 'width', 'height',
+     'display', 'display_content_type']
+)
+
+
+def _display_bytes(img, data, content_type):
+    '''Encode the image resized to config.IMG_DISPLAY_HEIGHT (original if not taller).'''
+    if img.size[1] <= config.IMG_DISPLAY_HEIGHT:
+        return data, content_type
+    return encode_image(resize_to_height(img, config.IMG_DISPLAY_HEIGHT))
+
+
+class ImageCache(object):
+    '''Process-local LRU cache of GridFS images bounded by a byte-size budget.
+
+    Entries are keyed by (_id, uploadDate) and hold the raw bytes, the image
+    dimensions and, once requested, the image re-encoded at
+    config.IMG_DISPLAY_HEIGHT.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, image_id):
+        '''Cached image for a GridFS file id (only the file document is queried on a hit).'''
+        return self.get_file(fs.get(ObjectId(image_id)))
+
+    def get_file(self, grid_out):
+        '''Cached image for an open GridOut; its chunks are only read on a miss.'''
+        key = (grid_out._id, grid_out.upload_date)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+
+        data = grid_out.read()
+        img_width, img_height = file_size(grid_out, BytesIO(data))
+        entry = CachedImage(
+            image_id=grid_out._id,
+            upload_date=grid_out.upload_date,
+            content_type=grid_out.content_type,
+            data=data,
+            width=img_width,
+            height=img_height,
+            display=None,
+            display_content_type=None
+        )
+        self._put(key, entry)
+        return entry
+
+    def get_display(self, grid_out):
+        '''Cached image with its display-height version, decoding it on first use.'''
+        entry = self.get_file(grid_out)
+        if entry.display is None:
+            img = PImage.open(BytesIO(entry.data))
+            display, display_content_type = _display_bytes(img, entry.data, entry.content_type)
+            entry = entry._replace(display=display, display_content_type=display_content_type)
+            self._put((grid_out._id, grid_out.upload_date), entry)
+        return entry
+
+    def _put(self, key, entry):
+        size = len(entry.data)
+        if entry.display is not None and entry.display is not entry.data:
+            size += len(entry.display)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (entry, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        '''Hit/miss/eviction counters and current occupancy.'''
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes
+            }
+
+
+image_cache = ImageCache(config.IMAGE_CACHE_MB * 1024 * 1024)
+
+
+def image_url(image_id, kind=None):
+    '''URL of the image endpoint for a GridFS file id (kind: display or thumbnail).'''
+    if kind:
+        return f'/images/{image_id}/{kind}'
+    return f'/images/{image_id}'
+
+
+def image_etag(grid_out):
+    '''Strong ETag for a GridFS file (files are never modified in place).'''
+    if getattr(grid_out, 'md5', None):
+        return grid_out.md5
+    return f'{grid_out._id}-{int(grid_out.upload_date.timestamp() * 1000)}'
+
+
+def _get_file_or_404(image_id):
+    try:
+        return fs.get(ObjectId(image_id))
+    except (InvalidId, gridfs.errors.NoFile):
+        flask.abort(404)
+
+
+def _cached_response(etag, make_response):
+    '''Answer conditional requests with 304 and attach the caching headers.'''
+    if etag in flask.request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        response = make_response()
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'private, max-age={config.IMAGE_MAX_AGE}'
+    return response
+
+
+@app.server.route('/images/<image_id>')
+def serve_image(image_id):
+    '''Stream an image from GridFS so figures only reference its URL.'''
+    grid_out = _get_file_or_404(image_id)
+
+    def make_response():
+        response = flask.Response(
+            iter(grid_out),
+            mimetype=grid_out.content_type or 'application/octet-stream'
+        )
+        response.content_length = grid_out.length
+        return response
+
+    return _cached_response(image_etag(grid_out), make_response)
+
+
+def _serve_derivative(grid_out, kind):
+    derivative = derivatives_fs.get(grid_out.metadata['derivatives'][kind])
+
+    def make_response():
+        response = flask.Response(iter(derivative), mimetype=derivative.content_type)
+        response.content_length = derivative.length
+        return response
+
+    return _cached_response(image_etag(derivative), make_response)
+
+
+@app.server.route('/images/<image_id>/display')
+def serve_display_image(image_id):
+    '''Serve the display-height derivative, or resize the original through the image cache.'''
+    grid_out = _get_file_or_404(image_id)
+    if 'display' in (grid_out.metadata or {}).get('derivatives', {}):
+        return _serve_derivative(grid_out, 'display')
+    if 'thumbnail' in (grid_out.metadata or {}).get('derivatives', {}):
+        # uploaded with derivatives but not taller than IMG_DISPLAY_HEIGHT
+        return serve_image(image_id)
+
+    def make_response():
+        cached = image_cache.get_display(grid_out)
+        return flask.Response(cached.display, mimetype=cached.display_content_type)
+
+    return _cached_response(image_etag(grid_out) + '-display', make_response)
+
+
+@app.server.route('/images/<image_id>/thumbnail')
+def serve_thumbnail(image_id):
+    '''Serve the thumbnail derivative of an image.'''
+    grid_out = _get_file_or_404(image_id)
+    if 'thumbnail' not in (grid_out.metadata or {}).get('derivatives', {}):
+        flask.abort(404)
+    return _serve_derivative(grid_out, 'thumbnail')
+
+
+@app.server.route('/masks/<annotation_id>.png')
+def serve_mask(annotation_id):
+    '''Render a stored mask annotation as a semi-transparent PNG overlay (at display height).'''
+    try:
+        doc = annotations.collection.find_one(
+            {'_id': ObjectId(annotation_id), 'shape_type': 'mask'},
+            {'mask': 1, 'style.marker.color': 1, 'created': 1, 'modified': 1}
+        )
+    except InvalidId:
+        doc = None
+    if doc is None or 'mask' not in doc:
+        flask.abort(404)
+    changed = doc.get('modified') or doc['created']
+
+    def make_response():
+        mask = masks.rle_decode(masks.rle_from_doc(doc['mask']))
+        color = (doc.get('style', {}).get('marker') or {}).get('color', 'rgb(255,0,0)')
+        png = masks.mask_png(mask, color, height=config.IMG_DISPLAY_HEIGHT)
+        return flask.Response(png, mimetype='image/png')
+
+    return _cached_response(f'{annotation_id}-{int(changed.timestamp() * 1000)}', make_response)
+
+
+@app.server.route('/masks/preview/<session_id>/<key>.png')
+def serve_mask_preview(session_id, key):
+    '''Render an unsaved mask prediction kept in an annotator session.'''
+    try:
+        state = session_store.get(session_id)
+    except ValueError:
+        state = None
+    mask = ((state or {}).get('masks') or {}).get(key)
+    if mask is None:
+        flask.abort(404)
+
+    def make_response():
+        png = masks.mask_png(masks.rle_decode(mask['rle']), mask['color'], height=config.IMG_DISPLAY_HEIGHT)
+        return flask.Response(png, mimetype='image/png')
+
+    # keys are unique per prediction, so the overlay never changes
+    return _cached_response(f'preview-{key}', make_response)
+
+
+@app.server.route('/image-cache/stats')
+def serve_image_cache_stats():
+    '''Image cache hit/miss/eviction counters as JSON.'''
+    return flask.jsonify(image_cache.stats())
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import hashlib
+from io import BytesIO
+from PIL import Image as PImage
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+
+from apps import config
+from apps.database import db, fs, derivatives_fs
+from apps import annotations
+
+
+def encode_image(img, quality=config.IMG_DISPLAY_QUALITY):
+    '''Encode a PIL image as config.DERIVATIVE_FORMAT (PNG if it has transparency).'''
+    buf = BytesIO()
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img.save(buf, format='PNG')
+        return buf.getvalue(), 'image/png'
+    fmt = config.DERIVATIVE_FORMAT
+    img.convert('RGB').save(buf, format=fmt, quality=quality)
+    return buf.getvalue(), PImage.MIME[fmt]
+
+
+def resize_to_height(img, height):
+    '''Resize a PIL image to the given height while maintaining the aspect ratio.'''
+    img_width, img_height = img.size
+    scale_factor = height/img_height
+    return img.resize((max(1, round(img_width*scale_factor)), height), PImage.BILINEAR)
+
+
+def make_derivatives(img):
+    '''Encoded display-height and thumbnail versions of a PIL image.
+
+    No display version is made for images that are not taller than
+    config.IMG_DISPLAY_HEIGHT; the original is displayed as is.
+    '''
+    derivatives = {}
+    if img.size[1] > config.IMG_DISPLAY_HEIGHT:
+        derivatives['display'] = encode_image(resize_to_height(img, config.IMG_DISPLAY_HEIGHT))
+    thumbnail = img.copy()
+    thumbnail.thumbnail(config.THUMBNAIL_SIZE, PImage.BILINEAR)
+    derivatives['thumbnail'] = encode_image(thumbnail)
+    return derivatives
+
+
+def save_derivatives(image_id, img):
+    '''Store the derivatives of an image in the derivatives GridFS bucket.
+
+    Returns {kind: derivative_id} to be saved as metadata.derivatives of the
+    original file.
+    '''
+    ids = {}
+    for kind, (data, content_type) in make_derivatives(img).items():
+        ids[kind] = derivatives_fs.put(
+            data=data,
+            content_type=content_type,
+            filename=f'{image_id}_{kind}',
+            metadata={'derivative_of': image_id, 'derivative': kind}
+        )
+    return ids
+
+
+def delete_image(image_id, derivatives=None):
+    '''Delete a GridFS image, its chunks and its derivatives.'''
+    for derivative_id in (derivatives or {}).values():
+        derivatives_fs.delete(derivative_id)
+    fs.delete(image_id)
+
+
+def image_info(img, size):
+    '''Image properties stored in metadata at ingest so display never decodes pixels.'''
+    img_width, img_height = img.size
+    return {
+        'width': img_width,
+        'height': img_height,
+        'mode': img.mode,
+        'format': img.format,
+        'size': size
+    }
+
+
+def file_size(grid_out, fp=None):
+    '''(width, height) of a GridFS image from its metadata.
+
+    Files stored before the dimensions were recorded fall back to parsing the
+    image header from fp (default: the GridOut itself); pixels are not decoded.
+    '''
+    metadata = grid_out.metadata if isinstance(grid_out.metadata, dict) else {}
+    if 'width' in metadata and 'height' in metadata:
+        return metadata['width'], metadata['height']
+    return PImage.open(fp or grid_out).size
+
+
+def image_size(image_id):
+    '''(width, height) of a GridFS image read from fs.files with a projection.'''
+    doc = db.fs.files.find_one(
+        {'_id': ObjectId(image_id)}, {'metadata.width': 1, 'metadata.height': 1}
+    )
+    metadata = doc.get('metadata') or {}
+    if 'width' in metadata and 'height' in metadata:
+        return metadata['width'], metadata['height']
+    return PImage.open(fs.get(doc['_id'])).size
+
+
+def backfill_derivatives(limit=0):
+    '''Create derivatives for files in fs.files uploaded before they existed.'''
+    search_request = {'metadata.derivatives': {'$exists': False}}
+    count = 0
+    for grid_out in fs.find(search_request, no_cursor_timeout=True).limit(limit):
+        try:
+            img = PImage.open(BytesIO(grid_out.read()))
+            ids = save_derivatives(grid_out._id, img)
+        except IOError as e:
+            print(f'skipped {grid_out.filename} ({grid_out._id}): {e}')
+            continue
+        if isinstance(grid_out.metadata, dict):
+            update = {'$set': {'metadata.derivatives': ids}}
+        else:
+            update = {'$set': {'metadata': {'derivatives': ids}}}
+        db.fs.files.update_one({'_id': grid_out._id}, update)
+        count = count + 1
+    return count
+
+
+def backfill_info(batch_size=500, limit=0):
+    '''Record width, height, mode, format and size for files in fs.files that lack them.
+
+    Only the image headers are read, and updates are sent in bulk_write batches.
+    '''
+    search_request = {'metadata.width': {'$exists': False}}
+    requests = []
+    count = 0
+    for grid_out in fs.find(search_request, no_cursor_timeout=True).limit(limit):
+        try:
+            # PIL parses the header lazily; GridFS chunks past it are never fetched
+            info = image_info(PImage.open(grid_out), grid_out.length)
+        except IOError as e:
+            print(f'skipped {grid_out.filename} ({grid_out._id}): {e}')
+            continue
+        if isinstance(grid_out.metadata, dict):
+            update = {'$set': {'metadata.' + key: value for key, value in info.items()}}
+        else:
+            update = {'$set': {'metadata': info}}
+        requests.append(UpdateOne({'_id': grid_out._id}, update))
+        if len(requests) == batch_size:
+            count = count + db.fs.files.bulk_write(requests, ordered=False).modified_count
+            requests = []
+    if requests:
+        count = count + db.fs.files.bulk_write(requests, ordered=False).modified_count
+    return count
+
+
+def file_sha256(grid_out):
+    '''SHA-256 of a GridFS file, read chunk by chunk.'''
+    digest = hashlib.sha256()
+    for chunk in grid_out:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def dedup(dry_run=False):
+    '''Hash files in fs.files and collapse those with identical bytes into one.
+
+    The file that already has a hash, or else the oldest, is kept. The other
+    files' names are recorded in its metadata.aliases, their annotations are
+    moved to it, and they are deleted with their derivatives.
+    Returns (number of files hashed, number of duplicates removed).
+    '''
+    groups = {}
+    hashed = 0
+    projection = {'uploadDate': 1, 'filename': 1, 'metadata.sha256': 1}
+    for doc in db.fs.files.find({}, projection, no_cursor_timeout=True).sort('uploadDate', 1):
+        sha256 = (doc.get('metadata') or {}).get('sha256')
+        if sha256 is None:
+            sha256 = file_sha256(fs.get(doc['_id']))
+            doc['new_hash'] = True
+            hashed = hashed + 1
+        groups.setdefault(sha256, []).append(doc)
+
+    removed = 0
+    for sha256, docs in groups.items():
+        # the unique index allows one file per hash, so keep the one that already has it
+        docs.sort(key=lambda doc: doc.get('new_hash', False))
+        kept, duplicates = docs[0], docs[1:]
+        if dry_run:
+            for doc in duplicates:
+                print(f"duplicate {doc['filename']} ({doc['_id']}) of {kept['filename']} ({kept['_id']})")
+            removed = removed + len(duplicates)
+            continue
+
+        update = {}
+        duplicate_docs = []
+        if kept.get('new_hash'):
+            update['$set'] = {'metadata.sha256': sha256}
+        if duplicates:
+            duplicate_docs = list(db.fs.files.find(
+                {'_id': {'$in': [doc['_id'] for doc in duplicates]}},
+                {'filename': 1, 'metadata.derivatives': 1}
+            ))
+            annotations.reassign([doc['_id'] for doc in duplicate_docs], kept['_id'])
+            update['$addToSet'] = {
+                'metadata.aliases': {'$each': [doc['filename'] for doc in duplicate_docs]}
+            }
+        if update:
+            db.fs.files.update_one({'_id': kept['_id']}, update)
+        for doc in duplicate_docs:
+            derivatives = (doc.get('metadata') or {}).get('derivatives')
+            delete_image(doc['_id'], derivatives)
+            removed = removed + 1
+    return hashed, removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Image maintenance jobs for fs.files.')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_derivatives = subparsers.add_parser(
+        'backfill-derivatives', help='create display/thumbnail derivatives for existing files'
+    )
+    parser_derivatives.add_argument('--limit', type=int, default=0, help='max files (0: all)')
+    parser_info = subparsers.add_parser(
+        'backfill-info', help='record width/height/mode/format/size in metadata of existing files'
+    )
+    parser_info.add_argument('--batch-size', type=int, default=500, help='updates per bulk_write')
+    parser_info.add_argument('--limit', type=int, default=0, help='max files (0: all)')
+    parser_dedup = subparsers.add_parser(
+        'dedup', help='hash existing files and collapse files with identical bytes'
+    )
+    parser_dedup.add_argument('--dry-run', action='store_true', help='only list the duplicates')
+    args = parser.parse_args()
+
+    if args.command == 'backfill-derivatives':
+        print(f'created derivatives for {backfill_derivatives(args.limit)} files')
+    elif args.command == 'backfill-info':
+        print(f'recorded image info for {backfill_info(args.batch_size, args.limit)} files')
+    elif args.command == 'dedup':
+        hashed, removed = dedup(args.dry_run)
+        print(f'hashed {hashed} files, {"found" if args.dry_run else "removed"} {removed} duplicates')
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
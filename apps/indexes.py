@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+from pymongo import IndexModel
+
+from apps import config
+from apps.database import db
+
+
+logger = logging.getLogger(__name__)
+
+
+# indexes behind the app's queries, by collection
+INDEXES = {
+    'fs.files': [
+        # query_db: newest images first
+        IndexModel([('uploadDate', -1), ('_id', -1)]),
+        # query_db: csv filename filter (same keys as the index GridFS creates)
+        IndexModel([('filename', 1), ('uploadDate', 1)]),
+        # ingest: duplicate lookup; files hashed before it existed are left out
+        IndexModel(
+            [('metadata.sha256', 1)],
+            unique=True,
+            partialFilterExpression={'metadata.sha256': {'$exists': True}}
+        )
+    ],
+    'annotations': [
+        # loading an image's annotations, Batch Model's already-annotated check,
+        # Select Images label filter (on the image ids of a page)
+        IndexModel([('image_id', 1), ('source', 1)]),
+        IndexModel([('label', 1), ('image_id', 1)])
+    ],
+    'dash_job_images': [
+        IndexModel([('job_id', 1), ('image_id', 1)], unique=True),
+        # resume: images a job already finished
+        IndexModel([('job_id', 1), ('status', 1)])
+    ]
+}
+
+
+def ensure_indexes(collections=None):
+    '''Create the app's indexes (idempotent); returns {collection: [index names]}.'''
+    created = {}
+    for name, indexes in INDEXES.items():
+        if collections is None or name in collections:
+            created[name] = db[name].create_indexes(indexes)
+    return created
+
+
+def _plan_stages(plan):
+    plan = plan.get('queryPlan', plan)
+    yield plan
+    if 'inputStage' in plan:
+        yield from _plan_stages(plan['inputStage'])
+    for stage in plan.get('inputStages', []):
+        yield from _plan_stages(stage)
+
+
+def explain_summary(explain):
+    '''Index names, collection scan flag and execution counters of an explain() result.'''
+    stages = list(_plan_stages(explain['queryPlanner']['winningPlan']))
+    stats = explain.get('executionStats', {})
+    return {
+        'indexes': [stage['indexName'] for stage in stages if stage.get('stage') == 'IXSCAN'],
+        'collscan': any(stage.get('stage') == 'COLLSCAN' for stage in stages),
+        'returned': stats.get('nReturned'),
+        'keys_examined': stats.get('totalKeysExamined'),
+        'docs_examined': stats.get('totalDocsExamined'),
+        'millis': stats.get('executionTimeMillis')
+    }
+
+
+def log_plan(label, collection, filter, projection=None, sort=None, limit=0):
+    '''With config.MONGODB_EXPLAIN set, log the explain() summary of a find.
+
+    Collection scans are logged as warnings, other plans at info level.
+    '''
+    if not config.MONGODB_EXPLAIN:
+        return
+    try:
+        cursor = collection.find(filter, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        summary = explain_summary(cursor.limit(limit).explain())
+    except Exception as e:
+        logger.warning('explain %s on %s failed: %s', label, collection.name, e)
+        return
+    log = logger.warning if summary['collscan'] else logger.info
+    log(
+        'explain %s on %s: %s, %s keys / %s docs examined, %s returned in %s ms',
+        label, collection.name,
+        'COLLSCAN' if summary['collscan'] else 'IXSCAN ' + ','.join(summary['indexes']),
+        summary['keys_examined'], summary['docs_examined'], summary['returned'], summary['millis']
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create the MongoDB indexes used by the app.')
+    parser.add_argument(
+        'collections', nargs='*', help=f"collections (default: all of {', '.join(INDEXES)})"
+    )
+    args = parser.parse_args()
+
+    for name, index_names in ensure_indexes(args.collections or None).items():
+        print(f"{name}: {', '.join(index_names)}")
+
+
+if __name__ == '__main__':
+    main()
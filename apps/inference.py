@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import base64
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from bson.objectid import ObjectId
+
+from apps import config
+from apps.database import fs
+from apps import annotations, masks
+from apps.simplify import simplify_trace
+from apps.imaging import file_size
+
+
+logger = logging.getLogger(__name__)
+
+
+def model_trace(predictions, img_height, labelcolor, loaded):
+    '''Scattergl trace dict of a model's x/y point predictions (image y-axis points up).'''
+    return {
+        'x': predictions['x'].tolist(),
+        'y': (img_height-predictions['y']).tolist(),
+        'mode': 'markers',
+        'marker': {'opacity': 1, 'color': labelcolor},
+        'showlegend': True,
+        'name': loaded.run_name + ' -model',
+        'customdata': [
+            {
+                'shape_type': 'model',
+                'mlflow_path': loaded.path,
+                'mlflow_run_id': loaded.run_id
+            }
+        ],
+        'hoverinfo': 'name',
+        'visible': True,
+        'type': 'scattergl'
+    }
+
+
+def mask_trace(predictions, img_width, img_height, labelcolor, loaded):
+    '''Legend-only trace of a model's predictions rasterized into a run-length encoded mask.
+
+    The RLE is in customdata for saving; the annotator moves it into its
+    session before the trace goes into a figure (see keep_mask_in_session).
+    '''
+    mask = masks.rasterize(predictions['x'], predictions['y'], img_width, img_height)
+    return {
+        'x': [],
+        'y': [],
+        'mode': 'markers',
+        'marker': {'opacity': 1, 'color': labelcolor, 'symbol': 'square'},
+        'showlegend': True,
+        'name': loaded.run_name + ' -mask',
+        'customdata': [
+            {
+                'shape_type': 'mask',
+                'mlflow_path': loaded.path,
+                'mlflow_run_id': loaded.run_id,
+                'rle': masks.rle_encode(mask)
+            }
+        ],
+        'hoverinfo': 'name',
+        'visible': True,
+        'type': 'scattergl'
+    }
+
+
+def prediction_trace(predictions, img_width, img_height, labelcolor, loaded):
+    '''Points or mask trace of a model's predictions (config.MLFLOW_PREDICTION_DISPLAY).'''
+    if config.MLFLOW_PREDICTION_DISPLAY == 'mask':
+        return mask_trace(predictions, img_width, img_height, labelcolor, loaded)
+    return model_trace(predictions, img_height, labelcolor, loaded)
+
+
+def is_annotated(image_id, run_id):
+    '''True if the image already has an annotation from this MLflow run.'''
+    return annotations.has_source(image_id, run_id)
+
+
+def _read_image(image_id, run_id):
+    '''Read stage: GridFS read, dimensions and base64 encoding of one image.'''
+    if is_annotated(image_id, run_id):
+        return image_id, None, None
+    grid_out = fs.get(image_id)
+    img_size = file_size(grid_out)
+    return image_id, base64.encodebytes(grid_out.read()), img_size
+
+
+def _split_predictions(predictions, num_rows):
+    '''Per-image predictions of a multi-row predict() call (None if not splittable).'''
+    if num_rows == 1:
+        return [predictions]
+    if config.MLFLOW_BATCH_ROW_COLUMN not in predictions.columns:
+        return None
+    groups = dict(list(predictions.groupby(config.MLFLOW_BATCH_ROW_COLUMN)))
+    return [groups.get(row, predictions.iloc[0:0]) for row in range(num_rows)]
+
+
+class BatchInference(object):
+    '''Three overlapping stages for applying an MLflow model to many images.
+
+    1. GridFS reads and base64 encoding run in a thread pool a bounded number
+       of images ahead of the model.
+    2. Images are grouped into batches of batch_size for one predict() call.
+    3. Annotations are written back by a separate thread with bulk_write.
+    '''
+
+    def __init__(self, loaded, labelcolor, batch_size=config.MLFLOW_BATCH_SIZE,
+                 read_workers=config.MLFLOW_BATCH_READ_WORKERS):
+        self.loaded = loaded
+        self.labelcolor = labelcolor
+        self.batch_size = max(1, batch_size)
+        self.read_workers = max(1, read_workers)
+        self.counts = {'done': 0, 'skipped': 0, 'failed': 0}
+        self._lock = threading.Lock()
+
+    def run(self, image_ids, on_result=None, should_stop=None):
+        '''Predict and save annotations for image_ids.
+
+        on_result(image_id, status, error) is called as each image finishes
+        (status: done, skipped or failed); should_stop() is polled between
+        images and stops the run when it returns True, leaving the images not
+        yet predicted unreported.
+        '''
+        self.on_result = on_result
+        if should_stop is None:
+            should_stop = lambda: False
+        read_ahead = 2 * max(self.batch_size, self.read_workers)
+        image_ids = iter(image_ids)
+        with ThreadPoolExecutor(max_workers=self.read_workers) as readers, \
+                ThreadPoolExecutor(max_workers=1) as writer:
+            pending = deque()
+            writes = []
+            batch = []
+            exhausted = False
+            while pending or not exhausted:
+                if should_stop():
+                    # images still in flight are left unreported for a later resume
+                    for _, future in pending:
+                        future.cancel()
+                    batch = []
+                    break
+                while not exhausted and len(pending) < read_ahead:
+                    image_id = next(image_ids, None)
+                    if image_id is None:
+                        exhausted = True
+                        break
+                    image_id = ObjectId(image_id)
+                    pending.append((image_id, readers.submit(_read_image, image_id, self.loaded.run_id)))
+                if not pending:
+                    break
+
+                image_id, future = pending.popleft()
+                try:
+                    image_id, image_b64, img_size = future.result()
+                except Exception as e:
+                    self._report(image_id, 'failed', e)
+                    continue
+                if image_b64 is None:
+                    self._report(image_id, 'skipped')
+                    continue
+                batch.append((image_id, image_b64, img_size))
+                if len(batch) == self.batch_size:
+                    writes.append(writer.submit(self._write, self._predict(batch)))
+                    batch = []
+            if batch:
+                writes.append(writer.submit(self._write, self._predict(batch)))
+            for write in writes:
+                write.result()
+        return self.counts
+
+    def _predict(self, batch):
+        '''Model stage: one predict() call per batch (per image for unsplittable outputs).'''
+        df_img = pd.DataFrame(data=[image_b64 for _, image_b64, _ in batch], columns=['image'])
+        try:
+            per_image = _split_predictions(self.loaded.model.predict(df_img), len(batch))
+            if per_image is None:
+                logger.warning(
+                    'predictions of run %s have no %r column; predicting one image at a time',
+                    self.loaded.run_id, config.MLFLOW_BATCH_ROW_COLUMN
+                )
+                self.batch_size = 1
+                per_image = [
+                    self.loaded.model.predict(df_img.iloc[[row]]) for row in range(len(batch))
+                ]
+        except Exception as e:
+            if len(batch) == 1:
+                self._report(batch[0][0], 'failed', e)
+                return []
+            # isolate the failing image(s)
+            return [result for item in batch for result in self._predict([item])]
+        return [
+            (image_id, prediction_trace(
+                predictions, img_size[0], img_size[1], self.labelcolor, self.loaded
+            ))
+            for (image_id, _, img_size), predictions in zip(batch, per_image)
+        ]
+
+    def _write(self, results):
+        '''Write stage: append the model traces to the images' annotations.'''
+        if not results:
+            return
+        if config.SIMPLIFY_ON_SAVE:
+            results = [(image_id, simplify_trace(trace)) for image_id, trace in results]
+        try:
+            annotations.insert_traces(results)
+        except Exception as e:
+            for image_id, _ in results:
+                self._report(image_id, 'failed', e)
+            return
+        for image_id, _ in results:
+            self._report(image_id, 'done')
+
+    def _report(self, image_id, status, error=None):
+        with self._lock:
+            self.counts[status] += 1
+        if error is not None:
+            logger.warning('batch model %s failed on %s: %s', self.loaded.run_id, image_id, error)
+        if self.on_result is not None:
+            self.on_result(image_id, status, error)
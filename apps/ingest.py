@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import base64
+import hashlib
+import itertools
+import logging
+import zipfile
+from tempfile import SpooledTemporaryFile
+from PIL import Image as PImage
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from apps import config
+from apps.database import db, fs
+from apps.imaging import image_info, save_derivatives, delete_image
+
+
+logger = logging.getLogger(__name__)
+
+# (offset, magic bytes, content type) of the image formats accepted at upload
+IMAGE_SIGNATURES = [
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'BM', 'image/bmp'),
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+    (8, b'WEBP', 'image/webp'),
+]
+ZIP_SIGNATURE = b'PK\x03\x04'
+HEADER_BYTES = 16
+
+
+def sniff_content_type(header):
+    '''Image content type from a file's first HEADER_BYTES bytes (None if not an image).'''
+    for offset, magic, content_type in IMAGE_SIGNATURES:
+        if header[offset:offset + len(magic)] == magic:
+            return content_type
+    return None
+
+
+def is_zip(fp):
+    '''True if a seekable file starts with a zip local file header.'''
+    position = fp.tell()
+    header = fp.read(len(ZIP_SIGNATURE))
+    fp.seek(position)
+    return header == ZIP_SIGNATURE
+
+
+def spool(chunks):
+    '''Copy an iterable of byte chunks to a spooled temporary file, rewound.'''
+    spooled = SpooledTemporaryFile(max_size=config.UPLOAD_SPOOL_BYTES)
+    for chunk in chunks:
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled
+
+
+def iter_base64(content):
+    '''Decode a Dash upload data URI in chunks instead of one full-size copy.'''
+    data = content[content.index(';base64,') + len(';base64,'):]
+    # 4 base64 characters encode 3 bytes, so chunk boundaries stay aligned
+    step = (config.UPLOAD_CHUNK_BYTES // 3) * 4
+    for start in range(0, len(data), step):
+        yield base64.b64decode(data[start:start + step])
+
+
+def iter_chunks(fp):
+    '''Read a file object UPLOAD_CHUNK_BYTES at a time.'''
+    chunk = fp.read(config.UPLOAD_CHUNK_BYTES)
+    while chunk:
+        yield chunk
+        chunk = fp.read(config.UPLOAD_CHUNK_BYTES)
+
+
+def result(name, status, image_id=None, error=None, duplicate_of=None):
+    '''Per-file outcome of an upload (status: stored, duplicate, skipped or failed).'''
+    return {
+        'name': name,
+        'status': status,
+        'image_id': image_id,
+        'error': error,
+        'duplicate_of': duplicate_of
+    }
+
+
+def find_duplicate(sha256):
+    '''fs.files document already holding these bytes (None if they are new).'''
+    return db.fs.files.find_one({'metadata.sha256': sha256}, {'filename': 1})
+
+
+def link_duplicate(name, original):
+    '''Record a re-uploaded file's name on the original instead of storing it again.'''
+    db.fs.files.update_one(
+        {'_id': original['_id']},
+        {'$addToSet': {'metadata.aliases': name.split('.')[0]}}
+    )
+    return result(
+        name, 'duplicate', image_id=original['_id'], duplicate_of=original['filename']
+    )
+
+
+def _hashing(chunks, digest):
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+def ingest_image(name, fp, metadata):
+    '''Store one image read from fp (read once) in GridFS with its metadata and derivatives.
+
+    Images whose SHA-256 is already in fs.files are linked to the stored file
+    instead of being stored again.
+    '''
+    header = fp.read(HEADER_BYTES)
+    content_type = sniff_content_type(header)
+    if content_type is None:
+        return result(name, 'skipped', error='not a supported image type')
+
+    digest = hashlib.sha256()
+    with spool(_hashing(itertools.chain([header], iter_chunks(fp)), digest)) as spooled:
+        sha256 = digest.hexdigest()
+        original = find_duplicate(sha256)
+        if original is not None:
+            return link_duplicate(name, original)
+
+        spooled.seek(0, 2)
+        size = spooled.tell()
+        spooled.seek(0)
+        img = PImage.open(spooled)
+        image_id = ObjectId()
+        file_metadata = dict(metadata, **image_info(img, size))
+        file_metadata['sha256'] = sha256
+        file_metadata['derivatives'] = save_derivatives(image_id, img)
+
+        spooled.seek(0)
+        try:
+            with fs.new_file(
+                    _id=image_id,
+                    filename=name.split('.')[0],
+                    content_type=content_type,
+                    metadata=file_metadata
+            ) as grid_in:
+                for chunk in iter_chunks(spooled):
+                    grid_in.write(chunk)
+        except DuplicateKeyError:
+            # the same bytes were stored concurrently since find_duplicate
+            delete_image(image_id, file_metadata['derivatives'])
+            return link_duplicate(name, find_duplicate(sha256))
+    return result(name, 'stored', image_id=image_id)
+
+
+def ingest_file(name, fp, metadata, on_result=None):
+    '''Store an uploaded image or every image in an uploaded zip; returns per-file results.
+
+    on_result(result) is called as each file is stored.
+    '''
+    if not is_zip(fp):
+        results = [_ingest_safely(name, fp, metadata)]
+        if on_result is not None:
+            on_result(results[0])
+        return results
+    results = []
+    with zipfile.ZipFile(fp) as zipped_contents:
+        for info in zipped_contents.infolist():
+            if info.is_dir():
+                continue
+            with zipped_contents.open(info) as member:
+                results.append(_ingest_safely(info.filename, member, metadata))
+            if on_result is not None:
+                on_result(results[-1])
+    return results
+
+
+def _ingest_safely(name, fp, metadata):
+    try:
+        return ingest_image(name, fp, metadata)
+    except Exception as e:
+        logger.exception('failed to ingest %s', name)
+        return result(name, 'failed', error=str(e))
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import datetime
+import logging
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+
+from apps import config
+from apps.database import db, lazy_collection
+from apps.indexes import log_plan
+from apps.models import model_cache
+from apps.selection import iter_images, files_filter, label_filter, after_page_key, newest_page_key
+from apps.inference import BatchInference
+
+
+logger = logging.getLogger(__name__)
+
+# job documents: run_id, labelcolor, query (of the Select Images table, see
+# apps/selection.py), newest (page key of its first image at submit time), total,
+# status, counts, cancel_requested, updated (heartbeat)
+jobs = lazy_collection('dash_jobs')
+# one document per (job_id, image_id) with the image's status and error
+job_images = lazy_collection('dash_job_images')
+
+FINISHED = ('completed', 'cancelled', 'failed')
+
+
+class JobProgress(object):
+    '''Buffers per-image results of a running job and flushes them to MongoDB.'''
+
+    def __init__(self, job_id, flush_every=100, flush_seconds=1.0):
+        self.job_id = job_id
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self._results = []
+        self._flushed = time.time()
+        self._checked = 0
+        self._cancelled = False
+        self._lock = threading.Lock()
+
+    def add(self, image_id, status, error=None):
+        with self._lock:
+            self._results.append((image_id, status, error))
+            if (len(self._results) >= self.flush_every) \
+                    or (time.time() - self._flushed > self.flush_seconds):
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        results, self._results = self._results, []
+        self._flushed = time.time()
+        if not results:
+            return
+        job_images.bulk_write([
+            UpdateOne(
+                {'job_id': self.job_id, 'image_id': image_id},
+                {'$set': {'status': status, 'error': None if error is None else str(error)}},
+                upsert=True
+            ) for image_id, status, error in results
+        ], ordered=False)
+        inc = {}
+        for _, status, _ in results:
+            inc[f'counts.{status}'] = inc.get(f'counts.{status}', 0) + 1
+        jobs.update_one(
+            {'_id': self.job_id},
+            {'$inc': inc, '$set': {'updated': datetime.datetime.utcnow()}}
+        )
+
+    def cancelled(self, force=False):
+        '''True once cancellation was requested (the job document is read at most every 0.5 s).'''
+        if not self._cancelled and (force or time.time() - self._checked > 0.5):
+            self._checked = time.time()
+            job = jobs.find_one({'_id': self.job_id}, {'cancel_requested': 1})
+            self._cancelled = bool(job.get('cancel_requested'))
+        return self._cancelled
+
+
+class Heartbeat(object):
+    '''Advances the updated field of a running job every interval seconds.
+
+    Progress is only flushed as images finish, so a job loading its model or
+    predicting a slow batch would otherwise look interrupted to resume().
+    '''
+
+    def __init__(self, job_id, interval=config.JOB_HEARTBEAT_SECONDS):
+        self.job_id = job_id
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                jobs.update_one(
+                    {'_id': self.job_id, 'status': 'running'},
+                    {'$set': {'updated': datetime.datetime.utcnow()}}
+                )
+            except Exception:
+                logger.exception('heartbeat of batch model job %s failed', self.job_id)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def unfinished_image_ids(job, batch_size=1000):
+    '''Ids of the images of a job's query it has not finished yet, in table order.
+
+    The query is read in batches (see apps.selection.iter_images) from the
+    job's newest image, so images uploaded after the job was submitted are
+    not part of it, and each batch is checked against the job's finished
+    images, so memory does not grow with the number of images. total is
+    recorded once the query is exhausted if it was not known at submit time.
+    '''
+    if ('newest' in job) and (job['newest'] is None):
+        # the query matched no images at submit time
+        image_ids = iter([])
+    elif 'query' in job:
+        images = iter_images(
+            job['query'], projection={'_id': 1}, batch_size=batch_size, newest=job.get('newest')
+        )
+        image_ids = (doc['_id'] for doc in itertools.islice(images, job['query']['num_imgs'] or None))
+    else:
+        # jobs submitted before the query was recorded
+        image_ids = iter(job['image_ids'])
+    count = 0
+    while True:
+        batch = list(itertools.islice(image_ids, batch_size))
+        count = count + len(batch)
+        if batch:
+            search_request = {
+                'job_id': job['_id'], 'image_id': {'$in': batch}, 'status': {'$in': ['done', 'skipped']}
+            }
+            log_plan('unfinished_image_ids', job_images, search_request, {'_id': 0, 'image_id': 1})
+            finished = set(job_images.distinct('image_id', search_request))
+            yield from (image_id for image_id in batch if image_id not in finished)
+        if len(batch) < batch_size:
+            break
+    if job.get('total') is None:
+        jobs.update_one({'_id': job['_id']}, {'$set': {'total': count}})
+
+
+def run_job(job_id):
+    '''Run (or resume) a Batch Model job; images already finished by it are skipped.'''
+    job = jobs.find_one({'_id': job_id})
+    jobs.update_one(
+        {'_id': job_id},
+        {'$set': {'status': 'running', 'updated': datetime.datetime.utcnow()}}
+    )
+    progress = JobProgress(job_id)
+    with Heartbeat(job_id):
+        try:
+            loaded = model_cache.get(job['run_id'])
+            BatchInference(loaded, job['labelcolor']).run(
+                unfinished_image_ids(job), on_result=progress.add, should_stop=progress.cancelled
+            )
+            status = 'cancelled' if progress.cancelled(force=True) else 'completed'
+            error = None
+        except Exception as e:
+            logger.exception('batch model job %s failed', job_id)
+            status = 'failed'
+            error = str(e)
+        progress.flush()
+    jobs.update_one(
+        {'_id': job_id},
+        {'$set': {'status': status, 'error': error, 'updated': datetime.datetime.utcnow()}}
+    )
+
+
+class JobManager(object):
+    '''Runs Batch Model jobs (and other long tasks) in a thread pool or a pool of spawned processes.'''
+
+    def __init__(self, executor=config.JOB_EXECUTOR, workers=config.JOB_WORKERS):
+        self.executor = executor
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def run_in_background(self, func, *args):
+        '''Queue func(*args); with the process executor func must be a module-level function.'''
+        with self._lock:
+            if self._pool is None:
+                if self.executor == 'process':
+                    # spawned (not forked) so each process opens its own MongoClient
+                    self._pool = multiprocessing.get_context('spawn').Pool(self.workers)
+                else:
+                    self._pool = ThreadPoolExecutor(max_workers=self.workers)
+            if self.executor == 'process':
+                self._pool.apply_async(func, args)
+            else:
+                self._pool.submit(func, *args)
+
+    def submit(self, run_id, query, labelcolor):
+        '''Record a new job over the images of a Select Images query and queue it; returns the job id.
+
+        The query is stored rather than its image ids, which could exceed the
+        BSON document limit; the runner reads the ids in batches, starting at
+        the query's newest image at submit time.
+        '''
+        now = datetime.datetime.utcnow()
+        query = {key: query.get(key) for key in ('num_imgs', 'filenames', 'filter_label')}
+        newest = newest_page_key(query)
+        total = None
+        if newest is None:
+            total = 0
+        elif label_filter(query) is None:
+            # without a label filter the image count is one indexed count
+            search = {'$and': [files_filter(query), after_page_key(newest, inclusive=True)]}
+            # num_imgs 0 means all images (a $limit of 0 is rejected by the server)
+            limit = {'limit': query['num_imgs']} if query['num_imgs'] else {}
+            total = db.fs.files.count_documents(search, **limit)
+        job_id = jobs.insert_one({
+            'run_id': run_id,
+            'labelcolor': labelcolor,
+            'query': query,
+            'newest': newest,
+            'total': total,
+            'counts': {'done': 0, 'skipped': 0, 'failed': 0},
+            'status': 'queued',
+            'cancel_requested': False,
+            'created': now,
+            'updated': now
+        }).inserted_id
+        self.run_in_background(run_job, job_id)
+        return job_id
+
+    def resume(self, job_id):
+        '''Re-queue a finished or interrupted job; only its unfinished and failed images are redone.'''
+        job_id = ObjectId(job_id)
+        stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=config.JOB_STALE_SECONDS)
+        result = jobs.update_one(
+            {'_id': job_id, '$or': [
+                {'status': {'$in': list(FINISHED)}},
+                # interrupted by a server restart
+                {'status': 'running', 'updated': {'$lt': stale}}
+            ]},
+            {'$set': {'status': 'queued', 'cancel_requested': False},
+             '$unset': {'counts.failed': ''}}
+        )
+        if result.matched_count:
+            job_images.delete_many({'job_id': job_id, 'status': 'failed'})
+            self.run_in_background(run_job, job_id)
+
+    def cancel(self, job_id):
+        '''Ask a queued or running job to stop after the images in flight.'''
+        jobs.update_one(
+            {'_id': ObjectId(job_id), 'status': {'$nin': list(FINISHED)}},
+            {'$set': {'cancel_requested': True}}
+        )
+
+    def status(self, job_id):
+        '''Job document without its image list (of jobs submitted before queries were stored).'''
+        return jobs.find_one({'_id': ObjectId(job_id)}, {'image_ids': 0})
+
+
+job_manager = JobManager()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+from io import BytesIO
+import numpy as np
+from PIL import Image as PImage
+from bson.binary import Binary
+
+from apps import config
+
+
+# Masks are run-length encoded like COCO's uncompressed RLE: column-major
+# runs alternating between 0 and 1, starting with a (possibly empty) run of 0.
+
+
+def rasterize(x, y, width, height):
+    '''Boolean mask (height x width) of predicted pixel coordinates (row y from the top).'''
+    mask = np.zeros((height, width), dtype=bool)
+    cols = np.round(np.asarray(x, dtype=np.float64)).astype(np.int64)
+    rows = np.round(np.asarray(y, dtype=np.float64)).astype(np.int64)
+    inside = (cols >= 0) & (cols < width) & (rows >= 0) & (rows < height)
+    mask[rows[inside], cols[inside]] = True
+    return mask
+
+
+def rle_encode(mask):
+    '''{'size': [height, width], 'counts': [run lengths]} of a boolean mask.'''
+    flat = mask.ravel(order='F')
+    if len(flat) == 0:
+        return {'size': list(mask.shape), 'counts': []}
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate([[0], changes, [len(flat)]]))
+    if flat[0]:
+        counts = np.concatenate([[0], counts])
+    return {'size': list(mask.shape), 'counts': counts.tolist()}
+
+
+def rle_decode(rle):
+    '''Boolean mask of an RLE.'''
+    height, width = rle['size']
+    counts = np.asarray(rle['counts'], dtype=np.int64)
+    values = np.arange(len(counts)) % 2 == 1
+    flat = np.repeat(values, counts)
+    return flat.reshape((height, width), order='F')
+
+
+def rle_area(rle):
+    '''Number of mask pixels.'''
+    return int(np.sum(np.asarray(rle['counts'], dtype=np.int64)[1::2]))
+
+
+def rle_bbox(rle):
+    '''[x0, y0, x1, y1] of an RLE in figure coordinates (y axis pointing up).'''
+    mask = rle_decode(rle)
+    height = mask.shape[0]
+    cols = np.flatnonzero(mask.any(axis=0))
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(cols) == 0:
+        return None
+    return [int(cols[0]), int(height - rows[-1] - 1), int(cols[-1] + 1), int(height - rows[0])]
+
+
+def rle_to_doc(rle):
+    '''RLE with its counts packed into BSON binary.'''
+    return {'size': rle['size'], 'counts': Binary(np.asarray(rle['counts'], dtype='<u4').tobytes())}
+
+
+def rle_from_doc(doc):
+    return {'size': doc['size'], 'counts': np.frombuffer(doc['counts'], dtype='<u4')}
+
+
+def parse_color(color):
+    '''(r, g, b) of an 'rgb(r,g,b)' or '#rrggbb' color.'''
+    if color.startswith('#'):
+        return tuple(int(color[i:i+2], 16) for i in (1, 3, 5))
+    return tuple(int(float(value)) for value in re.findall(r'[\d.]+', color)[:3])
+
+
+def mask_png(mask, color, opacity=None, height=None):
+    '''Semi-transparent RGBA PNG of a mask in a color, downscaled to height if it is taller.
+
+    A downscaled pixel is drawn if any mask pixel falls into it, so thin
+    structures stay visible at display resolution.
+    '''
+    if opacity is None:
+        opacity = config.MASK_OPACITY
+    if (height is not None) and (mask.shape[0] > height):
+        width = max(1, int(round(mask.shape[1]*height/mask.shape[0])))
+        coverage = PImage.fromarray(mask.astype(np.uint8)*255).resize((width, height), PImage.BOX)
+        mask = np.asarray(coverage) > 0
+    rgba = np.zeros(mask.shape + (4,), dtype=np.uint8)
+    rgba[mask] = parse_color(color) + (int(round(opacity*255)),)
+    buf = BytesIO()
+    PImage.fromarray(rgba, 'RGBA').save(buf, format='PNG', optimize=True)
+    return buf.getvalue()
+
+
+def mask_url(annotation_id):
+    '''URL of the PNG overlay of a stored mask annotation.'''
+    return f'/masks/{annotation_id}.png'
+
+
+def preview_url(session_id, key):
+    '''URL of the PNG overlay of an unsaved mask kept in an annotator session.'''
+    return f'/masks/preview/{session_id}/{key}.png'
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+import flask
+import dash
+from dash.exceptions import PreventUpdate
+
+from apps import config
+from app import app
+
+
+logger = logging.getLogger(__name__)
+
+# Metrics are kept per server process; with several workers Prometheus
+# scrapes each one (or aggregates them through the 'instance' label).
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+CALLBACK_URL = '/_dash-update-component'
+
+
+class Histogram(object):
+    '''Prometheus histogram with labels (only what the /metrics route needs).'''
+
+    def __init__(self, name, help_text, labelnames, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0]*len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                label_text = ','.join(
+                    f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, labels)
+                )
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {bucket_count}')
+                lines.append(f'{self.name}_bucket{{{label_text},le="+Inf"}} {count}')
+                lines.append(f'{self.name}_sum{{{label_text}}} {total}')
+                lines.append(f'{self.name}_count{{{label_text}}} {count}')
+        return '\n'.join(lines)
+
+
+class Counter(object):
+    '''Prometheus counter with labels.'''
+
+    def __init__(self, name, help_text, labelnames):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                label_text = ','.join(
+                    f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, labels)
+                )
+                lines.append(f'{self.name}{{{label_text}}} {value}')
+        return '\n'.join(lines)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+callback_seconds = Histogram(
+    'dash_callback_duration_seconds', 'Wall time of the callback function by triggering input.',
+    ('callback', 'trigger'), DURATION_BUCKETS
+)
+phase_seconds = Histogram(
+    'dash_callback_phase_duration_seconds',
+    'Wall time of named phases of a callback (serialize: request handling outside the callback, '
+    'mostly JSON encoding of the response).',
+    ('callback', 'phase'), DURATION_BUCKETS
+)
+request_seconds = Histogram(
+    'dash_callback_request_duration_seconds', 'Wall time of the callback request in the server.',
+    ('callback',), DURATION_BUCKETS
+)
+request_bytes = Histogram(
+    'dash_callback_request_bytes', 'Body size of callback requests.', ('callback',), BYTES_BUCKETS
+)
+response_bytes = Histogram(
+    'dash_callback_response_bytes', 'Body size of callback responses.', ('callback',), BYTES_BUCKETS
+)
+callback_errors = Counter(
+    'dash_callback_errors_total', 'Callbacks that raised an exception.', ('callback', 'trigger')
+)
+METRICS = (callback_seconds, phase_seconds, request_seconds, request_bytes, response_bytes, callback_errors)
+
+_local = threading.local()
+
+
+class CallbackRecord(object):
+    '''Timing of one callback call, completed when its response is sent.'''
+
+    def __init__(self, name, trigger):
+        self.name = name
+        self.trigger = trigger
+        self.seconds = 0.0
+        self.phases = []
+
+
+@contextmanager
+def phase(name):
+    '''Time a named phase of the running callback (no-op outside callbacks).'''
+    record = getattr(_local, 'record', None)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if record is not None:
+            record.phases.append((name, time.perf_counter() - start))
+
+
+def instrument(func):
+    '''Record the wall time, phases and triggering input of a Dash callback.
+
+    Applied below @app.callback; the request and response sizes and the
+    serialization time are added when the response is sent.
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        triggered = dash.callback_context.triggered
+        trigger = triggered[0]['prop_id'] if triggered else ''
+        record = CallbackRecord(func.__name__, trigger)
+        _local.record = record
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except PreventUpdate:
+            raise
+        except Exception:
+            callback_errors.inc(record.name, record.trigger)
+            raise
+        finally:
+            record.seconds = time.perf_counter() - start
+            _local.record = None
+            if flask.has_request_context():
+                flask.g.callback_record = record
+    return wrapper
+
+
+@app.server.before_request
+def _start_timer():
+    if flask.request.path == CALLBACK_URL:
+        flask.g.callback_start = time.perf_counter()
+
+
+@app.server.after_request
+def _record_callback(response):
+    record = flask.g.pop('callback_record', None)
+    if record is None:
+        return response
+    total = time.perf_counter() - flask.g.pop('callback_start', time.perf_counter())
+    size = 0 if response.is_streamed else response.content_length or len(response.get_data())
+    callback_seconds.observe(record.seconds, record.name, record.trigger)
+    for name, seconds in record.phases:
+        phase_seconds.observe(seconds, record.name, name)
+    phase_seconds.observe(max(total - record.seconds, 0.0), record.name, 'serialize')
+    request_seconds.observe(total, record.name)
+    request_bytes.observe(flask.request.content_length or 0, record.name)
+    response_bytes.observe(size, record.name)
+    if config.SLOW_CALLBACK_MS and (total*1000 >= config.SLOW_CALLBACK_MS):
+        logger.warning(
+            'slow callback %s (%s): %.0f ms, %s, serialize %.0f ms, request %d bytes, response %d bytes',
+            record.name, record.trigger, total*1000,
+            ', '.join(f'{name} {seconds*1000:.0f} ms' for name, seconds in record.phases) or 'no phases',
+            (total - record.seconds)*1000, flask.request.content_length or 0, size
+        )
+    return response
+
+
+@app.server.route('/metrics')
+def serve_metrics():
+    '''Callback metrics of this process in the Prometheus text format.'''
+    text = '\n'.join(metric.render() for metric in METRICS) + '\n'
+    return flask.Response(text, mimetype='text/plain; version=0.0.4')
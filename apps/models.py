@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from apps import config
+
+
+_mlflow = None
+_mlflow_lock = threading.Lock()
+
+
+def mlflow_module():
+    '''The mlflow package, imported and pointed at config.MLFLOW_URI on first use.
+
+    mlflow (and the TensorFlow/Keras its models load) takes seconds to import,
+    so it stays out of server startup and of deployments without MLFLOW_URI.
+    '''
+    global _mlflow
+    with _mlflow_lock:
+        if _mlflow is None:
+            import mlflow
+            import mlflow.pyfunc
+            if config.MLFLOW_URI is not None:
+                mlflow.tracking.set_tracking_uri(config.MLFLOW_URI)
+            _mlflow = mlflow
+    return _mlflow
+
+
+def mlflow_client():
+    return mlflow_module().tracking.MlflowClient()
+
+
+LoadedModel = namedtuple('LoadedModel', ['run_id', 'path', 'run_name', 'model'])
+
+
+class ModelCache(object):
+    '''LRU cache of loaded MLflow pyfunc models keyed by (run_id, artifact path).
+
+    Concurrent requests for a model that is still loading wait for that load
+    instead of starting another one.
+    '''
+
+    def __init__(self, max_models):
+        self.max_models = max_models
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._models = OrderedDict()
+        self._paths = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def pyfunc_path(self, run_id):
+        '''Artifact path of the run's pyfunc model.'''
+        if run_id not in self._paths:
+            artifacts = mlflow_client().list_artifacts(run_id=run_id)
+            self._paths[run_id] = [
+                artifact.path for artifact in artifacts if 'pyfunc' in artifact.path
+            ][0]
+        return self._paths[run_id]
+
+    def get(self, run_id, path=None):
+        '''Loaded model of an MLflow run (loading it on a miss).'''
+        if path is None:
+            path = self.pyfunc_path(run_id)
+        key = (run_id, path)
+        with self._lock:
+            future = self._models.get(key)
+            if future is not None:
+                self._models.move_to_end(key)
+                self.hits += 1
+                loading = False
+            else:
+                future = self._models[key] = Future()
+                self.misses += 1
+                loading = True
+                self._evict()
+
+        if loading:
+            try:
+                run_dict = mlflow_client().get_run(run_id=run_id).to_dictionary()
+                model = mlflow_module().pyfunc.load_model(model_uri=f'runs:/{run_id}/{path}')
+            except Exception as e:
+                with self._lock:
+                    self._models.pop(key, None)
+                future.set_exception(e)
+                raise
+            future.set_result(
+                LoadedModel(run_id, path, run_dict['data']['tags']['mlflow.runName'], model)
+            )
+        return future.result()
+
+    def put(self, run_id, path, run_name, model):
+        '''Add an already loaded model (e.g. a local stand-in for a run's pyfunc model).'''
+        future = Future()
+        future.set_result(LoadedModel(run_id, path, run_name, model))
+        with self._lock:
+            self._paths[run_id] = path
+            self._models[(run_id, path)] = future
+            self._models.move_to_end((run_id, path))
+            self._evict()
+
+    def warm_up(self, run_id):
+        '''Load a run's model in the background; returns a Future of the LoadedModel.'''
+        return self._executor.submit(self.get, run_id)
+
+    def _evict(self):
+        # called with self._lock held; models still loading are never evicted
+        for key in list(self._models):
+            if len(self._models) <= self.max_models:
+                break
+            if self._models[key].done():
+                del self._models[key]
+                self.evictions += 1
+
+    def stats(self):
+        '''Hit/miss/eviction counters and the resident models.'''
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'models': [list(key) for key in self._models],
+                'max_models': self.max_models
+            }
+
+
+model_cache = ModelCache(config.MLFLOW_MODEL_CACHE_SIZE)
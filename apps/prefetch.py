@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from bson.objectid import ObjectId
+
+from apps import config
+from apps.database import db, fs
+from apps.images import image_cache
+
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher(object):
+    '''Loads the images after the selected one into the image cache in the background.
+
+    Each image is read from GridFS once: images uploaded with derivatives
+    are served from GridFS as they are, so they are left to browser preload
+    hints; older images are decoded and resized here so their /display
+    request is a cache hit. Each session has at most one batch of
+    prefetches queued: a new selection cancels the prefetches of the
+    previous one that have not started.
+    '''
+
+    def __init__(self, workers, cache):
+        self.workers = workers
+        self.cache = cache
+        self.loaded = 0
+        self.cancelled = 0
+        self.failed = 0
+        self._pending = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def prefetch(self, session_id, image_ids):
+        '''Queue image_ids (next rows first) for session_id, replacing its earlier batch.
+
+        Returns the image ids left to the browser to preload, in order.
+        '''
+        cached_ids = set()
+        if (self.workers > 0) and image_ids:
+            # /display of images with derivatives never goes through the image cache
+            cached_ids = {
+                str(doc['_id']) for doc in db.fs.files.find(
+                    {'_id': {'$in': [ObjectId(image_id) for image_id in image_ids]},
+                     'metadata.derivatives': {'$exists': False}},
+                    {'_id': 1}
+                )
+            }
+        with self._lock:
+            for future in self._pending.pop(session_id, []):
+                if future.cancel():
+                    self.cancelled += 1
+            # forget sessions whose prefetches have all finished
+            for other in [key for key, futures in self._pending.items() if all(f.done() for f in futures)]:
+                del self._pending[other]
+            if cached_ids:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers)
+                self._pending[session_id] = [
+                    self._executor.submit(self._load, image_id)
+                    for image_id in image_ids if str(image_id) in cached_ids
+                ]
+        return [image_id for image_id in image_ids if str(image_id) not in cached_ids]
+
+    def _load(self, image_id):
+        try:
+            self.cache.get_display(fs.get(ObjectId(image_id)))
+            with self._lock:
+                self.loaded += 1
+        except Exception:
+            logger.exception('prefetch of image %s failed', image_id)
+            with self._lock:
+                self.failed += 1
+
+    def stats(self):
+        '''Loaded/cancelled/failed counters and the number of queued or running prefetches.'''
+        with self._lock:
+            return {
+                'loaded': self.loaded,
+                'cancelled': self.cancelled,
+                'failed': self.failed,
+                'pending': sum(not future.done() for futures in self._pending.values() for future in futures)
+            }
+
+
+prefetcher = Prefetcher(config.PREFETCH_WORKERS, image_cache)
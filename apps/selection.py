@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import datetime
+from bson.objectid import ObjectId
+
+from apps.database import db
+from apps import annotations
+from apps.indexes import log_plan
+
+
+# Select Images rows: newest first, paged by (uploadDate, _id) keys
+FILENAMES_SORT = [('uploadDate', -1), ('_id', -1)]
+FILENAMES_PROJECTION = {'filename': 1, 'contentType': 1, 'uploadDate': 1, 'metadata.comments': 1}
+PAGE_KEY_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+# fs.files rows read per annotations lookup of the label filter
+LABEL_FILTER_BATCH = 500
+
+
+def files_filter(query):
+    '''fs.files filter of a Select Images query (all but its annotation label filter).'''
+    if query.get('filenames'):
+        return {'filename': {'$in': query['filenames']}}
+    return {}
+
+
+def label_filter(query):
+    '''(annotation name regex, exclude) of a query's label filter ('!label' excludes), or None.'''
+    filter_label = query.get('filter_label')
+    if not filter_label:
+        return None
+    if filter_label[0] == '!':
+        return re.compile(filter_label[1:], re.IGNORECASE), True
+    return re.compile(filter_label, re.IGNORECASE), False
+
+
+def page_key(doc):
+    '''JSON-serializable (uploadDate, _id) key of a row.'''
+    return [doc['uploadDate'].strftime(PAGE_KEY_DATE_FORMAT), str(doc['_id'])]
+
+
+def after_page_key(key, inclusive=False):
+    '''Filter for the rows following a page key in FILENAMES_SORT order (and its own row if inclusive).'''
+    upload_date = datetime.datetime.strptime(key[0], PAGE_KEY_DATE_FORMAT)
+    id_ = ObjectId(key[1])
+    return {'$or': [
+        {'uploadDate': {'$lt': upload_date}},
+        {'uploadDate': upload_date, '_id': {'$lte' if inclusive else '$lt': id_}}
+    ]}
+
+
+def newest_page_key(query):
+    '''Page key of the first row of a query's fs.files filter (None if it matches no images).'''
+    doc = db.fs.files.find_one(files_filter(query), {'uploadDate': 1}, sort=FILENAMES_SORT)
+    if doc is None:
+        return None
+    return page_key(doc)
+
+
+def iter_images(query, after=None, projection=None, batch_size=LABEL_FILTER_BATCH, newest=None):
+    '''fs.files documents of a Select Images query in FILENAMES_SORT order.
+
+    Rows are read batch_size at a time, each batch one indexed query starting
+    after the (uploadDate, _id) key of the previous one (or after). Without
+    after, rows start at the page key newest (see newest_page_key), which
+    leaves out images uploaded since it was taken. The label filter is
+    joined on each batch with one annotations query on its image ids, so
+    neither side is ever read in full.
+    '''
+    projection = dict(projection or FILENAMES_PROJECTION, uploadDate=1)
+    label = label_filter(query)
+    bound = None
+    if after is not None:
+        bound = after_page_key(after)
+    elif newest is not None:
+        bound = after_page_key(newest, inclusive=True)
+    while True:
+        search = files_filter(query)
+        if bound is not None:
+            search = {'$and': [search, bound]}
+        log_plan('iter_images', db.fs.files, search, projection, FILENAMES_SORT, batch_size)
+        docs = list(db.fs.files.find(search, projection).sort(FILENAMES_SORT).limit(batch_size))
+        if not docs:
+            return
+        bound = after_page_key(page_key(docs[-1]))
+        last_batch = len(docs) < batch_size
+        if label is not None:
+            pattern, exclude = label
+            matched = annotations.image_ids_with_name(pattern, [doc['_id'] for doc in docs])
+            docs = [doc for doc in docs if (doc['_id'] in matched) != exclude]
+        yield from docs
+        if last_batch:
+            return
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import uuid
+import time
+import datetime
+import tempfile
+import threading
+from collections import OrderedDict
+
+from apps import config
+from apps.database import lazy_collection
+
+
+def _check_session_id(session_id):
+    '''Session ids are uuid4 strings generated by the annotator page.'''
+    return str(uuid.UUID(session_id))
+
+
+class MemorySessionStore(object):
+    '''Per-process session store; only suitable for a single server worker.'''
+
+    def __init__(self, max_sessions=config.SESSION_MEMORY_MAX):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            state = self._sessions.get(session_id)
+            if state is not None:
+                self._sessions.move_to_end(session_id)
+            return state
+
+    def set(self, session_id, state):
+        with self._lock:
+            self._sessions[session_id] = state
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+class FileSessionStore(object):
+    '''One JSON file per session, shared by the workers of one host.'''
+
+    def __init__(self, directory=config.SESSION_DIR, ttl=config.SESSION_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, session_id):
+        return os.path.join(self.directory, _check_session_id(session_id) + '.json')
+
+    def get(self, session_id):
+        path = self._path(session_id)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def set(self, session_id, state):
+        path = self._path(session_id)
+        # write then rename so concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+    def delete(self, session_id):
+        try:
+            os.remove(self._path(session_id))
+        except FileNotFoundError:
+            pass
+
+
+class MongoSessionStore(object):
+    '''Sessions in a MongoDB collection, expired by a TTL index.'''
+
+    def __init__(self, collection, ttl=config.SESSION_TTL):
+        self.collection = collection
+        self.collection.create_index('updated', expireAfterSeconds=ttl)
+
+    def get(self, session_id):
+        doc = self.collection.find_one({'_id': _check_session_id(session_id)}, {'state': 1})
+        if doc is None:
+            return None
+        return doc['state']
+
+    def set(self, session_id, state):
+        self.collection.replace_one(
+            {'_id': _check_session_id(session_id)},
+            {'state': state, 'updated': datetime.datetime.utcnow()},
+            upsert=True
+        )
+
+    def delete(self, session_id):
+        self.collection.delete_one({'_id': _check_session_id(session_id)})
+
+
+def make_session_store(backend=config.SESSION_BACKEND):
+    '''Session store selected by config.SESSION_BACKEND.'''
+    if backend == 'memory':
+        return MemorySessionStore()
+    if backend == 'file':
+        return FileSessionStore()
+    if backend == 'mongo':
+        return MongoSessionStore(lazy_collection('dash_sessions'))
+    raise ValueError(f'unknown SESSION_BACKEND: {backend}')
+
+
+session_store = make_session_store()
+
+
+def new_session_id():
+    return str(uuid.uuid4())
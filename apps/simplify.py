@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from apps import config
+from apps.annotations import label_of
+
+
+def _segment_distances(points, a, b):
+    '''Distances of points (n x 2) to the segment a-b.'''
+    ab = b - a
+    length2 = ab.dot(ab)
+    if length2 == 0:
+        return np.hypot(*(points - a).T)
+    t = np.clip((points - a).dot(ab)/length2, 0, 1)
+    return np.hypot(*(points - a - t[:, None]*ab).T)
+
+
+def douglas_peucker(x, y, tolerance):
+    '''Indices of the polyline points kept by Ramer-Douglas-Peucker.
+
+    Points closer than tolerance (image pixels) to the simplified line are
+    dropped; the distances of each segment's points are computed in one
+    NumPy operation.
+    '''
+    num_points = len(x)
+    if (num_points < 3) or (tolerance <= 0):
+        return np.arange(num_points)
+    points = np.column_stack([x, y]).astype(np.float64)
+    keep = np.zeros(num_points, dtype=bool)
+    keep[0] = keep[-1] = True
+    segments = [(0, num_points - 1)]
+    while segments:
+        start, end = segments.pop()
+        if end - start < 2:
+            continue
+        distances = _segment_distances(points[start+1:end], points[start], points[end])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            farthest = farthest + start + 1
+            keep[farthest] = True
+            segments.append((start, farthest))
+            segments.append((farthest, end))
+    return np.flatnonzero(keep)
+
+
+def thin_points(x, y, tolerance):
+    '''Indices of the points kept when a point cloud is thinned to one point per tolerance-sized cell.'''
+    if tolerance <= 0:
+        return np.arange(len(x))
+    if len(x) == 0:
+        return np.arange(0)
+    cells = np.floor(np.column_stack([x, y])/tolerance).astype(np.int64)
+    cells -= cells.min(axis=0)
+    # one integer per cell so np.unique works on a flat array
+    keys = cells[:, 0]*(cells[:, 1].max() + 1) + cells[:, 1]
+    _, index = np.unique(keys, return_index=True)
+    return np.sort(index)
+
+
+def tolerance_for(name):
+    '''Simplification tolerance of a trace name's label (config.SIMPLIFY_LABEL_TOLERANCES).'''
+    return config.SIMPLIFY_LABEL_TOLERANCES.get(label_of(name), config.SIMPLIFY_TOLERANCE)
+
+
+def simplify_points(x, y, shape_type, tolerance):
+    '''Simplified x/y lists of a lasso line/polygon or a model point cloud (others unchanged).'''
+    if shape_type in ('line', 'polygon'):
+        index = douglas_peucker(x, y, tolerance)
+    elif shape_type == 'model':
+        index = thin_points(x, y, tolerance)
+    else:
+        return x, y
+    if len(index) == len(x):
+        return x, y
+    return np.asarray(x)[index].tolist(), np.asarray(y)[index].tolist()
+
+
+def simplify_trace(trace, tolerance=None):
+    '''Trace with simplified coordinates, at its label's tolerance unless one is given.'''
+    if tolerance is None:
+        tolerance = tolerance_for(trace['name'])
+    shape_type = (trace.get('customdata') or [{}])[0].get('shape_type')
+    x, y = simplify_points(trace['x'], trace['y'], shape_type, tolerance)
+    if x is trace['x']:
+        return trace
+    return dict(trace, x=x, y=y)
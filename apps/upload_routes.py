@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+import flask
+
+from apps import config
+from apps.ingest import ingest_file, iter_chunks
+from apps.jobs import JobManager
+from app import app
+
+
+logger = logging.getLogger(__name__)
+
+# separate from the Batch Model jobs, so ingestion does not wait behind a model run
+ingest_jobs = JobManager(workers=config.UPLOAD_INGEST_WORKERS)
+
+
+# appends to the same partial upload are serialized within a process; the
+# offset check rejects out-of-order chunks from other processes
+_append_lock = threading.Lock()
+
+# upload status in its JSON description: receiving -> ingesting -> completed/failed
+FINISHED = ('completed', 'failed')
+
+
+def _paths(upload_id):
+    '''Partial file, JSON description and ingestion lock of an upload.'''
+    try:
+        upload_id = str(uuid.UUID(upload_id))
+    except ValueError:
+        flask.abort(404)
+    base = os.path.join(config.UPLOAD_DIR, upload_id)
+    return base + '.part', base + '.json', base + '.lock'
+
+
+def _write(meta_path, upload):
+    # replaced atomically: other workers read it while the upload is ingested
+    upload = {key: value for key, value in upload.items() if key != 'offset'}
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(upload, f)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+def _load(upload_id):
+    part_path, meta_path, _ = _paths(upload_id)
+    try:
+        with open(meta_path) as f:
+            upload = json.load(f)
+    except FileNotFoundError:
+        flask.abort(404)
+    try:
+        upload['offset'] = os.path.getsize(part_path)
+    except FileNotFoundError:
+        # removed once ingested
+        upload['offset'] = upload['size']
+    return upload
+
+
+def _remove_stale_uploads():
+    '''Remove the files of uploads none of whose files changed for config.UPLOAD_TTL.'''
+    now = time.time()
+    uploads = {}
+    for name in os.listdir(config.UPLOAD_DIR):
+        path = os.path.join(config.UPLOAD_DIR, name)
+        try:
+            uploads.setdefault(name.split('.')[0], []).append((path, os.path.getmtime(path)))
+        except FileNotFoundError:
+            pass
+    for files in uploads.values():
+        if now - max(mtime for _, mtime in files) > config.UPLOAD_TTL:
+            for path, _ in files:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+def _claim(lock_path):
+    '''True if this process may ingest the upload (its lock was free or abandoned).'''
+    for _ in range(2):
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                # the ingesting process touches the lock after each file
+                if time.time() - os.path.getmtime(lock_path) <= config.UPLOAD_INGEST_STALE:
+                    return False
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+    return False
+
+
+def _unlock(lock_path):
+    try:
+        os.remove(lock_path)
+    except FileNotFoundError:
+        pass
+
+
+@app.server.route('/uploads', methods=['POST'])
+def create_upload():
+    '''Start a chunked upload: {filename, size, comments} -> {upload_id, offset, chunk_size}.'''
+    request = flask.request.get_json()
+    os.makedirs(config.UPLOAD_DIR, exist_ok=True)
+    _remove_stale_uploads()
+    upload = {
+        'upload_id': str(uuid.uuid4()),
+        'filename': os.path.basename(request['filename']),
+        'size': int(request['size']),
+        'comments': request.get('comments', ''),
+        'chunk_size': config.UPLOAD_CLIENT_CHUNK_BYTES,
+        'status': 'receiving'
+    }
+    part_path, meta_path, _ = _paths(upload['upload_id'])
+    open(part_path, 'wb').close()
+    _write(meta_path, upload)
+    upload['offset'] = 0
+    return flask.jsonify(upload)
+
+
+@app.server.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    '''Offset to resume an upload from, its status and, once ingested, the per-file results.'''
+    return flask.jsonify(_load(upload_id))
+
+
+@app.server.route('/uploads/<upload_id>', methods=['PUT'])
+def append_chunk(upload_id):
+    '''Append the request body at ?offset=N; 409 with the current offset if N is not it.'''
+    upload = _load(upload_id)
+    part_path, meta_path, _ = _paths(upload_id)
+    if upload['status'] != 'receiving':
+        return flask.jsonify({'offset': upload['offset'], 'error': 'upload already received'}), 409
+    offset = flask.request.args.get('offset', type=int)
+    with _append_lock:
+        current = os.path.getsize(part_path)
+        if offset != current:
+            return flask.jsonify({'offset': current}), 409
+        with open(part_path, 'ab') as f:
+            for chunk in iter_chunks(flask.request.stream):
+                f.write(chunk)
+                if f.tell() > upload['size']:
+                    f.truncate(current)
+                    return flask.jsonify({'offset': current, 'error': 'more data than size'}), 400
+        current = os.path.getsize(part_path)
+    # the description's mtime is what stale uploads are expired by
+    os.utime(meta_path)
+    return flask.jsonify({'offset': current})
+
+
+@app.server.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    '''Start ingesting a fully received upload in the background (202); poll GET /uploads/<id>.
+
+    Ingesting a multi-GB zip takes longer than a server's request timeout,
+    so the request only starts it. Completing an upload that is already
+    being ingested or was ingested returns its status instead of starting
+    again.
+    '''
+    upload = _load(upload_id)
+    if upload['status'] == 'completed':
+        return flask.jsonify(upload)
+    if upload['offset'] != upload['size']:
+        return flask.jsonify({'offset': upload['offset'], 'error': 'upload incomplete'}), 409
+    _, meta_path, lock_path = _paths(upload_id)
+    if _claim(lock_path):
+        upload.update(status='ingesting', processed=0, error=None)
+        _write(meta_path, upload)
+        ingest_jobs.run_in_background(ingest_upload, upload['upload_id'])
+    return flask.jsonify(upload), 202
+
+
+def ingest_upload(upload_id):
+    '''Ingest a received upload (holding its lock), then discard its partial file.
+
+    The number of files processed is written to the upload's description as
+    they are stored, and the results once all are.
+    '''
+    base = os.path.join(config.UPLOAD_DIR, upload_id)
+    part_path, meta_path, lock_path = base + '.part', base + '.json', base + '.lock'
+    with open(meta_path) as f:
+        upload = json.load(f)
+    if upload['status'] == 'completed':
+        # queued twice after its lock looked abandoned
+        return
+    os.utime(lock_path)
+
+    def on_result(result):
+        upload['processed'] += 1
+        _write(meta_path, upload)
+        os.utime(lock_path)
+
+    try:
+        with open(part_path, 'rb') as f:
+            results = ingest_file(upload['filename'], f, {'comments': upload['comments']}, on_result)
+    except Exception as e:
+        logger.exception('ingesting upload %s (%s) failed', upload_id, upload['filename'])
+        # the partial file is kept: completing the upload again retries
+        upload.update(status='failed', error=str(e))
+        _write(meta_path, upload)
+        _unlock(lock_path)
+        return
+    for item in results:
+        if item['image_id'] is not None:
+            item['image_id'] = str(item['image_id'])
+    # the description keeps the results for a later status request until it expires
+    upload.update(status='completed', results=results)
+    _write(meta_path, upload)
+    os.remove(part_path)
+    _unlock(lock_path)
@@ -1,25 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import base64
-from io import BytesIO
-import zipfile
-from PIL import Image as PImage
 import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output, State
-from pymongo import MongoClient
-import gridfs
 
-from apps import config
+from apps.ingest import ingest_file, iter_base64, spool
+from apps import upload_routes
+from apps.metrics import instrument, phase
 from app import app
 
 
-client = MongoClient(config.MONGODB_CONNECT_STRING)
-db = client[config.MONGODB_DATABASE]
-fs = gridfs.GridFS(db)
-
-
 layout = html.Div(
     [
         html.H1('Upload Images to MongoDB'),
@@ -51,51 +42,41 @@ layout = html.Div(
         ),
         html.H2('File List'),
         html.Ul(id='file-list'),
+        html.H2('Large Files'),
+        # uploaded in resumable chunks by assets/chunked-upload.js (apps/upload_routes.py)
+        html.Div('Select large image(s) or zipped images to upload in resumable chunks.'),
+        html.Button(
+            children='Select large files',
+            id='button-chunked-upload',
+            title='upload large files in resumable chunks',
+            n_clicks=0
+        ),
+        html.Div(id='chunked-upload-progress'),
+        html.Ul(id='chunked-upload-list'),
     ], className='five columns',
 )
 
 
-def extract_zip(data):
-    input_zip = zipfile.ZipFile(BytesIO(data))
-    return {name: input_zip.read(name) for name in input_zip.namelist()}
-
-
 def save_file(name, content, comments):
-    '''Decode and store a file uploaded with Plotly Dash.'''
-    files = []
+    '''Decode and store a file uploaded with Plotly Dash; returns per-file results.'''
     metadata = {}
     metadata['comments'] = comments
-    filename = name.split('.')[0]
-    data = content.encode('utf8').split(b';base64,')[1]
-    data = base64.decodebytes(data)
+    with phase('decode'):
+        upload_file = spool(iter_base64(content))
+    with upload_file, phase('ingest'):
+        return ingest_file(name, upload_file, metadata)
 
-    if name.split('.')[-1] == 'zip':
-        zipped_contents = zipfile.ZipFile(BytesIO(data))
-        for _name in zipped_contents.namelist():
-            filename = _name.split('.')[0:-1]
-            try:
-                img = PImage.open(BytesIO(zipped_contents.read(_name)))
-                content_type = img.get_format_mimetype()
-                image_id = fs.put(
-                    data=BytesIO(zipped_contents.read(_name)).getvalue(),
-                    content_type=content_type,
-                    filename=filename[0],
-                    metadata=metadata
-                )
-                files.append(_name)
-            except: IOError
-    else:
-        img = PImage.open(BytesIO(data))
-        content_type = img.get_format_mimetype()
 
-        image_id = fs.put(
-            data=data,
-            content_type=content_type,
-            filename=filename,
-            metadata=metadata
+def report_item(item):
+    '''File-list entry for one ingested file.'''
+    if item['status'] == 'stored':
+        return html.Li(item['name'])
+    if item['status'] == 'duplicate':
+        return html.Li(
+            f"{item['name']}: duplicate of {item['duplicate_of']}, not stored again",
+            style={'color': 'gray'}
         )
-        files.append(name)
-    return files
+    return html.Li(f"{item['name']}: {item['status']} ({item['error']})", style={'color': 'gray'})
 
 
 @app.callback(
@@ -103,17 +84,14 @@ def save_file(name, content, comments):
     [Input('upload-data', 'filename'),
      Input('upload-data', 'contents')],
     [State('input-comments', 'value')])
+@instrument
 def update_output(uploaded_filenames, uploaded_file_contents, comments):
     '''Save uploaded files and regenerate the file list.'''
-    files = []
+    results = []
     if uploaded_filenames is not None and uploaded_file_contents is not None:
         for name, data in zip(uploaded_filenames, uploaded_file_contents):
-            if name.split('.')[-1] != 'zip':
-                _ = save_file(name, data, comments)
-                files.append(name)
-            else:
-                files = save_file(name, data, comments)
+            results = results + save_file(name, data, comments)
 
-    if not files:
+    if not results:
         return [html.Li('No files yet!')]
-    return [html.Li(filename) for filename in files]
+    return [report_item(item) for item in results]
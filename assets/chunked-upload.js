@@ -0,0 +1,158 @@
+/* Resumable chunked uploads for the uploader page (routes in apps/upload_routes.py).
+ *
+ * Files selected with #button-chunked-upload are sent in slices with PUT
+ * /uploads/<id>?offset=N instead of being base64-encoded by dcc.Upload. The
+ * upload id is kept in localStorage, so a failed or reloaded upload of the
+ * same file continues from the offset the server already has. Once all bytes
+ * are sent, the server ingests the upload in the background and its status
+ * is polled until the per-file results are ready.
+ */
+(function () {
+    var MAX_RETRIES = 5;
+    var POLL_MS = 1000;
+
+    function uploadKey(file) {
+        return 'chunked-upload:' + file.name + ':' + file.size + ':' + file.lastModified;
+    }
+
+    function sleep(ms) {
+        return new Promise(function (resolve) { setTimeout(resolve, ms); });
+    }
+
+    async function requestJSON(method, url, body) {
+        var response = await fetch(url, {
+            method: method,
+            headers: {'Content-Type': 'application/json'},
+            body: body === undefined ? undefined : JSON.stringify(body)
+        });
+        if (!response.ok) {
+            throw new Error(method + ' ' + url + ': ' + response.status);
+        }
+        return response.json();
+    }
+
+    async function startOrResume(file, comments) {
+        var uploadId = window.localStorage.getItem(uploadKey(file));
+        if (uploadId) {
+            try {
+                return await requestJSON('GET', '/uploads/' + uploadId);
+            } catch (e) {
+                window.localStorage.removeItem(uploadKey(file));
+            }
+        }
+        var upload = await requestJSON('POST', '/uploads', {
+            filename: file.name, size: file.size, comments: comments
+        });
+        window.localStorage.setItem(uploadKey(file), upload.upload_id);
+        return upload;
+    }
+
+    async function uploadFile(file, comments, onProgress) {
+        var upload = await startOrResume(file, comments);
+        var url = '/uploads/' + upload.upload_id;
+        var offset = upload.offset;
+        var started = performance.now();
+        var startOffset = offset;
+        var retries = 0;
+        while (offset < file.size) {
+            var chunk = file.slice(offset, offset + upload.chunk_size);
+            try {
+                var response = await fetch(url + '?offset=' + offset, {method: 'PUT', body: chunk});
+                if (!response.ok && response.status !== 409) {
+                    throw new Error('PUT ' + url + ': ' + response.status);
+                }
+                // a 409 carries the offset the server expects next
+                offset = (await response.json()).offset;
+                retries = 0;
+            } catch (e) {
+                retries += 1;
+                if (retries > MAX_RETRIES) {
+                    throw e;
+                }
+                await sleep(1000 * retries);
+                offset = (await requestJSON('GET', url)).offset;
+            }
+            var seconds = (performance.now() - started) / 1000;
+            onProgress(offset, (offset - startOffset) / Math.max(seconds, 0.001));
+        }
+        var status = await requestJSON('POST', url + '/complete');
+        retries = 0;
+        while (status.status !== 'completed') {
+            if (status.status === 'failed') {
+                // the next selection of the file completes (and retries) it again
+                throw new Error(status.error);
+            }
+            onProgress(offset, 0, status.processed || 0);
+            await sleep(POLL_MS);
+            try {
+                status = await requestJSON('GET', url);
+                retries = 0;
+            } catch (e) {
+                retries += 1;
+                if (retries > MAX_RETRIES) {
+                    throw e;
+                }
+            }
+        }
+        window.localStorage.removeItem(uploadKey(file));
+        return status.results;
+    }
+
+    function formatMB(bytes) {
+        return (bytes / (1024 * 1024)).toFixed(1) + ' MB';
+    }
+
+    function appendResult(list, item) {
+        var li = document.createElement('li');
+        if (item.status === 'stored') {
+            li.textContent = item.name;
+        } else if (item.status === 'duplicate') {
+            li.textContent = item.name + ': duplicate of ' + item.duplicate_of + ', not stored again';
+        } else {
+            li.textContent = item.name + ': ' + item.status + ' (' + item.error + ')';
+        }
+        if (item.status !== 'stored') {
+            li.style.color = 'gray';
+        }
+        list.appendChild(li);
+    }
+
+    async function uploadFiles(files) {
+        var progress = document.getElementById('chunked-upload-progress');
+        var list = document.getElementById('chunked-upload-list');
+        var commentsInput = document.getElementById('input-comments');
+        var comments = commentsInput ? commentsInput.value : '';
+        for (var i = 0; i < files.length; i++) {
+            var file = files[i];
+            try {
+                var results = await uploadFile(file, comments, function (offset, rate, processed) {
+                    if (processed !== undefined) {
+                        progress.textContent = file.name + ': uploaded, ' + processed + ' file(s) processed';
+                        return;
+                    }
+                    progress.textContent = file.name + ': ' + formatMB(offset) + ' / '
+                        + formatMB(file.size) + ' (' + (100 * offset / Math.max(file.size, 1)).toFixed(0)
+                        + '%) at ' + formatMB(rate) + '/s';
+                });
+                progress.textContent = file.name + ': processed';
+                results.forEach(function (item) { appendResult(list, item); });
+            } catch (e) {
+                progress.textContent = file.name + ': upload failed, select it again to resume (' + e.message + ')';
+            }
+        }
+    }
+
+    // the button is rendered by Dash after this script runs, so listen on the document
+    document.addEventListener('click', function (evt) {
+        if (evt.target.id !== 'button-chunked-upload') {
+            return;
+        }
+        var input = document.createElement('input');
+        input.type = 'file';
+        input.multiple = true;
+        input.addEventListener('change', function () {
+            uploadFiles(Array.prototype.slice.call(input.files));
+        });
+        input.click();
+    });
+})();
@@ -0,0 +1,67 @@
+/* Figure updates of the annotator page (display_update_image in apps/annotator.py).
+ *
+ * The server keeps each session's figure and answers an event with a delta
+ * against the figure the graph shows (its seq, reported in
+ * store-figure-seq): unchanged traces come as their index in that figure,
+ * a legend event as the restyle plotly has already drawn. A delta that
+ * does not follow the figure shown is dropped; the server then sends the
+ * whole figure with the next event.
+ */
+(function () {
+    // same as apply_restyle in apps/annotator.py, on copies of the traces
+    function restyle(data, event) {
+        var update = event[0];
+        var indices = event[1];
+        data = data.slice();
+        indices.forEach(function (index, indexPos) {
+            if (index >= data.length) {
+                return;
+            }
+            var trace = JSON.parse(JSON.stringify(data[index]));
+            Object.keys(update).forEach(function (key) {
+                var value = update[key];
+                if (Array.isArray(value)) {
+                    value = value[indexPos % value.length];
+                }
+                var parents = key.split('.');
+                var attr = parents.pop();
+                var item = trace;
+                parents.forEach(function (parent) {
+                    if (item[parent] === undefined) {
+                        item[parent] = {};
+                    }
+                    item = item[parent];
+                });
+                item[attr] = value;
+            });
+            data[index] = trace;
+        });
+        return data;
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        annotator: {
+            applyFigureDelta: function (delta, figure) {
+                if (!delta) {
+                    return figure;
+                }
+                if ((delta.after !== null) && (!figure || (figure.seq !== delta.after))) {
+                    return figure;
+                }
+                var data;
+                if (delta.restyle) {
+                    data = restyle(figure.data, delta.restyle);
+                } else {
+                    data = delta.data.map(function (trace) {
+                        return (typeof trace === 'number') ? figure.data[trace] : trace;
+                    });
+                }
+                return {data: data, layout: delta.layout, seq: delta.seq};
+            },
+
+            figureSeq: function (figure) {
+                return (figure && (figure.seq !== undefined)) ? figure.seq : null;
+            }
+        }
+    });
+})();
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Latency, peak memory and payload size of the app's Dash callbacks on synthetic data.
+
+Callbacks are posted to Dash's /_dash-update-component endpoint of the
+Flask test client, so request parsing and JSON serialization are timed
+too. The database is mongomock (pip install mongomock) or a local mongod;
+a stub pyfunc model stands in for an MLflow server. Run from the
+repository root:
+
+    $ python -m benchmarks.bench_callbacks --images 200 --annotations 50 --save before.json
+    $ python -m benchmarks.bench_callbacks --images 200 --annotations 50 --baseline before.json
+    $ python -m benchmarks.bench_callbacks --mongo mongodb://localhost:27017
+'''
+
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import tracemalloc
+from io import BytesIO
+import numpy as np
+
+
+STUB_RUN_ID = 'stub-run'
+
+
+class StubModel(object):
+    '''pyfunc-like model predicting a disc of pixels in the middle of each image.'''
+
+    def __init__(self, radius):
+        self.radius = radius
+
+    def predict(self, df):
+        import pandas as pd
+        from PIL import Image as PImage
+        from apps import config
+        frames = []
+        for row, image in enumerate(df['image']):
+            width, height = PImage.open(BytesIO(base64.decodebytes(image))).size
+            yy, xx = np.mgrid[-self.radius:self.radius + 1, -self.radius:self.radius + 1]
+            inside = xx**2 + yy**2 <= self.radius**2
+            frames.append(pd.DataFrame({
+                'x': xx[inside] + width//2,
+                'y': yy[inside] + height//2,
+                config.MLFLOW_BATCH_ROW_COLUMN: row
+            }))
+        return pd.concat(frames, ignore_index=True)
+
+
+def use_mongomock():
+    '''Make apps.database create mongomock clients (before apps is imported).'''
+    import pymongo
+    import mongomock
+    import mongomock.gridfs
+    mongomock.gridfs.enable_gridfs_integration()
+    pymongo.MongoClient = mongomock.MongoClient
+
+
+def jpeg_bytes(width, height, random):
+    from PIL import Image as PImage
+    buf = BytesIO()
+    pixels = random.randint(0, 256, (height, width, 3)).astype(np.uint8)
+    PImage.fromarray(pixels).save(buf, format='JPEG', quality=85)
+    return buf.getvalue()
+
+
+def synthetic_traces(count, points, width, height, random):
+    '''Boxes and lasso polygons of the default labels.'''
+    from apps import config
+    labels = config.DEFAULT_LABELS
+    for index in range(count):
+        label = labels['labels'][index % len(labels['labels'])]
+        color = labels['colors'][index % len(labels['colors'])]
+        x0, y0 = random.uniform(0, width*0.8), random.uniform(0, height*0.8)
+        size = random.uniform(10, min(width, height)*0.2)
+        if index % 2:
+            angle = np.linspace(0, 2*np.pi, points)
+            x = np.round(x0 + size/2*(1 + np.cos(angle))).tolist()
+            y = np.round(y0 + size/2*(1 + np.sin(angle))).tolist()
+            shape_type = 'polygon'
+        else:
+            x = [x0, x0 + size, x0 + size, x0, x0]
+            y = [y0, y0, y0 + size, y0 + size, y0]
+            shape_type = 'box'
+        yield {
+            'x': x,
+            'y': y,
+            'mode': 'markers+lines',
+            'marker': {'opacity': 1, 'color': color},
+            'showlegend': True,
+            'name': f'{label} -{shape_type}',
+            'customdata': [{'shape_type': shape_type}],
+            'hoverinfo': 'name',
+            'visible': True,
+            'line': {'color': color},
+            'type': 'scattergl'
+        }
+
+
+def populate(args, random):
+    '''Synthetic images (through the ingest path) and their annotations.'''
+    from apps import annotations
+    from apps.ingest import ingest_image
+    image_ids = []
+    for index in range(args.images):
+        data = jpeg_bytes(args.width, args.height, random)
+        stored = ingest_image(f'bench_{index:06d}.jpg', BytesIO(data), {'comments': 'bench'})
+        image_ids.append(stored['image_id'])
+    for image_id in image_ids:
+        annotations.insert_traces([
+            (image_id, trace)
+            for trace in synthetic_traces(args.annotations, args.points, args.width, args.height, random)
+        ])
+    return image_ids
+
+
+class Driver(object):
+    '''Posts callback requests like the browser does and measures them.'''
+
+    def __init__(self, server):
+        self.client = server.test_client()
+
+    def post(self, outputs, inputs, state=(), changed=()):
+        if len(outputs) == 1:
+            output = outputs[0]
+        else:
+            output = '..' + '...'.join(outputs) + '..'
+        body = {
+            'output': output,
+            'inputs': [{'id': id_, 'property': prop, 'value': value} for id_, prop, value in inputs],
+            'state': [{'id': id_, 'property': prop, 'value': value} for id_, prop, value in state],
+            'changedPropIds': list(changed)
+        }
+        response = self.client.post('/_dash-update-component', json=body)
+        if response.status_code not in (200, 204):
+            raise RuntimeError(f'{output}: HTTP {response.status_code}\n{response.data[-2000:]}')
+        return response
+
+    def response(self, *args, **kwargs):
+        response = self.post(*args, **kwargs)
+        if response.status_code == 204:
+            return {}
+        return json.loads(response.data)['response']
+
+
+def measure(driver, case, repeat):
+    '''Latencies (ms), peak traced memory (MB) and mean payload bytes of a case.
+
+    case() runs its untimed setup and returns the request arguments.
+    '''
+    latencies, sizes = [], []
+    for _ in range(repeat):
+        request = case()
+        start = time.perf_counter()
+        response = driver.post(*request)
+        latencies.append((time.perf_counter() - start)*1000)
+        sizes.append(len(response.data))
+    # memory in a separate run: tracing slows the timed calls down
+    request = case()
+    tracemalloc.start()
+    driver.post(*request)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'n': repeat,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'peak_mb': peak/2**20,
+        'bytes': int(np.mean(sizes))
+    }
+
+
+def run(args):
+    from apps import config
+    from apps.models import model_cache
+    from apps.sessions import new_session_id
+    from apps.jobs import job_manager, jobs, FINISHED
+    import index
+
+    random = np.random.RandomState(args.seed)
+    start = time.perf_counter()
+    populate(args, random)
+    print(f'{args.images} images with {args.annotations} annotations each '
+          f'generated in {time.perf_counter() - start:.1f} s')
+    model_cache.put(STUB_RUN_ID, 'pyfunc_model', 'stub', StubModel(args.model_radius))
+
+    driver = Driver(index.app.server)
+    session_id = new_session_id()
+    label_data = [
+        {'labels': label, 'colors': color}
+        for label, color in zip(config.DEFAULT_LABELS['labels'], config.DEFAULT_LABELS['colors'])
+    ]
+    query_outputs = ['store-query.data', 'datatable-filenames.page_current']
+    query_state = [('input-num-imgs', 'value', args.images),
+                   ('input-annotation-labels', 'value', ''),
+                   ('output-data-upload', 'children', None)]
+    page_outputs = ['datatable-filenames.data', 'datatable-filenames.columns',
+                    'datatable-filenames.selected_rows', 'store-page-keys.data']
+    page_state = [('datatable-filenames', 'page_size', 10), ('store-page-keys', 'data', None)]
+
+    query = driver.response(query_outputs, [('button-download-meta', 'n_clicks', 1)], query_state,
+                            ['button-download-meta.n_clicks'])['store-query']['data']
+    file_data = driver.response(page_outputs, [('store-query', 'data', query),
+                                               ('datatable-filenames', 'page_current', 0)],
+                                page_state, ['store-query.data'])['datatable-filenames']['data']
+
+    display_outputs = ['graph-image.figure', 'booleanswitch-edit-output.children']
+    display_defaults = {
+        ('datatable-filenames', 'selected_rows'): [0],
+        ('graph-image', 'selectedData'): None,
+        ('datatable-labels', 'selected_rows'): [0],
+        ('daq-booleanswitch-edit', 'on'): False,
+        ('button-rect', 'n_clicks'): 0,
+        ('button-lasso', 'n_clicks'): 0,
+        ('javascript-ctrl-click', 'event'): None,
+        ('javascript-ctrl-keyup', 'event'): None,
+        ('button-mlflow-single', 'n_clicks'): 0,
+        ('button-remove-traces', 'n_clicks'): 0,
+        ('graph-image', 'restyleData'): None
+    }
+    display_state = [('dropdown-select-run', 'value', STUB_RUN_ID),
+                     ('datatable-filenames', 'data', file_data),
+                     ('datatable-labels', 'data', label_data),
+                     ('daq-booleanswitch-edit', 'on', False),
+                     ('daq-booleanswitch-lasso', 'on', False),
+                     ('store-shapes', 'data', None),
+                     ('input-annotation-labels', 'value', ''),
+                     ('session-id', 'data', session_id)]
+
+    def display(trigger, value):
+        '''Request of display_update_image triggered by one input.'''
+        values = dict(display_defaults)
+        values[trigger] = value
+        inputs = [(id_, prop, value) for (id_, prop), value in values.items()]
+        return display_outputs, inputs, display_state, ['.'.join(trigger)]
+
+    def select_image():
+        driver.post(*display(('datatable-filenames', 'selected_rows'), [0]))
+
+    def after_select(request):
+        def case():
+            select_image()
+            return request
+        return case
+
+    angle = np.linspace(0, 2*np.pi, args.points)
+    lasso = {'lassoPoints': {
+        'x': (args.width/2 + args.width/4*np.cos(angle)).tolist(),
+        'y': (args.height/2 + args.height/4*np.sin(angle)).tolist()
+    }}
+    box = {'range': {'x': [10, args.width/3], 'y': [10, args.height/3]}}
+
+    def save_case():
+        select_image()
+        driver.post(*display(('graph-image', 'selectedData'), box))
+        return (['report-save.children'], [('button-save', 'n_clicks', 1)],
+                [('datatable-filenames', 'data', file_data),
+                 ('datatable-filenames', 'selected_rows', [0]),
+                 ('session-id', 'data', session_id)],
+                ['button-save.n_clicks'])
+
+    uploads = iter([jpeg_bytes(args.width, args.height, random) for _ in range(args.repeat + 1)])
+
+    def upload_case():
+        content = 'data:image/jpeg;base64,' + base64.b64encode(next(uploads)).decode()
+        return (['file-list.children'],
+                [('upload-data', 'filename', ['upload.jpg']), ('upload-data', 'contents', [content])],
+                [('input-comments', 'value', 'bench')],
+                ['upload-data.contents'])
+
+    def cancel_jobs():
+        for job in jobs.find({'status': {'$nin': list(FINISHED)}}, {'_id': 1}):
+            job_manager.cancel(job['_id'])
+
+    def batch_case():
+        # only the submission is timed; earlier jobs stop after their images in flight
+        cancel_jobs()
+        return (['store-job-id.data'],
+                [('button-mlflow-batch', 'n_clicks', 1), ('button-mlflow-cancel', 'n_clicks', 0),
+                 ('button-mlflow-resume', 'n_clicks', 0)],
+                [('store-query', 'data', query), ('datatable-labels', 'data', label_data),
+                 ('datatable-labels', 'selected_rows', [0]), ('dropdown-select-run', 'value', STUB_RUN_ID),
+                 ('store-job-id', 'data', None)],
+                ['button-mlflow-batch.n_clicks'])
+
+    cases = [
+        ('query_db', lambda: (query_outputs, [('button-download-meta', 'n_clicks', 1)], query_state,
+                              ['button-download-meta.n_clicks'])),
+        ('page_filenames', lambda: (page_outputs, [('store-query', 'data', query),
+                                                   ('datatable-filenames', 'page_current', 1)],
+                                    page_state, ['datatable-filenames.page_current'])),
+        ('display: select image', lambda: display(('datatable-filenames', 'selected_rows'), [0])),
+        ('display: box', after_select(display(('graph-image', 'selectedData'), box))),
+        ('display: lasso', after_select(display(('graph-image', 'selectedData'), lasso))),
+        ('display: ctrl-click', after_select(display(('javascript-ctrl-click', 'event'), {'x': 5, 'y': 5}))),
+        ('display: edit boxes', after_select(display(('daq-booleanswitch-edit', 'on'), True))),
+        ('display: rect mode', after_select(display(('button-rect', 'n_clicks'), 1))),
+        ('display: model', after_select(display(('button-mlflow-single', 'n_clicks'), 1))),
+        ('display: remove traces', after_select(display(('button-remove-traces', 'n_clicks'), 1))),
+        ('display: legend click', after_select(display(('graph-image', 'restyleData'),
+                                                       [{'visible': ['legendonly']}, [1]]))),
+        ('save_metadata', save_case),
+        ('uploader update_output', upload_case),
+        ('mlflow_batch', batch_case),
+    ]
+    results = {}
+    for name, case in cases:
+        if args.only and not any(pattern in name for pattern in args.only):
+            continue
+        results[name] = measure(driver, case, args.repeat)
+        print_row(name, results[name])
+    cancel_jobs()
+    # let cancelled jobs finish before the interpreter shuts their thread pools down
+    deadline = time.time() + 60
+    while jobs.count_documents({'status': {'$nin': list(FINISHED)}}) and (time.time() < deadline):
+        time.sleep(0.2)
+    return results
+
+
+def print_row(name, result, baseline=None):
+    row = (f"{name:<26} {result['n']:>4} {result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} "
+           f"{result['peak_mb']:>8.1f} {result['bytes']/1024:>10.1f}")
+    if baseline:
+        row += f" {result['p50_ms']/baseline['p50_ms'] - 1:>+9.0%} {result['bytes']/max(baseline['bytes'], 1) - 1:>+9.0%}"
+    print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mongo', default='mongomock', help="'mongomock' or a mongodb:// URI of a local mongod")
+    parser.add_argument('--database', default='dash_image_annotator_bench_callbacks')
+    parser.add_argument('--images', type=int, default=50)
+    parser.add_argument('--annotations', type=int, default=20, help='annotations per image')
+    parser.add_argument('--points', type=int, default=200, help='points per lasso annotation')
+    parser.add_argument('--width', type=int, default=1024)
+    parser.add_argument('--height', type=int, default=768)
+    parser.add_argument('--model-radius', type=int, default=50, help='radius (pixels) of the stub predictions')
+    parser.add_argument('--repeat', type=int, default=20, help='timed calls per callback')
+    parser.add_argument('--only', nargs='+', help='only callbacks whose name contains one of these')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the results as JSON (a baseline for --baseline)')
+    parser.add_argument('--baseline', help='JSON of an earlier --save to compare with')
+    parser.add_argument('--keep', action='store_true', help='keep the benchmark database of a local mongod')
+    args = parser.parse_args()
+
+    # apps.config reads these at import
+    os.environ['MONGODB_DATABASE'] = args.database
+    os.environ['MLFLOW_URI'] = 'stub://'
+    os.environ['APP_PAGES'] = 'annotator,uploader'
+    os.environ['JOB_EXECUTOR'] = 'thread'
+    os.environ['SESSION_BACKEND'] = 'memory'
+    if args.mongo == 'mongomock':
+        os.environ['MONGODB_CONNECT_STRING'] = 'mongodb://localhost'
+        # mongomock ignores partial index filters, which the unique sha256 index relies on
+        os.environ['MONGODB_ENSURE_INDEXES'] = '0'
+        use_mongomock()
+    else:
+        os.environ['MONGODB_CONNECT_STRING'] = args.mongo
+    from apps.database import client
+    client.drop_database(args.database)
+
+    print(f"{'callback':<26} {'n':>4} {'p50 ms':>9} {'p95 ms':>9} {'peak MB':>8} {'payload KB':>10}")
+    try:
+        results = run(args)
+    finally:
+        if not args.keep:
+            client.drop_database(args.database)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\n{'compared with ' + args.baseline:<60} {'p50':>9} {'payload':>9}")
+        for name, result in results.items():
+            if name in baseline:
+                print_row(name, result, baseline[name])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
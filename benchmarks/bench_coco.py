@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Throughput and peak memory of the COCO export and import on a synthetic dataset.
+
+The dataset is written to its own database (dropped afterwards unless --keep);
+MONGODB_CONNECT_STRING must be set as for the app:
+
+    $ python -m benchmarks.bench_coco --images 10000 --annotations 20
+'''
+
+import os
+import sys
+import time
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+import numpy as np
+
+
+def synthetic_files(count, width, height):
+    '''fs.files documents (without chunks: the COCO export only reads metadata).'''
+    from bson.objectid import ObjectId
+    now = datetime.datetime.utcnow()
+    for index in range(count):
+        yield {
+            '_id': ObjectId(),
+            'filename': f'image_{index:07d}',
+            'contentType': 'image/jpeg',
+            'length': 0,
+            'chunkSize': 261120,
+            'uploadDate': now,
+            'metadata': {'width': width, 'height': height, 'comments': ''}
+        }
+
+
+def synthetic_traces(image_id, count, width, height, labels, random):
+    '''Boxes, lasso polygons and masks at random positions.'''
+    from apps.coco import _trace
+    from apps.masks import rle_encode
+    for index in range(count):
+        label = labels[index % len(labels)]
+        x0, y0 = random.uniform(0, width - 100), random.uniform(0, height - 100)
+        size = random.uniform(10, 100)
+        kind = index % 3
+        if kind == 0:
+            yield image_id, _trace(label, 'rgb(255,0,0)', 'box',
+                                   [x0, x0 + size, x0 + size, x0, x0], [y0, y0, y0 + size, y0 + size, y0])
+        elif kind == 1:
+            angle = np.linspace(0, 2*np.pi, 200)
+            x = np.round(x0 + size/2*(1 + np.cos(angle)))
+            y = np.round(y0 + size/2*(1 + np.sin(angle)))
+            yield image_id, _trace(label, 'rgb(0,255,0)', 'polygon', x.tolist(), y.tolist())
+        else:
+            mask = np.zeros((height, width), dtype=bool)
+            row, col = int(height - y0 - size), int(x0)
+            mask[row:row + int(size), col:col + int(size)] = True
+            trace = _trace(label, 'rgb(0,0,255)', 'mask', [], [], rle=rle_encode(mask))
+            yield image_id, trace
+
+
+def measure(function, *args):
+    '''(result, seconds, peak traced MB) of a call.'''
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak/2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='dash_image_annotator_bench_coco')
+    parser.add_argument('--images', type=int, default=1000)
+    parser.add_argument('--annotations', type=int, default=10, help='annotations per image')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--batch-size', type=int, default=1000, help='annotations per bulk_write on import')
+    parser.add_argument('--keep', action='store_true', help='keep the benchmark database')
+    args = parser.parse_args()
+
+    # apps.config reads the database name at import
+    os.environ['MONGODB_DATABASE'] = args.database
+    from apps.database import client, db
+    from apps import annotations, coco
+    from apps.indexes import ensure_indexes
+
+    try:
+        client.drop_database(args.database)
+        ensure_indexes()
+        random = np.random.RandomState(0)
+        labels = [f'label_{index}' for index in range(1, 5)]
+        start = time.perf_counter()
+        files = list(synthetic_files(args.images, args.width, args.height))
+        db.fs.files.insert_many(files)
+        for doc in files:
+            annotations.insert_traces(list(synthetic_traces(
+                doc['_id'], args.annotations, args.width, args.height, labels, random
+            )))
+        num_annotations = annotations.collection.count_documents({})
+        print(f'{args.images} images, {num_annotations} annotations generated in '
+              f'{time.perf_counter() - start:.1f} s')
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'coco.json')
+
+            def export():
+                with open(path, 'w') as out:
+                    for piece in coco.iter_coco_json():
+                        out.write(piece)
+
+            _, elapsed, peak = measure(export)
+            size = os.path.getsize(path)/2**20
+            print(f'export: {elapsed:8.2f} s {num_annotations/elapsed:10.0f} annotations/s '
+                  f'{size:8.1f} MB JSON  peak {peak:7.1f} MB')
+
+            annotations.collection.delete_many({})
+
+            def import_():
+                with open(path) as fp:
+                    return coco.import_coco(fp, batch_size=args.batch_size)
+
+            counts, elapsed, peak = measure(import_)
+            print(f"import: {elapsed:8.2f} s {counts['annotations']/elapsed:10.0f} annotations/s "
+                  f"{counts['annotations']:>8} written  peak {peak:7.1f} MB")
+            if counts['annotations'] != num_annotations:
+                print(f'warning: {num_annotations} annotations exported, '
+                      f"{counts['annotations']} imported", file=sys.stderr)
+    finally:
+        if not args.keep:
+            client.drop_database(args.database)
+
+
+if __name__ == '__main__':
+    main()
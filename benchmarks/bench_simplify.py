@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Point reduction and timing of apps.simplify on stored or synthetic annotations.
+
+Run from the repository root with the env variables from apps/config.py set:
+
+    $ python -m benchmarks.bench_simplify --limit 1000 --tolerances 0.5 1 2
+    $ python -m benchmarks.bench_simplify --synthetic 200
+'''
+
+import time
+import argparse
+import numpy as np
+
+from apps import annotations, geometry
+from apps.simplify import simplify_points
+
+
+def stored_traces(label=None, source=None, limit=1000):
+    '''(shape_type, x, y) of stored lasso and model annotations.'''
+    search_request = {'shape_type': {'$in': ['line', 'polygon', 'model']}}
+    if label:
+        search_request['label'] = label
+    if source:
+        search_request['source'] = source
+    projection = {'shape_type': 1, 'geometry': 1}
+    for doc in annotations.collection.find(search_request, projection).limit(limit):
+        x, y = geometry.decode_points(doc['geometry'])
+        yield doc['shape_type'], x, y
+
+
+def synthetic_traces(count, seed=0):
+    '''Free-hand-like closed lassos (noisy circles) and model point clouds.'''
+    random = np.random.RandomState(seed)
+    for _ in range(count):
+        num_points = random.randint(200, 2000)
+        angle = np.linspace(0, 2*np.pi, num_points)
+        radius = random.uniform(20, 300) + np.cumsum(random.normal(0, 0.3, num_points))
+        x = 500 + radius*np.cos(angle)
+        y = 500 + radius*np.sin(angle)
+        yield 'polygon', np.append(x, x[0]), np.append(y, y[0])
+        num_points = random.randint(1000, 50000)
+        yield 'model', random.uniform(0, 2000, num_points), random.uniform(0, 2000, num_points)
+
+
+def run(traces, tolerances):
+    results = {}
+    for shape_type, x, y in traces:
+        for tolerance in tolerances:
+            start = time.perf_counter()
+            x_simple, _ = simplify_points(x, y, shape_type, tolerance)
+            elapsed = time.perf_counter() - start
+            row = results.setdefault((shape_type, tolerance), [0, 0, 0, 0.0])
+            row[0] += 1
+            row[1] += len(x)
+            row[2] += len(x_simple)
+            row[3] += elapsed
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tolerances', type=float, nargs='+', default=[0.5, 1.0, 2.0])
+    parser.add_argument('--label', help='only annotations with this label')
+    parser.add_argument('--source', help="only annotations from this source ('manual' or a run id)")
+    parser.add_argument('--limit', type=int, default=1000, help='max stored annotations')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='use this many synthetic lasso/model pairs instead of stored annotations')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        traces = list(synthetic_traces(args.synthetic))
+    else:
+        traces = list(stored_traces(args.label, args.source, args.limit))
+    print(f'{len(traces)} traces')
+    print(f"{'shape':<8} {'tolerance':>9} {'traces':>7} {'points':>10} {'kept':>10} "
+          f"{'reduction':>9} {'ms total':>9} {'ms/trace':>9}")
+    for (shape_type, tolerance), (count, before, after, elapsed) in sorted(run(traces, args.tolerances).items()):
+        print(f'{shape_type:<8} {tolerance:>9g} {count:>7} {before:>10} {after:>10} '
+              f'{1 - after/max(before, 1):>9.1%} {elapsed*1000:>9.1f} {elapsed*1000/count:>9.3f}')
+
+
+if __name__ == '__main__':
+    main()
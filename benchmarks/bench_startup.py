@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Import time per module of the app's entry points, parsed from python -X importtime.
+
+Each target is imported in a fresh interpreter (best of --repeat runs), with
+MONGODB_ENSURE_INDEXES=0 so no database round trip is timed. Run from the
+repository root with the env variables from apps/config.py set:
+
+    $ python -m benchmarks.bench_startup
+    $ python -m benchmarks.bench_startup index --save startup.json
+    $ python -m benchmarks.bench_startup index --baseline startup.json --threshold 0.2
+'''
+
+import os
+import re
+import sys
+import json
+import argparse
+import subprocess
+
+
+TARGETS = ('index', 'apps.uploader', 'apps.annotator')
+# modules that should only be imported on first use
+LAZY_MODULES = ('mlflow', 'tensorflow', 'keras')
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def import_times(target, env=None):
+    '''{module: (self us, cumulative us)} of importing target in a new interpreter.'''
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {target}'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, universal_newlines=True
+    )
+    times = {}
+    for line in process.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            times[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+    if process.returncode != 0:
+        raise RuntimeError(f'importing {target} failed:\n{process.stderr[-2000:]}')
+    return times
+
+
+def best_of(target, repeat, env=None):
+    '''Per-module minimum over repeated imports (import times are noisy).'''
+    best = {}
+    for _ in range(repeat):
+        for module, (self_us, cumulative_us) in import_times(target, env).items():
+            if module in best:
+                self_us = min(self_us, best[module][0])
+                cumulative_us = min(cumulative_us, best[module][1])
+            best[module] = (self_us, cumulative_us)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('targets', nargs='*', default=list(TARGETS), help='modules to import')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=15, help='slowest modules listed per target')
+    parser.add_argument('--save', help='write the results as JSON (a baseline for --baseline)')
+    parser.add_argument('--baseline', help='JSON of an earlier --save to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slow-down of a target over the baseline that fails the run')
+    args = parser.parse_args()
+
+    env = dict(os.environ, MONGODB_ENSURE_INDEXES='0')
+    results = {}
+    for target in args.targets:
+        results[target] = times = best_of(target, args.repeat, env)
+        print(f'{target}: {times[target][1]/1000:.0f} ms, {len(times)} modules')
+        print(f"  {'module':<50} {'self ms':>9} {'cumul. ms':>10}")
+        slowest = sorted(times.items(), key=lambda item: item[1][1], reverse=True)
+        for module, (self_us, cumulative_us) in slowest[:args.top]:
+            print(f'  {module:<50} {self_us/1000:>9.1f} {cumulative_us/1000:>10.1f}')
+        lazy = sorted(module for module in times if module.split('.')[0] in LAZY_MODULES)
+        if lazy:
+            print(f"  warning: imported at startup: {', '.join(lazy[:10])}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = []
+        for target, times in results.items():
+            if target not in baseline:
+                continue
+            before, after = baseline[target][target][1], times[target][1]
+            change = after/before - 1
+            print(f'{target}: {before/1000:.0f} ms -> {after/1000:.0f} ms ({change:+.0%})')
+            new_modules = sorted(set(times) - set(baseline[target]))
+            if new_modules:
+                print(f"  newly imported: {', '.join(new_modules[:20])}")
+            if change > args.threshold:
+                regressions.append(target)
+        if regressions:
+            print(f"import time regression: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,38 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import logging
+import importlib
 import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output
 
 from app import app
-from apps import annotator, uploader, config
+from apps import config, health
+from apps.indexes import ensure_indexes
 
 
+if config.MONGODB_ENSURE_INDEXES:
+    ensure_indexes()
+
+
+# only configured pages are imported (their callbacks register at import)
+pages = {name: importlib.import_module(f'apps.{name}') for name in config.APP_PAGES}
+default_page = config.APP_PAGES[0]
+
+
+def page_link(name):
+    '''Link to the other page (hidden when only one page is served).'''
+    others = [other for other in config.APP_PAGES if other != name]
+    if not others:
+        return '', '/'
+    return f'Navigate to {others[0]}', f'/apps/{others[0]}'
+
+
+link_children, link_href = page_link(default_page)
 app.layout = html.Div([
-    dcc.Location(id='url-location', refresh=False, href='/apps/annotator'),
-    dcc.Link(id='link', children='Navigate to uploader', href='/apps/uploader'),
+    dcc.Location(id='url-location', refresh=False, href=f'/apps/{default_page}'),
+    dcc.Link(id='link', children=link_children, href=link_href),
     html.Br(),
     # content will be rendered in this element
     html.Div(id='page-content')
@@ -23,13 +44,13 @@ app.layout = html.Div([
                Output('link', 'href')],
               [Input('url-location', 'pathname')])
 def display_page(pathname):
-    if pathname == '/apps/annotator':
-        return annotator.layout, 'Navigate to uploader', '/apps/uploader'
-    if pathname == '/apps/uploader':
-        return uploader.layout, 'Navigate to annotator', '/apps/annotator'
-    return annotator.layout, 'Navigate to uploader', '/apps/uploader'
+    name = (pathname or '').rpartition('/')[2]
+    if name not in pages:
+        name = default_page
+    return (pages[name].layout,) + page_link(name)
 
 
 if __name__ == '__main__':
+    if config.MONGODB_EXPLAIN:
+        logging.basicConfig(level=logging.INFO)
     app.run_server(host=config.HOST, port=config.PORT, debug=True)
-    
\ No newline at end of file
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Production entry point, e.g.
+
+    $ SESSION_BACKEND=file gunicorn --workers 4 --bind 0.0.0.0:8050 wsgi:server
+
+The annotator keeps its per-session state on the server, so several
+workers need a shared session store: SESSION_BACKEND=file on one host,
+SESSION_BACKEND=mongo across hosts (see apps/config.py). The default
+memory store only works with a single worker, and several workers
+refuse to start with it.
+
+Each worker process creates its own MongoDB client on first use, so the
+app can also be preloaded (--preload) before workers are forked. With
+WARM_UP=1 each worker warms up in the background from its first request
+(see apps/health.py), never in the preloading master.
+'''
+
+import sys
+import logging
+
+from apps import config
+from index import app
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def gunicorn_workers():
+    '''Worker count of the gunicorn server importing this module (None if unknown or not gunicorn).'''
+    if 'gunicorn' not in sys.modules:
+        return None
+    from gunicorn.app.wsgiapp import WSGIApplication
+    try:
+        # the command line, GUNICORN_CMD_ARGS, WEB_CONCURRENCY and config file, as gunicorn reads them
+        return WSGIApplication('%(prog)s [OPTIONS] [APP_MODULE]').cfg.workers
+    except (Exception, SystemExit):
+        return None
+
+
+if config.SESSION_BACKEND == 'memory':
+    workers = gunicorn_workers()
+    if (workers is not None) and (workers > 1):
+        raise RuntimeError(
+            f'SESSION_BACKEND=memory keeps annotator sessions in one worker process; '
+            f'set SESSION_BACKEND=file (one host) or mongo to run {workers} workers'
+        )
+    if (workers is None) and ('gunicorn' in sys.modules):
+        logger.warning(
+            'SESSION_BACKEND=memory only works with a single worker; '
+            'set SESSION_BACKEND=file or mongo for several'
+        )
+
+server = app.server